@@ -4,7 +4,13 @@ from django.contrib.admin.templatetags.admin_list import _boolean_icon
 
 # Mass Migration
 from .loader import store
-from .models import MigrationRecord
+from .models import (
+    MigrationAttempt,
+    MigrationErrorSample,
+    MigrationRecord,
+    MigrationSnapshot,
+    MigrationTask,
+)
 
 
 class MigrationRecordAdmin(admin.ModelAdmin):
@@ -23,4 +29,47 @@ class MigrationRecordAdmin(admin.ModelAdmin):
         return _boolean_icon((not obj.has_error) if obj.is_applied else None)
 
 
+class MigrationErrorSampleAdmin(admin.ModelAdmin):
+    """ Custom admin class for the MigrationErrorSample model. """
+
+    list_display = ("key", "error_type", "occurred_at", "attempt_uuid")
+    list_filter = ("error_type",)
+    search_fields = ("key",)
+    readonly_fields = ("attempt_uuid", "occurred_at")
+
+
+class MigrationAttemptAdmin(admin.ModelAdmin):
+    """ Custom admin class for the MigrationAttempt model. """
+
+    list_display = (
+        "key", "db_alias", "status", "started_at", "duration", "objects_processed",
+        "objects_per_second", "peak_task_seconds",
+    )
+    list_filter = ("status", "db_alias")
+    search_fields = ("key",)
+    readonly_fields = ("attempt_uuid", "started_at")
+
+
+class MigrationTaskAdmin(admin.ModelAdmin):
+    """ Custom admin class for the MigrationTask model. """
+
+    list_display = (
+        "key", "phase", "status", "worker", "objects_processed", "peak_memory", "heartbeat_at", "created_at"
+    )
+    list_filter = ("status", "phase")
+    search_fields = ("key",)
+
+
+class MigrationSnapshotAdmin(admin.ModelAdmin):
+    """ Custom admin class for the MigrationSnapshot model. """
+
+    list_display = ("key", "model", "path", "object_count", "created_at")
+    search_fields = ("key",)
+    readonly_fields = ("attempt_uuid", "created_at")
+
+
 admin.site.register(MigrationRecord, MigrationRecordAdmin)
+admin.site.register(MigrationErrorSample, MigrationErrorSampleAdmin)
+admin.site.register(MigrationAttempt, MigrationAttemptAdmin)
+admin.site.register(MigrationTask, MigrationTaskAdmin)
+admin.site.register(MigrationSnapshot, MigrationSnapshotAdmin)
@@ -5,12 +5,16 @@
 # Standard library
 from typing import List
 
+# Third party
+from django.db.models import QuerySet
+
 # Mass Migration
 from . import enforcement
 from .exceptions import MigrationAlreadyStarted
 from .loader import store
-from .migrations import BaseMigration
-from .models import MigrationRecord
+from .migrations import BaseMigration, IncrementalMapperMigration
+from .models import MigrationAttempt, MigrationRecord
+from .planner import MigrationPlan, plan_migration as _plan_migration
 
 
 def get_all_migrations() -> List[BaseMigration]:
@@ -44,6 +48,45 @@ def can_start_migration(migration: BaseMigration, db_alias: str) -> bool:
     ).exists()
 
 
+def get_migration_attempts(migration: BaseMigration, db_alias: str) -> QuerySet:
+    """ Returns the MigrationAttempts (the history of every attempt at running the given migration
+        on the given DB, including those whose records have been deleted), newest first.
+    """
+    return MigrationAttempt.objects.using(db_alias).filter(key=migration.key)
+
+
+def plan_migration(migration: BaseMigration, db_alias: str, estimate: bool = True) -> MigrationPlan:
+    """ Work out what launching the given migration would involve: the size of its queryset, the
+        DB's query plan, the key ranges it would be split into and its projected duration.
+        Unless `estimate` is False, only the size of the queryset's table is given, from its table
+        statistics (on PostgreSQL and MySQL; elsewhere it's unknown), and the objects aren't counted.
+    """
+    return _plan_migration(migration, db_alias, estimate)
+
+
+def pause_migration(migration: BaseMigration, db_alias: str) -> None:
+    """ Pause the given running migration. Its tasks stop at the end of their current chunk and
+        wait until it's resumed. Raises MigrationNotRunning if it isn't running.
+    """
+    migration.pause(db_alias)
+
+
+def resume_migration(migration: BaseMigration, db_alias: str) -> None:
+    """ Resume the given paused migration, continuing the same attempt from where it stopped. """
+    migration.resume(db_alias)
+
+
+def run_incremental_migration(migration: IncrementalMapperMigration, db_alias: str) -> bool:
+    """ Launch (or re-launch) the given incremental migration if there are objects which it hasn't
+        processed yet and it isn't already running. Returns True if it was launched. This is
+        designed to be called on a schedule, e.g. by the `massmigration_run_incremental` command.
+    """
+    if not migration.can_be_started(db_alias) or not migration.has_new_objects(db_alias):
+        return False
+    migration.launch(db_alias)
+    return True
+
+
 def initiate_migration(migration: BaseMigration, db_alias: str) -> bool:
     if migration_is_in_progress(migration):
         raise MigrationAlreadyStarted(f"Migration {migration.key} on db '{db_alias}' is already running.")
@@ -0,0 +1,26 @@
+# Standard library
+import logging
+
+# Third party
+from django.apps import AppConfig
+from django.conf import settings
+from django.db import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+
+class MassMigrationConfig(AppConfig):
+    name = "massmigration"
+    # So that the PK type of the app's models doesn't depend on the project's DEFAULT_AUTO_FIELD
+    default_auto_field = "django.db.models.AutoField"
+
+    def ready(self):
+        # Connects the signal which invalidates each process's cache of applied migrations
+        from . import enforcement
+
+        if getattr(settings, "MASSMIGRATION_WARM_APPLIED_MIGRATIONS", False):
+            try:
+                enforcement.warm_applied_migrations()
+            except DatabaseError:
+                # E.g. the tables don't exist yet because Django's `migrate` hasn't been run
+                logger.exception("Failed to load the applied mass migrations.")
@@ -26,3 +26,31 @@ class BackendBase(ABC):
             iteration can be stopped. But continuing to iterate will do no harm.
         """
         raise NotImplementedError
+
+    def run_update(self, migration):
+        """ Run the given UpdateMigration (or other ChunkedMigration) by calling
+            migration.wrapped_chunks(attempt_uuid, db_alias, lower, upper) for ranges of PKs which
+            together cover the whole of the get_queryset() queryset.
+            This MUST:
+            * Call migration.mark_as_started() before performing the data operation.
+            * Exhaust the `wrapped_chunks()` generator for every range. It yields after each chunk
+              so that the backend can record the PK which it got up to, and pass it as `after` to
+              continue from there if the processing is interrupted.
+            * Call migration.mark_as_finished() when all of the ranges have been processed.
+        """
+        raise NotImplementedError
+
+    def run_delete(self, migration):
+        """ Run the given DeleteMigration. The requirements are the same as for `run_update`. """
+        raise NotImplementedError
+
+    def run_copy(self, migration):
+        """ Run the given CopyMigration. The requirements are the same as for `run_update`. """
+        raise NotImplementedError
+
+    def get_key_ranges(self, migration, db_alias):
+        """ Return the (lower, upper) ranges of PKs which the given migration's queryset would be
+            split into, one per task, for showing in the migration's launch plan. Backends which
+            don't split querysets themselves can return None.
+        """
+        return None
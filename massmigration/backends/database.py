@@ -0,0 +1,270 @@
+# Standard library
+from contextlib import contextmanager
+from datetime import timedelta
+import logging
+import threading
+
+# Third party
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+# Mass Migration
+from massmigration.exceptions import TaskClaimLimitExceeded
+from massmigration.loader import store
+from massmigration.models import MigrationRecord, MigrationTask
+from massmigration.tasks import (
+    complete_task,
+    create_tasks,
+    get_paused_task_delay,
+    get_shard_count,
+    run_task,
+    task_must_wait,
+)
+from massmigration.utils.key_ranges import get_key_ranges
+from massmigration.utils.memory import memory_limit_exceeded
+from massmigration.utils.transaction import get_transaction
+from .base import BackendBase
+
+logger = logging.getLogger(__name__)
+
+
+# While a worker is processing a task, its lease is renewed by a background thread every third of
+# this, so the task is only re-claimed by another worker if its worker dies (or stops responding),
+# however long an operation or a chunk of objects takes.
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_CLAIMS = 10
+
+
+class DatabaseBackend(BackendBase):
+    """ Backend which stores the work to be done as MigrationTask objects in the database, to be
+        processed by any number of `massmigration_worker` processes on any number of machines.
+        Workers claim tasks with `SELECT ... FOR UPDATE SKIP LOCKED`, so this requires a SQL
+        database which supports that (e.g. PostgreSQL or MySQL 8+).
+
+        Optional `backend_params`:
+        - `shard_count` - the number of tasks to split a migration's queryset into.
+        - `chunk_size` - the number of objects to fetch per query when processing a mapper task.
+        - `target_chunk_seconds` - enables adaptive chunk sizing for mapper migrations, where
+            the number of objects fetched per query is chosen so that each chunk takes roughly
+            this long.
+        - `min_chunk_size`/`max_chunk_size` - the limits for adaptive chunk sizing.
+        - `split_after_seconds` - enables splitting of long-running tasks, where each time a task
+            has been running for this long, the upper half of its remaining range is handed to a
+            new task, for another worker to pick up.
+        - `min_split_size` - the smallest number of remaining objects which will be split.
+        - `max_claims` - the number of times a task may be claimed by a worker without being
+            finished (e.g. because processing it keeps raising an exception) before the migration
+            is marked as errored. Overrides `settings.MASSMIGRATION_MAX_TASK_CLAIMS`.
+    """
+
+    def run_simple(self, migration, db_alias):
+        # The migration is marked as started here, so that the task belongs to its attempt
+        with get_transaction(db_alias).atomic(using=db_alias):
+            attempt_uuid = migration.mark_as_started(db_alias)
+            MigrationTask.objects.using(db_alias).create(
+                key=migration.key, attempt_uuid=attempt_uuid, backend_method="run_simple"
+            )
+        logger.info("Queued task to run single-task migration %s", migration.key)
+
+    def run_mapper(self, migration, db_alias):
+        self._queue_range_tasks(migration, db_alias)
+
+    def run_update(self, migration, db_alias):
+        self._queue_range_tasks(migration, db_alias)
+
+    def run_delete(self, migration, db_alias):
+        self._queue_range_tasks(migration, db_alias)
+
+    def run_copy(self, migration, db_alias):
+        self._queue_range_tasks(migration, db_alias)
+
+    def get_key_ranges(self, migration, db_alias):
+        queryset = migration.get_task_queryset(db_alias)
+        return get_key_ranges(queryset, get_shard_count(migration))
+
+    def claim_task(self, db_alias, worker, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """ Claim the next available task from the given DB for the given worker, or return None if
+            there isn't one. Tasks whose lease has expired (i.e. whose worker has died) are re-claimed,
+            unless they've already been claimed `max_claims` times, in which case they're abandoned
+            and their migration is marked as errored.
+        """
+        while True:
+            task, abandoned = self._claim_next_task(db_alias, worker, lease_seconds)
+            if not abandoned:
+                return task
+
+    def _claim_next_task(self, db_alias, worker, lease_seconds):
+        """ Claim the next available task. Returns the task (or None) and whether it was abandoned. """
+        now = timezone.now()
+        with get_transaction(db_alias).atomic(using=db_alias):
+            task = MigrationTask.objects.using(db_alias).select_for_update(skip_locked=True).filter(
+                Q(available_at__isnull=True) | Q(available_at__lte=now),
+                status__in=[MigrationTask.Status.PENDING, MigrationTask.Status.RUNNING],
+            ).exclude(
+                status=MigrationTask.Status.RUNNING, lease_expires_at__gte=now
+            ).first()
+            if task:
+                if task.status == MigrationTask.Status.RUNNING:
+                    logger.warning(
+                        "Lease of task %s for migration %s expired for worker %s. Re-claiming it.",
+                        task.pk, task.key, task.worker,
+                    )
+                if task.claim_count >= self._get_max_claims(task):
+                    self._abandon_task(task)
+                    return task, True
+                task.status = MigrationTask.Status.RUNNING
+                task.worker = worker
+                task.claim_count += 1
+                task.started_at = task.started_at or now
+                task.heartbeat_at = now
+                task.lease_expires_at = now + timedelta(seconds=lease_seconds)
+                task.save()
+        return task, False
+
+    def _get_max_claims(self, task):
+        migration = store.by_key.get(task.key)
+        params = migration.get_backend_params() if migration else {}
+        return params.get(
+            "max_claims", getattr(settings, "MASSMIGRATION_MAX_TASK_CLAIMS", DEFAULT_MAX_CLAIMS)
+        )
+
+    def _abandon_task(self, task):
+        """ Mark the task as done without processing it, and its migration as errored. """
+        logger.error(
+            "Task %s for migration %s has been claimed %s times without finishing. Abandoning it.",
+            task.pk, task.key, task.claim_count,
+        )
+        task.status = MigrationTask.Status.DONE
+        task.worker = ""
+        task.lease_expires_at = None
+        task.finished_at = timezone.now()
+        task.save()
+        migration = store.by_key.get(task.key)
+        record = MigrationRecord.objects.using(task._state.db).filter(key=task.key).first()
+        if record and not record._in_progress():
+            # E.g. its worker finished the migration, but died before marking the task as done
+            logger.warning("Migration %s has already been applied. Not marking it as errored.", task.key)
+            return
+        if migration:
+            error = TaskClaimLimitExceeded(
+                f"Task {task.pk} was claimed {task.claim_count} times without finishing. "
+                "See the workers' logs for the errors which stopped it."
+            )
+            migration.mark_as_errored(task._state.db, error, task.attempt_uuid)
+
+    def process_task(self, task, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """ Perform the work of a task which has been claimed by `claim_task`. If the worker goes
+            over `settings.MASSMIGRATION_MEMORY_LIMIT_MB`, the task is released for another worker
+            to continue from where it got to. If the migration is paused (or the replica which it
+            reads from is lagging), the task is released to be claimed again after a delay.
+        """
+        if task_must_wait(task):
+            self._release_waiting_task(task)
+            return
+        with self._keep_lease(task, lease_seconds):
+            finished = run_task(task, lambda task: self._on_progress(task, lease_seconds))
+        if finished:
+            complete_task(task)
+
+    @contextmanager
+    def _keep_lease(self, task, lease_seconds):
+        """ Extend the task's lease from a background thread for as long as the block runs, so that
+            a long operation (e.g. that of a simple migration, or a slow chunk of a mapper) doesn't
+            let the lease expire and another worker process the same objects. Only the lease is
+            updated; the task's progress is still saved by `_heartbeat` between chunks.
+        """
+        stopped = threading.Event()
+
+        def extend_lease():
+            try:
+                while not stopped.wait(max(lease_seconds / 3, 1)):
+                    now = timezone.now()
+                    if not MigrationTask.objects.using(task._state.db).filter(
+                        pk=task.pk, worker=task.worker, status=MigrationTask.Status.RUNNING
+                    ).update(heartbeat_at=now, lease_expires_at=now + timedelta(seconds=lease_seconds)):
+                        return
+            except DatabaseError:
+                logger.exception("Failed to extend the lease of task %s for migration %s.", task.pk, task.key)
+            finally:
+                # Each thread has its own DB connection
+                connections[task._state.db].close()
+
+        thread = threading.Thread(target=extend_lease, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def _on_progress(self, task, lease_seconds):
+        if not self._heartbeat(task, lease_seconds):
+            logger.warning(
+                "Worker %s lost the lease on task %s for migration %s. Stopping.",
+                task.worker, task.pk, task.key,
+            )
+            return False
+        if memory_limit_exceeded():
+            logger.warning(
+                "Worker %s reached its memory limit while processing task %s for migration %s. "
+                "Releasing the task.",
+                task.worker, task.pk, task.key,
+            )
+            self._release_task(task)
+            return False
+        if task_must_wait(task):
+            self._release_waiting_task(task)
+            return False
+        return True
+
+    def _heartbeat(self, task, lease_seconds):
+        """ Save the task's progress and extend its lease. Returns False if the task is no longer
+            leased to this worker, e.g. because its lease expired and another worker took it.
+        """
+        now = timezone.now()
+        return bool(
+            MigrationTask.objects.using(task._state.db).filter(
+                pk=task.pk, worker=task.worker, status=MigrationTask.Status.RUNNING
+            ).update(
+                cursor=task.cursor,
+                objects_processed=task.objects_processed,
+                seconds_per_object=task.seconds_per_object,
+                operation_retries=task.operation_retries,
+                peak_memory=task.peak_memory,
+                partial_result=task.partial_result,
+                heartbeat_at=now,
+                lease_expires_at=now + timedelta(seconds=lease_seconds),
+            )
+        )
+
+    def _release_task(self, task, delay_seconds=None):
+        """ Put the task back in the queue, to be continued from its cursor by whichever worker
+            claims it next, optionally not until after the given delay. The claim doesn't count
+            towards the task's `max_claims`, as it wasn't cut short by an error.
+        """
+        available_at = None
+        if delay_seconds:
+            available_at = timezone.now() + timedelta(seconds=delay_seconds)
+        MigrationTask.objects.using(task._state.db).filter(
+            pk=task.pk, worker=task.worker, status=MigrationTask.Status.RUNNING
+        ).update(
+            status=MigrationTask.Status.PENDING,
+            worker="",
+            claim_count=F("claim_count") - 1,
+            lease_expires_at=None,
+            available_at=available_at,
+        )
+
+    def _release_waiting_task(self, task):
+        logger.info("Releasing task %s for migration %s until later.", task.pk, task.key)
+        self._release_task(task, get_paused_task_delay())
+
+    def _queue_range_tasks(self, migration, db_alias):
+        """ Mark the migration as started and queue a task for each key range of its queryset. """
+        key_ranges = self.get_key_ranges(migration, db_alias)
+        with get_transaction(db_alias).atomic(using=db_alias):
+            attempt_uuid = migration.mark_as_started(db_alias)
+            create_tasks(migration, db_alias, attempt_uuid, key_ranges)
+        logger.info("Queued %s tasks to run migration %s", len(key_ranges), migration.key)
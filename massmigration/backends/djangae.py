@@ -1,5 +1,7 @@
 # Standard library
 import logging
+import pickle
+import time
 import warnings
 
 # Third party
@@ -7,12 +9,12 @@ from djangae.processing import (
     datastore_key_ranges,
     firestore_name_key_ranges,
     firestore_scattered_int_key_ranges,
-    sequential_int_key_ranges,
     uuid_key_ranges,
 )
-from djangae.tasks.deferred import defer, defer_iteration_with_finalize
+from djangae.tasks.deferred import defer
 from django.conf import settings
 from django.db import models, router
+from django.utils import timezone
 try:
     from gcloudc.db.models.fields.firestore import AutoCharField
 except ImportError:
@@ -20,20 +22,52 @@ except ImportError:
     AutoCharField = type("AutoCharField", (), {})
 
 # Massmigration
+from massmigration.loader import store
+from massmigration.models import MigrationTask
+from massmigration.tasks import (
+    complete_task,
+    create_tasks,
+    get_paused_task_delay,
+    get_shard_count,
+    run_task,
+    task_must_wait,
+)
+from massmigration.utils.key_ranges import get_key_ranges
+from massmigration.utils.memory import memory_limit_exceeded
 from massmigration.utils.transaction import get_transaction
 from .base import BackendBase
 
 logger = logging.getLogger(__name__)
 
+# The deadline of Cloud Tasks HTTP targets on App Engine
+DEFAULT_TASK_DEADLINE = 60 * 10
+# The fraction of the deadline for which each deferred task processes its key range before
+# continuing in a new task
+DEFAULT_TASK_TIME_BUDGET = 0.8
+
 
 class DjangaeBackend(BackendBase):
     """ Backend for running operations on Google Cloud Tasks in Djangae projects.
         Works with SQL, Cloud Datastore and Firestore.
 
         Optional `backend_params`:
-        - `defer_kwargs` - these get passed through to `defer` for simple migrations.
-        - `defer_iteration_with_finalize_kwargs` - these get passed through to
-            `defer_iteration_with_finalize` for mapper migrations.
+        - `defer_kwargs` - these get passed through to `defer` for every task.
+        - `shard_count` - the number of key ranges to split a migration's queryset into.
+        - `chunk_size` - the number of objects to fetch per query when processing a mapper task.
+        - `target_chunk_seconds` - enables adaptive chunk sizing for mapper migrations, where
+            the number of objects fetched per query is chosen so that each chunk takes roughly
+            this long, and each deferred task processes roughly one chunk.
+        - `min_chunk_size`/`max_chunk_size` - the limits for adaptive chunk sizing.
+        - `split_after_seconds` - enables splitting of long-running tasks, where each time a
+            deferred task has been running for this long, the upper half of its remaining range is
+            handed to a new task. This must be less than the time limit of each deferred task.
+        - `min_split_size` - the smallest number of remaining objects which will be split.
+        - `task_deadline_seconds` - the request deadline of the task queue. Overrides
+            `settings.MASSMIGRATION_TASK_DEADLINE`.
+        - `task_time_budget` - the fraction of the deadline for which each deferred task runs
+            before continuing in a new task. Overrides `settings.MASSMIGRATION_TASK_TIME_BUDGET`.
+        - `defer_iteration_with_finalize_kwargs` - deprecated; only the `key_ranges_getter`,
+            `_shards` and `_queue` items of this are used.
     """
 
     def run_simple(self, migration, db_alias):
@@ -42,14 +76,30 @@ class DjangaeBackend(BackendBase):
             "_using": db_alias,
             **migration.get_backend_params().get("defer_kwargs", {}),
         }
-        defer(migration.wrapped_operation, db_alias, **defer_kwargs)
+        # The migration is looked up by its key in the task, rather than being pickled into it
+        self._defer(self._run_simple, migration.key, db_alias, **defer_kwargs)
         logger.info("Deferred task to run single-task migration %s", migration.key)
 
     def run_mapper(self, migration, db_alias):
-        # Use `defer_iteration_with_finalize` to do the processing with whichever key_ranges_getter
-        # is appropriate for the DB.
-        queryset = migration.get_queryset(db_alias)
+        self._defer_range_tasks(migration, db_alias)
+
+    def run_update(self, migration, db_alias):
+        self._defer_range_tasks(migration, db_alias)
+
+    def run_delete(self, migration, db_alias):
+        self._defer_range_tasks(migration, db_alias)
+
+    def run_copy(self, migration, db_alias):
+        self._defer_range_tasks(migration, db_alias)
+
+    def get_key_ranges(self, migration, db_alias):
+        # The queryset is split using whichever key_ranges_getter is appropriate for the DB
+        queryset = migration.get_task_queryset(db_alias)
+        if not queryset.exists():
+            # Even an empty queryset needs a task, so that the migration gets marked as finished
+            return [(None, None)]
         key_ranges_getter = self._key_ranges_getter(queryset)
+        shard_count = get_shard_count(migration)
         params = migration.get_backend_params()
         # Legacy backwards compatibility
         if "key_ranges_getter" in params:
@@ -59,25 +109,126 @@ class DjangaeBackend(BackendBase):
                 "instead."
             )
             key_ranges_getter = params["key_ranges_getter"]
+        if "defer_iteration_with_finalize_kwargs" in params:
+            warnings.warn(
+                "Mapper migrations are no longer run with `defer_iteration_with_finalize`. Only the "
+                "'key_ranges_getter', '_shards' and '_queue' items of "
+                "backend_params['defer_iteration_with_finalize_kwargs'] are still used."
+            )
+            legacy_kwargs = params["defer_iteration_with_finalize_kwargs"]
+            key_ranges_getter = legacy_kwargs.get("key_ranges_getter", key_ranges_getter)
+            shard_count = legacy_kwargs.get("_shards", shard_count)
         # End backwards compatibility
-        defer_iteration_with_finalize_kwargs = {
-            "key_ranges_getter": key_ranges_getter,
-            "migration": migration,
-            "db_alias": db_alias,
-            "_queue": self._get_queue_name(migration),
-            "_transactional": True,
-            **params.get("defer_iteration_with_finalize_kwargs", {}),
-        }
+        return key_ranges_getter(queryset, shard_count) or [(None, None)]
+
+    def _defer_range_tasks(self, migration, db_alias):
+        # Each key range is tracked as a MigrationTask, and processed by its own deferred task
+        key_ranges = self.get_key_ranges(migration, db_alias)
         with get_transaction(db_alias).atomic(using=db_alias):
             attempt_uuid = migration.mark_as_started(db_alias)
-            defer_iteration_with_finalize(
-                queryset,
-                self._call_mapper_wrapped_operation,
-                self._mark_mapper_as_finished,
-                attempt_uuid=attempt_uuid,
-                **defer_iteration_with_finalize_kwargs,
-            )
-            logger.info("Deferred task to run mapper migration %s", migration.key)
+            for task in create_tasks(migration, db_alias, attempt_uuid, key_ranges):
+                self._defer_task(migration, task.pk, db_alias, _transactional=True)
+        logger.info("Deferred %s tasks to run migration %s", len(key_ranges), migration.key)
+
+    def _defer_task(self, migration, task_pk, db_alias, **kwargs):
+        defer_kwargs = {
+            "_queue": self._get_queue_name(migration),
+            "_using": db_alias,
+            **kwargs,
+            **self._get_legacy_queue_kwargs(migration),
+            **migration.get_backend_params().get("defer_kwargs", {}),
+        }
+        self._defer(self._process_task, task_pk, db_alias, **defer_kwargs)
+
+    def _defer(self, function, *args, **defer_kwargs):
+        """ Defer the given function, logging the size of the task's pickled payload. The payload
+            should only ever contain keys (not migration instances), so it should stay small.
+        """
+        payload_size = len(pickle.dumps((function, args)))
+        logger.debug("Deferring %s with a payload of %s bytes.", function.__name__, payload_size)
+        defer(function, *args, **defer_kwargs)
+
+    def _get_legacy_queue_kwargs(self, migration):
+        legacy_kwargs = migration.get_backend_params().get("defer_iteration_with_finalize_kwargs", {})
+        return {"_queue": legacy_kwargs["_queue"]} if "_queue" in legacy_kwargs else {}
+
+    def _run_simple(self, key, db_alias):
+        migration = store.by_key.get(key)
+        if not migration:
+            logger.error("Migration %s not found. Abandoning task.", key)
+            return
+        migration.wrapped_operation(db_alias)
+
+    def _process_task(self, task_pk, db_alias):
+        task = MigrationTask.objects.using(db_alias).filter(pk=task_pk).first()
+        if not task or task.status == MigrationTask.Status.DONE:
+            # The task has been deleted or was already completed by a previous run of this task
+            return
+        migration = store.by_key.get(task.key)
+        if migration and task_must_wait(task):
+            self._defer_waiting_task(migration, task)
+            return
+        task.status = MigrationTask.Status.RUNNING
+        task.claim_count += 1
+        task.heartbeat_at = timezone.now()
+        task.started_at = task.started_at or task.heartbeat_at
+        task.save()
+        # Once the time limit or the memory limit is reached, the rest of the key range is continued
+        # in a new task. A chunk which is still running when the time budget runs out is stopped
+        # after its current object, so that the task finishes well within the queue's deadline.
+        # If this deferred task dies part way through, then when it's retried it will continue
+        # from the last completed chunk.
+        started = time.monotonic()
+        params = migration.get_backend_params() if migration else {}
+        time_budget = self._get_time_budget(params)
+        # The time limit can't exceed the time budget, so that a task which reaches it is continued
+        time_limit = min(params.get("target_chunk_seconds") or time_budget, time_budget)
+
+        def on_progress(task):
+            self._save_task_progress(task)
+            if task_must_wait(task):
+                self._defer_waiting_task(migration, task)
+                return False
+            if time.monotonic() - started < time_limit and not memory_limit_exceeded():
+                return True
+            self._defer_task(migration, task.pk, db_alias)
+            logger.info("Deferred continuation of task %s for migration %s", task.pk, task.key)
+            return False
+
+        def defer_new_task(new_task):
+            # Tasks split off from this one, or created to verify the migration
+            self._defer_task(migration, new_task.pk, db_alias, _transactional=True)
+
+        def defer_new_tasks(new_tasks):
+            for new_task in new_tasks:
+                defer_new_task(new_task)
+
+        if run_task(task, on_progress, defer_new_task, deadline=started + time_budget):
+            complete_task(task, defer_new_tasks)
+
+    def _get_time_budget(self, params):
+        """ The number of seconds for which each deferred task may run, given the migration's
+            backend params.
+        """
+        deadline = params.get(
+            "task_deadline_seconds", getattr(settings, "MASSMIGRATION_TASK_DEADLINE", DEFAULT_TASK_DEADLINE)
+        )
+        budget = params.get(
+            "task_time_budget", getattr(settings, "MASSMIGRATION_TASK_TIME_BUDGET", DEFAULT_TASK_TIME_BUDGET)
+        )
+        return deadline * budget
+
+    def _defer_waiting_task(self, migration, task):
+        # Rather than spinning, check again after a delay
+        self._defer_task(migration, task.pk, task._state.db, _countdown=get_paused_task_delay())
+        logger.info("Deferred task %s for migration %s until later.", task.pk, task.key)
+
+    def _save_task_progress(self, task):
+        task.heartbeat_at = timezone.now()
+        task.save(update_fields=[
+            "cursor", "objects_processed", "seconds_per_object", "operation_retries", "peak_memory",
+            "partial_result", "heartbeat_at",
+        ])
 
     def _get_queue_name(self, migration):
         """ Get the queue name from settings, or the override on the migration, if set."""
@@ -88,6 +239,9 @@ class DjangaeBackend(BackendBase):
             raise NotImplementedError("Please configure settings.MASSMIGRATION_TASK_QUEUE.")
         return queue
 
+    # These two methods are no longer used, but are kept so that tasks which were deferred by
+    # `defer_iteration_with_finalize` before upgrading can still run.
+
     def _call_mapper_wrapped_operation(self, instance, migration, attempt_uuid, db_alias):
         migration.wrapped_operation(instance, attempt_uuid, db_alias)
 
@@ -111,7 +265,9 @@ class DjangaeBackend(BackendBase):
                 return firestore_scattered_int_key_ranges
         else:  # SQL
             if isinstance(pk_field, models.IntegerField):
-                return sequential_int_key_ranges
+                # Djangae's `sequential_int_key_ranges` can return overlapping ranges, which would
+                # process some objects twice
+                return get_key_ranges
         # There's also `firestore_scattered_int_key_ranges` which we might want to use in some cases
         raise NotImplementedError(
             f"Key ranges getter function for PKs of type {type(pk_field)} on DB engine '{engine}' "
@@ -4,15 +4,24 @@ migrations have been applied.
 """
 
 # Standard library
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
 from functools import wraps
 import logging
+import time
 
 # Third party
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete
 from django.http import HttpResponse
 
 # Djangae Migrations
 from .exceptions import DbAliasNotAllowed, RequiredMigrationNotApplied
 from .loader import store
+from .migrations import get_all_db_aliases
 from .models import MigrationRecord
 from .utils.test import in_tests
 
@@ -20,6 +29,29 @@ logger = logging.getLogger(__name__)
 
 APPLIED_MIGRATIONS_CACHE = {}
 
+# A version number in the shared cache which is changed whenever a migration is applied or has its
+# record deleted, so that every process knows to clear its APPLIED_MIGRATIONS_CACHE
+APPLIED_VERSION_CACHE_KEY = "massmigration:applied_version"
+# A (version, [(key, db_alias), ...]) snapshot of all applied migrations in the shared cache, for
+# `warm_applied_migrations`
+APPLIED_SNAPSHOT_CACHE_KEY = "massmigration:applied_snapshot"
+# How often (in seconds) each process checks the version
+VERSION_CHECK_INTERVAL = 5
+
+# The version which this process's APPLIED_MIGRATIONS_CACHE is up to date with, and when it last
+# checked the version
+_applied_version = None
+_version_checked_at = None
+
+# The (migration identifier, db_aliases) required by every `requires_migration(s)` decorator, so
+# that they can all be checked at once. The identifiers are resolved to keys when they're checked,
+# as the migrations may not have been loaded when the decorators are applied.
+REQUIRED_MIGRATIONS = set()
+
+# The {(key, db_alias): is_applied} results of the checks made during the current request, if
+# inside `request_scope`
+_request_results = ContextVar("massmigration_request_results", default=None)
+
 
 def get_migration_key(migration_id_str_or_tuple):
     """
@@ -52,68 +84,212 @@ def migration_is_applied(migration_identifier, db_alias):
     """ Tells you whether or not the specified migration has been applied to the DB.
         Positive (True) responses are cached to avoid repeated DB queries.
     """
-    migration_key = get_migration_key(migration_identifier)
-    cache_key = (get_migration_key(migration_identifier), db_alias)
+    return migrations_are_applied([(migration_identifier, db_alias)])
+
+
+def migrations_are_applied(identifiers_and_db_aliases):
+    """ Tells you whether all of the given (migration identifier, db_alias) pairs are applied, with
+        at most one DB query per DB alias. Positive responses are cached for the life of the
+        process. Inside `request_scope`, negative responses are remembered for the rest of the
+        request, and any other migrations required by `requires_migration(s)` decorators on the
+        same DBs are checked in the same queries.
+    """
+    pairs = {(get_migration_key(identifier), db_alias) for identifier, db_alias in identifiers_and_db_aliases}
+    _check_applied_version()
+    request_results = _request_results.get()
+    results = {pair: _get_known_result(pair, request_results) for pair in pairs}
+    unknown = {pair for pair, result in results.items() if result is None}
+    if unknown and request_results is not None:
+        db_aliases = {db_alias for _, db_alias in unknown}
+        unknown |= {
+            pair for pair in _get_required_pairs()
+            if pair[1] in db_aliases and _get_known_result(pair, request_results) is None
+        }
+    keys_by_db_alias = defaultdict(set)
+    for key, db_alias in unknown:
+        keys_by_db_alias[db_alias].add(key)
+    for db_alias, keys in keys_by_db_alias.items():
+        applied_keys = set(
+            MigrationRecord.objects.using(db_alias).filter(
+                key__in=keys, is_applied=True
+            ).values_list("key", flat=True)
+        )
+        for key in keys:
+            results[(key, db_alias)] = key in applied_keys
+            if key in applied_keys:
+                APPLIED_MIGRATIONS_CACHE[(key, db_alias)] = True
+            if request_results is not None:
+                request_results[(key, db_alias)] = key in applied_keys
+    return all(results[pair] for pair in pairs)
+
+
+def _get_known_result(pair, request_results):
+    """ Return whether the (key, db_alias) pair is already known to be applied, or None if it isn't
+        known, without querying the DB.
+    """
+    if pair in APPLIED_MIGRATIONS_CACHE:
+        return True
+    if request_results is not None:
+        return request_results.get(pair)
+    return None
+
+
+def bump_applied_version():
+    """ Make every process clear its cache of applied migrations. This is called once a migration
+        has been marked as applied, or has had its record deleted, and that has been committed.
+    """
+    try:
+        cache.incr(APPLIED_VERSION_CACHE_KEY)
+    except ValueError:
+        # The key doesn't exist yet (or has been evicted), so start from a value which is
+        # different to anything a process could have seen before
+        cache.set(APPLIED_VERSION_CACHE_KEY, time.time_ns(), None)
+
+
+def warm_applied_migrations():
+    """ Fill this process's cache of applied migrations, either from an up to date snapshot in the
+        shared cache, or with one query per DB (in which case the snapshot is stored for other
+        processes). This can be called on startup via `settings.MASSMIGRATION_WARM_APPLIED_MIGRATIONS`.
+    """
+    global _applied_version, _version_checked_at
+    version = cache.get(APPLIED_VERSION_CACHE_KEY)
+    snapshot = cache.get(APPLIED_SNAPSHOT_CACHE_KEY)
+    if snapshot and snapshot[0] == version:
+        pairs = snapshot[1]
+    else:
+        pairs = [
+            (key, db_alias)
+            for db_alias in get_all_db_aliases()
+            for key in MigrationRecord.objects.using(db_alias).filter(
+                is_applied=True
+            ).values_list("key", flat=True)
+        ]
+        cache.set(APPLIED_SNAPSHOT_CACHE_KEY, (version, pairs), None)
+    APPLIED_MIGRATIONS_CACHE.clear()
+    APPLIED_MIGRATIONS_CACHE.update({pair: True for pair in pairs})
+    _applied_version = version
+    _version_checked_at = time.monotonic()
+    logger.info("Loaded %s applied migrations.", len(pairs))
+
+
+def _check_applied_version():
+    """ Clear this process's cache of applied migrations if any migration has been applied or had
+        its record deleted since it was filled. Checks at most every VERSION_CHECK_INTERVAL seconds.
+    """
+    global _applied_version, _version_checked_at
+    now = time.monotonic()
+    if _version_checked_at is not None and now - _version_checked_at < VERSION_CHECK_INTERVAL:
+        return
+    _version_checked_at = now
+    version = cache.get(APPLIED_VERSION_CACHE_KEY)
+    if version == _applied_version:
+        return
+    if getattr(settings, "MASSMIGRATION_WARM_APPLIED_MIGRATIONS", False):
+        warm_applied_migrations()
+    else:
+        APPLIED_MIGRATIONS_CACHE.clear()
+        _applied_version = version
+
+
+def record_post_delete(sender, **kwargs):
+    # Other processes mustn't reload the applied migrations before the deletion is committed
+    transaction.on_commit(bump_applied_version, using=kwargs["using"])
+
+
+post_delete.connect(record_post_delete, sender=MigrationRecord)
+
+
+@contextmanager
+def request_scope():
+    """ Context manager which remembers the results of migration checks until it exits, so that
+        each unapplied migration is only queried once. See `EnforcementMiddleware`.
+    """
+    token = _request_results.set({})
     try:
-        return APPLIED_MIGRATIONS_CACHE[cache_key]
-    except KeyError:
-        applied = MigrationRecord.objects.using(db_alias).filter(key=migration_key, is_applied=True).exists()
-        if applied:
-            APPLIED_MIGRATIONS_CACHE[cache_key] = True
-            return True
-    return False
+        yield
+    finally:
+        _request_results.reset(token)
+
+
+def _get_required_pairs():
+    """ Get the (key, db_alias) pairs required by all of the `requires_migration(s)` decorators. """
+    pairs = set()
+    for identifier, db_aliases in REQUIRED_MIGRATIONS:
+        try:
+            migration = store.by_key[get_migration_key(identifier)]
+        except ValueError:
+            # This will be raised when the decorated function is called
+            continue
+        db_aliases = db_aliases or migration.get_allowed_db_aliases()
+        pairs |= {(migration.key, db_alias) for db_alias in db_aliases}
+    return pairs
 
 
 def requires_migration(migration_identifier, db_aliases=[], is_view=False, skip_in_tests=True):
     """ Function decorator which prevents the function being run if the specified migration is not
         applied.
     """
+    return requires_migrations(
+        [migration_identifier], db_aliases=db_aliases, is_view=is_view, skip_in_tests=skip_in_tests
+    )
+
+
+def requires_migrations(migration_identifiers, db_aliases=[], is_view=False, skip_in_tests=True):
+    """ Function decorator which prevents the function being run unless all of the specified
+        migrations are applied. They're checked with at most one query per DB.
+    """
+    for migration_identifier in migration_identifiers:
+        identifier = tuple(migration_identifier) if isinstance(migration_identifier, list) else migration_identifier
+        REQUIRED_MIGRATIONS.add((identifier, tuple(db_aliases)))
 
     def decorator(function):
         @wraps(function)
         def replacement(*args, **kwargs):
-            def enforce_migration():
-                key = get_migration_key(migration_identifier)
-
-                migration = store.by_key[key]
-
-                allowed_db_aliases = migration.get_allowed_db_aliases()
-
-                # By default if db_alias is not specified, we assume the migration needs to be applied on all the allowed_db_aliases
-                # specified in the migration
-                if not db_aliases:
-                    required_migrations_db_aliases = allowed_db_aliases
-                else:
-                    if any([db_alias not in allowed_db_aliases for db_alias in db_aliases]):
-                        raise DbAliasNotAllowed(
-                            f"requires_migration decorator improperly configured. "
-                            f"It requires the migration <{migration_identifier}> to have run on <{', '.join(db_aliases)}> "
-                            f"while the allowed databases are <{', '.join(allowed_db_aliases)}>."
-                        )
+            def enforce_migrations():
+                required = []
+                for migration_identifier in migration_identifiers:
+                    key = get_migration_key(migration_identifier)
+
+                    migration = store.by_key[key]
+
+                    allowed_db_aliases = migration.get_allowed_db_aliases()
+
+                    # By default if db_alias is not specified, we assume the migration needs to be applied on all the allowed_db_aliases
+                    # specified in the migration
+                    if not db_aliases:
+                        required_migrations_db_aliases = allowed_db_aliases
                     else:
-                        required_migrations_db_aliases = db_aliases
+                        if any([db_alias not in allowed_db_aliases for db_alias in db_aliases]):
+                            raise DbAliasNotAllowed(
+                                f"requires_migration decorator improperly configured. "
+                                f"It requires the migration <{migration_identifier}> to have run on <{', '.join(db_aliases)}> "
+                                f"while the allowed databases are <{', '.join(allowed_db_aliases)}>."
+                            )
+                        else:
+                            required_migrations_db_aliases = db_aliases
+                    required.extend((key, db_alias) for db_alias in required_migrations_db_aliases)
 
                 if not (skip_in_tests and in_tests()):
-                    if not all([migration_is_applied(migration_identifier, db_alias) for db_alias in required_migrations_db_aliases]):
+                    if not migrations_are_applied(required):
                         raise RequiredMigrationNotApplied(
-                            f"Migration '{function}'' requires migration {migration_identifier} which has "
-                            "not been applied."
+                            f"Migration '{function}'' requires migrations {migration_identifiers}, not all of "
+                            "which have been applied."
                         )
 
             if is_view:
                 try:
-                    enforce_migration()
+                    enforce_migrations()
                 except RequiredMigrationNotApplied:
                     logger.error(
-                        "View function '%s' requires migration '%s' which has not yet been applied.",
-                        function, migration_identifier
+                        "View function '%s' requires migrations %s, not all of which have been applied.",
+                        function, migration_identifiers
                     )
                     return HttpResponse(
                         "This resource requires data changes which have not yet been made.",
                         status=503,
                     )
             else:
-                enforce_migration()
+                enforce_migrations()
 
             return function(*args, **kwargs)
         return replacement
@@ -124,4 +300,26 @@ def view_requires_migration(migration_identifier, db_aliases=[], skip_in_tests=T
     """ Same as `requires_migration`, but for view functions. Returns a 503 status HttpResponse
         rather than raising an exception.
     """
-    return requires_migration(migration_identifier, is_view=True, db_aliases=db_aliases, skip_in_tests=skip_in_tests)
\ No newline at end of file
+    return requires_migration(migration_identifier, is_view=True, db_aliases=db_aliases, skip_in_tests=skip_in_tests)
+
+
+def view_requires_migrations(migration_identifiers, db_aliases=[], skip_in_tests=True):
+    """ Same as `requires_migrations`, but for view functions. Returns a 503 status HttpResponse
+        rather than raising an exception.
+    """
+    return requires_migrations(migration_identifiers, is_view=True, db_aliases=db_aliases, skip_in_tests=skip_in_tests)
+
+
+class EnforcementMiddleware:
+    """ Middleware which remembers the results of migration checks for the duration of each
+        request. The first time that a request checks for an unapplied migration, all of the
+        migrations required by `requires_migration(s)` decorators are checked, with one query per
+        DB, so that any further checks in the same request don't need to query the DB.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with request_scope():
+            return self.get_response(request)
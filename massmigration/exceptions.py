@@ -9,6 +9,11 @@ class MigrationAlreadyStarted(MigrationError):
     pass
 
 
+class MigrationNotRunning(MigrationError):
+    """ Error for when trying to pause or resume a migration which isn't in progress. """
+    pass
+
+
 class DependentMigrationNotApplied(MigrationError):
     """ Error for when trying to apply a migration which depends on another migration, and that
         other migration has not yet been applied.
@@ -16,6 +21,18 @@ class DependentMigrationNotApplied(MigrationError):
     pass
 
 
+class VerificationFailed(MigrationError):
+    """ Error for when objects still need migrating after a mapper migration's verification pass. """
+    pass
+
+
+class TaskClaimLimitExceeded(MigrationError):
+    """ Error for when a task has been claimed by workers too many times without being finished,
+        e.g. because processing it keeps raising an exception.
+    """
+    pass
+
+
 class RequiredMigrationNotApplied(Exception):
     """ Error for when a block of code which is marked as requiring a particular migration is being
         tried to run when that migration is not yet applied.
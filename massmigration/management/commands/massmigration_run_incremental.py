@@ -0,0 +1,51 @@
+# Third party
+from django.core.management.base import BaseCommand, CommandError
+
+# Mass Migration
+from massmigration.api import run_incremental_migration
+from massmigration.exceptions import DependentMigrationNotApplied, MigrationAlreadyStarted
+from massmigration.loader import store
+from massmigration.migrations import IncrementalMapperMigration, get_all_db_aliases
+
+
+class Command(BaseCommand):
+    """ Re-runs any incremental migrations which have new objects to process. This is designed to be
+        run on a schedule, e.g. from cron.
+    """
+
+    help = "Launch any incremental mass-migrations which have objects that they haven't processed yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--database",
+            action="append",
+            dest="databases",
+            help=(
+                "Alias of a database to run the migrations on. Can be given multiple times. "
+                "Defaults to all databases."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        db_aliases = options["databases"] or get_all_db_aliases()
+        unknown = set(db_aliases) - set(get_all_db_aliases())
+        if unknown:
+            raise CommandError(f"Unknown database(s): {', '.join(sorted(unknown))}.")
+
+        for migration in store.all:
+            if not isinstance(migration, IncrementalMapperMigration):
+                continue
+            for db_alias in db_aliases:
+                if db_alias not in migration.get_allowed_db_aliases():
+                    continue
+                try:
+                    launched = run_incremental_migration(migration, db_alias)
+                except DependentMigrationNotApplied as error:
+                    self.stderr.write(str(error))
+                    continue
+                except MigrationAlreadyStarted:
+                    # Another process launched it between our check and the launch
+                    self.stdout.write(f"Migration {migration.key} is already running on {db_alias}.")
+                    continue
+                if launched:
+                    self.stdout.write(f"Launched migration {migration.key} on {db_alias}.")
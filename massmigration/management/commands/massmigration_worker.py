@@ -0,0 +1,86 @@
+# Standard library
+import logging
+import os
+import socket
+import time
+
+# Third party
+from django.core.management.base import BaseCommand, CommandError
+
+# Mass Migration
+from massmigration.backends.database import DEFAULT_LEASE_SECONDS, DatabaseBackend
+from massmigration.migrations import get_all_db_aliases
+from massmigration.utils.memory import memory_limit_exceeded
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """ Processes the MigrationTasks queued by the DatabaseBackend. Any number of these can be run
+        concurrently, on any number of machines.
+    """
+
+    help = "Run a worker which processes mass-migration tasks queued by the DatabaseBackend."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--database",
+            action="append",
+            dest="databases",
+            help=(
+                "Alias of a database to take tasks from. Can be given multiple times. "
+                "Defaults to all databases."
+            ),
+        )
+        parser.add_argument(
+            "--lease-seconds",
+            type=int,
+            default=DEFAULT_LEASE_SECONDS,
+            help=(
+                "How long a claimed task is reserved for this worker without a heartbeat before "
+                "other workers can re-claim it."
+            ),
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=5,
+            help="Number of seconds to wait before checking again when there are no tasks.",
+        )
+        parser.add_argument(
+            "--burst",
+            action="store_true",
+            help="Exit when there are no more tasks, rather than waiting for more.",
+        )
+
+    def handle(self, *args, **options):
+        db_aliases = options["databases"] or get_all_db_aliases()
+        unknown = set(db_aliases) - set(get_all_db_aliases())
+        if unknown:
+            raise CommandError(f"Unknown database(s): {', '.join(sorted(unknown))}.")
+
+        backend = DatabaseBackend()
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.stdout.write(f"Worker {worker} processing tasks from: {', '.join(db_aliases)}")
+        while True:
+            for db_alias in db_aliases:
+                task = backend.claim_task(db_alias, worker, options["lease_seconds"])
+                if task:
+                    self.stdout.write(f"Processing task {task.pk} for migration {task.key}")
+                    try:
+                        backend.process_task(task, options["lease_seconds"])
+                    except Exception:
+                        # The task will be re-claimed once its lease expires
+                        logger.exception("Error processing task %s for migration %s.", task.pk, task.key)
+                    if memory_limit_exceeded():
+                        # Python rarely gives memory back, so the only way to free it is to restart
+                        self.stdout.write(
+                            "Memory limit reached. Exiting so that the worker can be restarted."
+                        )
+                        return
+                    break
+            else:
+                if options["burst"]:
+                    self.stdout.write("No more tasks.")
+                    return
+                time.sleep(options["poll_interval"])
@@ -1,11 +1,18 @@
 # Standard library
-from uuid import UUID
+from decimal import Decimal
+from uuid import UUID, uuid4
+import datetime
 import logging
+import random
+import time
 
 # Third party
 from djangae.utils import retry_on_error
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Max
+from django.db.models.deletion import Collector
+from django.utils import timezone
 from django.utils.module_loading import import_string
 
 # Mass Migration
@@ -15,14 +22,34 @@ from .exceptions import (
     CannotRunOnDB,
     DbAliasNotAllowed,
     DependentMigrationNotApplied,
-    MigrationAlreadyStarted
+    MigrationAlreadyStarted,
+    MigrationNotRunning,
 )
-from .models import MigrationRecord
+from .models import (
+    MigrationAttempt,
+    MigrationErrorSample,
+    MigrationRecord,
+    MigrationSnapshot,
+    MigrationTask,
+)
+from .snapshots import restore_snapshot
+from .utils.key_ranges import filter_key_range
+from .utils.lru import LRUDict
 from .utils.transaction import get_transaction
 
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_ERROR_SAMPLES_PER_ATTEMPT = 20
+
+# The number of attempts which each of the per-process records below remembers. Forgetting an
+# attempt only means that its next error does one more (harmless) query.
+REMEMBERED_ATTEMPTS = 100
+
+# The (key, db_alias, attempt_uuid) of attempts which this process knows to be marked as errored
+ERRORED_ATTEMPTS = LRUDict(REMEMBERED_ATTEMPTS)
+# The error types which this process has stored samples of, by (key, db_alias, attempt_uuid)
+SAMPLED_ERRORS = LRUDict(REMEMBERED_ATTEMPTS)
 
 # TODO: Is there a better place for this?
 def get_all_db_aliases():
@@ -98,6 +125,20 @@ class BaseMigration:
         # Handle `backend_params` being a dict, None or missing entirely
         return getattr(self, "backend_params", {}) or {}
 
+    def get_read_db_alias(self, db_alias):
+        """ The DB which the migration's queryset is read from (and split into key ranges on) when
+            it's run on the given DB.
+        """
+        return db_alias
+
+    def get_task_queryset(self, db_alias, read_db_alias=None):
+        """ The queryset which the migration's tasks process (and which is split into their key
+            ranges) when it's run on the given DB, read from `read_db_alias`, which defaults to
+            `get_read_db_alias(db_alias)`. This is fetched once per task, so any state of the
+            migration which the queryset depends on is read fresh from `db_alias`.
+        """
+        return self.get_queryset(read_db_alias or self.get_read_db_alias(db_alias))
+
     def launch(self, db_alias):
         """ Pass the migration to the backend to perform the data operation(s).
             This is what should be called by the web interface to trigger the migration.
@@ -128,14 +169,60 @@ class BaseMigration:
             migration = MigrationRecord.objects.using(db_alias).create(
                 key=self.key,
             )
+            MigrationAttempt.objects.using(db_alias).create(
+                key=self.key,
+                attempt_uuid=migration.attempt_uuid,
+                db_alias=db_alias,
+                started_at=migration.initiated_at,
+            )
             return migration.attempt_uuid
 
     @retry_on_error()
-    def mark_as_errored(self, db_alias, error=None):
-        """ Mark the migration as errored in the database. """
+    def mark_as_errored(self, db_alias, error=None, attempt_uuid=None):
+        """ Mark the migration as errored in the database.
+            When many tasks hit errors at once, only the first one writes to the MigrationRecord;
+            the others just record a sample of their error (see `_record_error_sample`).
+        """
         # TODO: Generate a proper traceback here
         error_str = f"{error.__class__.__name__}: {error}"
-        MigrationRecord.objects.using(db_alias).filter(key=self.key).update(has_error=True, last_error=error_str)
+        errored_key = (self.key, db_alias, attempt_uuid)
+        if attempt_uuid is None or errored_key not in ERRORED_ATTEMPTS:
+            queryset = MigrationRecord.objects.using(db_alias).filter(key=self.key, has_error=False)
+            if attempt_uuid is not None:
+                queryset = queryset.filter(attempt_uuid=attempt_uuid)
+            if queryset.update(has_error=True, last_error=error_str):
+                logger.info("Marked migration %s as errored.", self.key)
+                record_cache.refresh_record(self.key, db_alias)
+                self.finish_attempt(db_alias, attempt_uuid, MigrationAttempt.Status.ERRORED, error_str)
+            if attempt_uuid is not None:
+                ERRORED_ATTEMPTS[errored_key] = True
+        self._record_error_sample(db_alias, error, error_str, attempt_uuid)
+
+    def _record_error_sample(self, db_alias, error, error_str, attempt_uuid):
+        """ Store the error as a MigrationErrorSample, unless this process has already stored one
+            of the same type for this attempt, or has already stored its maximum number of samples
+            for this attempt.
+        """
+        attempt_key = (self.key, db_alias, attempt_uuid)
+        error_type = error.__class__.__name__
+        max_samples = getattr(
+            settings, "MASSMIGRATION_MAX_ERROR_SAMPLES_PER_ATTEMPT", DEFAULT_MAX_ERROR_SAMPLES_PER_ATTEMPT
+        )
+        sampled_types = SAMPLED_ERRORS.get(attempt_key, set())
+        if error_type in sampled_types or len(sampled_types) >= max_samples:
+            return
+        sampled_types.add(error_type)
+        SAMPLED_ERRORS[attempt_key] = sampled_types
+        try:
+            MigrationErrorSample.objects.using(db_alias).create(
+                key=self.key,
+                attempt_uuid=attempt_uuid,
+                error_type=error.__class__.__name__,
+                error=error_str,
+            )
+        except Exception:
+            # The sample is only informational, so failing to store it mustn't stop anything else
+            logger.exception("Failed to store error sample for migration %s.", self.key)
 
     @retry_on_error()
     def mark_as_finished(self, db_alias):
@@ -148,6 +235,46 @@ class BaseMigration:
                 migration.is_applied = True
                 migration.save()
                 logger.info("Migration %s finished. Marked it as applied.", self.key)
+                # Imported here because the enforcement module imports this one
+                from .enforcement import bump_applied_version
+                # Other processes mustn't reload the applied migrations before this is committed
+                transaction.on_commit(bump_applied_version, using=db_alias)
+                self.finish_attempt(db_alias, migration.attempt_uuid, MigrationAttempt.Status.APPLIED)
+
+    def finish_attempt(self, db_alias, attempt_uuid, status, error=""):
+        """ Record the outcome, timings and throughput of an attempt at running the migration in
+            its MigrationAttempt. Only the first outcome of each attempt is recorded.
+            If `attempt_uuid` is None, the current attempt is used.
+        """
+        record = MigrationRecord.objects.using(db_alias).filter(key=self.key).first()
+        if attempt_uuid is None:
+            if not record:
+                return
+            attempt_uuid = record.attempt_uuid
+        attempt = MigrationAttempt.objects.using(db_alias).filter(
+            attempt_uuid=attempt_uuid, finished_at=None
+        ).first()
+        if not attempt:
+            return
+        attempt.status = status
+        attempt.error = error
+        attempt.finished_at = timezone.now()
+        tasks = MigrationTask.objects.using(db_alias).filter(attempt_uuid=attempt_uuid)
+        task_durations = [
+            (finished_at - started_at).total_seconds()
+            for started_at, finished_at in tasks.values_list("started_at", "finished_at")
+            if started_at and finished_at
+        ]
+        attempt.peak_task_seconds = max(task_durations, default=None)
+        # Chunked migrations count their rows on the record, whereas mapper tasks count their own
+        attempt.objects_processed = max(
+            record.objects_processed if record and record.attempt_uuid == attempt_uuid else 0,
+            sum(tasks.filter(phase=MigrationTask.Phase.PROCESS).values_list("objects_processed", flat=True)),
+        )
+        seconds = attempt.duration().total_seconds()
+        if attempt.objects_processed and seconds > 0:
+            attempt.objects_per_second = attempt.objects_processed / seconds
+        attempt.save()
 
     def check_dependencies(self, db_alias):
         """ Make sure that any migrations which this migration depends on have been applied. """
@@ -163,6 +290,58 @@ class BaseMigration:
                     "yet been applied."
                 )
 
+    def attempt_is_current(self, attempt_uuid, db_alias) -> bool:
+        """ Should processing for the given attempt continue? I.e. the migration still exists in
+            the DB, with the same attempt, and hasn't errored. This uses the (possibly stale)
+            cached record, so that it can be called for every object/chunk of a migration.
+        """
+        key = self.key
+        record = record_cache.get_record(key, db_alias)
+        if record is None:
+            logger.warning(
+                "Migration %s no longer exists in the DB. Skipping processing operation.", key
+            )
+        elif record.attempt_uuid != attempt_uuid:
+            logger.warning(
+                "Migration %s now has attempt %s. Skipping processing operation from attempt %s.",
+                key, record.attempt_uuid, attempt_uuid
+            )
+        elif record.has_error:
+            ERRORED_ATTEMPTS[(key, db_alias, attempt_uuid)] = True
+            logger.warning(
+                "Migration %s is marked in the DB as having errors. Skipping processing operation.",
+                key,
+            )
+        else:
+            return True
+        return False
+
+    def pause(self, db_alias):
+        """ Pause the running migration. Its tasks stop at the end of their current chunk, and
+            wait until it's resumed.
+        """
+        self._set_paused(db_alias, True)
+        logger.info("Paused migration %s.", self.key)
+
+    def resume(self, db_alias):
+        """ Resume the paused migration. Its tasks continue from where they stopped. """
+        record = self._set_paused(db_alias, False)
+        # Tasks which are waiting to check again can be claimed straight away
+        MigrationTask.objects.using(db_alias).filter(
+            attempt_uuid=record.attempt_uuid, status=MigrationTask.Status.PENDING
+        ).update(available_at=None)
+        logger.info("Resumed migration %s.", self.key)
+
+    def _set_paused(self, db_alias, is_paused):
+        with get_transaction(db_alias).atomic(using=db_alias):
+            record = MigrationRecord.objects.using(db_alias).select_for_update().filter(key=self.key).first()
+            if not record or not record._in_progress():
+                raise MigrationNotRunning(f"Migration {self.key} on DB {db_alias} is not running.")
+            record.is_paused = is_paused
+            # Saving (rather than updating) the record updates the record cache which tasks check
+            record.save()
+        return record
+
     def get_migration_record(self, db_alias):
         return MigrationRecord.objects.using(db_alias).filter(key=self.key).first()
 
@@ -178,13 +357,26 @@ class SimpleMigration(BaseMigration):
     def operation(self, db_alias):
         raise NotImplementedError("The `operation` method must be implemented by subclasses.")
 
-    def wrapped_operation(self, db_alias):
+    def wrapped_operation(self, db_alias, attempt_uuid=None):
+        """ Mark the migration as started and run its operation. If `attempt_uuid` is given, the
+            backend has already marked it as started (when it queued the task), and the operation
+            is only run if that attempt is still in progress.
+        """
+        if attempt_uuid is None:
+            attempt_uuid = self.mark_as_started(db_alias)
+        elif not MigrationRecord.objects.using(db_alias).filter(
+            key=self.key, attempt_uuid=attempt_uuid, is_applied=False, has_error=False
+        ).exists():
+            logger.warning(
+                "Attempt %s of migration %s is no longer in progress. Not running its operation.",
+                attempt_uuid, self.key,
+            )
+            return
         logger.info("Running operation for migration %s", self.key)
-        self.mark_as_started(db_alias)
         try:
             self.operation(db_alias)
         except Exception as error:
-            self.mark_as_errored(db_alias, error)
+            self.mark_as_errored(db_alias, error, attempt_uuid)
         else:
             self.mark_as_finished(db_alias)
 
@@ -194,50 +386,459 @@ class MapperMigration(BaseMigration):
 
     backend_method = "run_mapper"
 
+    # The number of objects which may still need migrating after the verification pass for the
+    # migration to be marked as applied. See `verify_queryset`.
+    verify_threshold: int = 0
+
+    # If True, a record of which objects have been processed is kept in the cache, so that objects
+    # aren't processed twice when a task is retried part way through a chunk. This costs a cache
+    # write per transaction batch (or per 100 objects), so is intended for expensive or
+    # non-idempotent operations. The cache must be shared between all of the processes which run
+    # the migration.
+    skip_processed_objects: bool = False
+
+    # Exceptions which `operation` may raise due to transient problems (e.g. deadlocks or timeouts),
+    # which should be retried before the migration is marked as errored, e.g. `(OperationalError,)`
+    retry_exceptions: tuple = ()
+    # The number of times to try the operation on each object (or each batch of objects, if
+    # `objects_per_transaction` is set) if it raises one of `retry_exceptions`
+    retry_max_attempts: int = 3
+    # The wait before each retry doubles from `retry_initial_wait` up to `retry_max_wait` seconds,
+    # with a random amount of this actually being waited, so that retries are spread out
+    retry_initial_wait: float = 0.1
+    retry_max_wait: float = 10
+
+    # If set, this many consecutive objects are processed in one transaction, rather than each
+    # object's changes being committed separately, which is much faster for cheap operations on SQL
+    # DBs. Each object is processed in a savepoint, so that a failure only rolls back its changes.
+    # A transient error rolls back the whole batch, which is retried once the transaction's locks
+    # have been released.
+    objects_per_transaction: int = None
+
+    # If set, the queryset is read from (and split into key ranges on) this DB, e.g. a read replica,
+    # rather than the DB which the migration is run on. The objects are switched to the DB which
+    # it's run on before being passed to `operation`, so that saving them writes to it.
+    read_db_alias: str = None
+    # If set (along with `read_db_alias`), each chunk of objects is re-fetched from the DB which the
+    # migration is run on before being processed, so that `operation` sees their latest values.
+    refetch_from_primary: bool = False
+    # If set (along with `read_db_alias`), tasks wait while the replica is more than this many
+    # seconds behind its primary, in the same way as when the migration is paused.
+    max_replication_lag: float = None
+
+    # If set, the values of these fields of each chunk of objects are stored in a compressed snapshot
+    # file before the objects are processed, so that the migration can be rolled back with a
+    # `RestoreSnapshotMigration`
+    snapshot_fields: list = None
+
+    def get_read_db_alias(self, db_alias):
+        """ Override this to read from a different replica depending on the DB which the migration
+            is run on.
+        """
+        return self.read_db_alias or db_alias
+
     def get_queryset(self, db_alias):
         """ Returns the Django queryset which is to be mapped over. """
         raise NotImplementedError("The `get_queryset` method must be implemented by subclasses.")
 
+    def verify_queryset(self, db_alias):
+        """ Optionally returns a queryset of the objects which still need migrating, e.g.
+            `self.get_queryset(db_alias).filter(new_field=None)`. If given, then once all of the
+            objects have been processed, this is counted across the same key ranges and any objects
+            in it are processed again. The migration is only marked as applied if no more than
+            `verify_threshold` of them remain.
+        """
+        return None
+
     def operation(self, obj: models.Model, db_alias: str) -> None:
         """ This is what will get called on each model instance in the queryset. """
         raise NotImplementedError("The `operation` method must be implemented by subclasses.")
 
-    def wrapped_operation(self, obj, attempt_uuid, db_alias):
+    def map_result(self, obj: models.Model):
+        """ Optionally returns a (JSON serializable) value for each object which was successfully
+            processed, e.g. `{obj.category: 1}`, to be aggregated with `reduce`. Objects for which
+            this returns None are left out.
+        """
+        return None
+
+    def reduce(self, partials: list):
+        """ Combines a list of values, each of which is either a result of `map_result` or a
+            previous result of this method, into one. Each task aggregates the results of its own
+            objects as it goes, then the tasks' aggregates are reduced into the migration's result,
+            which is stored on its record. This must therefore be associative, and must accept the
+            values as they are once they've been through JSON, e.g. dicts rather than Counters.
+        """
+        raise NotImplementedError("The `reduce` method must be implemented if `map_result` is.")
+
+    def wrapped_operation(self, obj, attempt_uuid, db_alias, on_retry=None, in_batch=False):
         """ Call self.operation() on the object, but wrap it to catch any errors and set the
-            migration as failed if necessary.
+            migration as failed if necessary. Returns True if the operation succeeded.
+            `on_retry()` is called each time the operation is retried after a transient error.
+            If `in_batch` is True, the operation is run in a savepoint and transient errors are
+            raised rather than retried, so that the caller can retry the whole batch (see
+            `wrapped_batch`).
         """
         key = self.key
-        record = record_cache.get_record(self.key, db_alias)
-        if record is None:
-            logger.warning(
-                "Migration %s no longer exists in the DB. Skipping processing operation.", key
+        if not self.attempt_is_current(attempt_uuid, db_alias):
+            return False
+        # We could log the object with just str(obj) here, but as the model might have a custom
+        # __str__ method which does DB lookups, we just use the PK to ensure efficiency
+        logger.info(
+            "Running operation for migration %s on %s (pk=%r).",
+            key,
+            obj.__class__.__name__,
+            obj.pk,
+        )
+        try:
+            if in_batch:
+                with get_transaction(db_alias).atomic(using=db_alias):
+                    self.operation(obj, db_alias)
+            else:
+                self._operation_with_retries(obj, db_alias, on_retry)
+        except Exception as error:
+            if in_batch and isinstance(error, self.retry_exceptions):
+                raise
+            logger.exception(
+                "Error in migration %s trying to process object %s (pk=%r).",
+                key,
+                obj.__class__.__name__,
+                obj.pk,
             )
-        elif record.attempt_uuid != attempt_uuid:
-            logger.warning(
-                "Migration %s now has attempt %s. Skipping processing operation from attempt %s.",
-                key, record.attempt_uuid, attempt_uuid
+            self.mark_as_errored(db_alias, error, attempt_uuid)
+            return False
+        return True
+
+    def wrapped_batch(self, objects, attempt_uuid, db_alias, on_retry=None):
+        """ Call wrapped_operation() on each of the objects in one transaction, and return those
+            whose operation succeeded. If an operation raises one of `retry_exceptions`, the whole
+            transaction is rolled back, and the batch is retried after a wait, so that the batch's
+            locks aren't held while waiting.
+        """
+        for attempt in range(1, self.retry_max_attempts + 1):
+            try:
+                with get_transaction(db_alias).atomic(using=db_alias):
+                    return [
+                        obj for obj in objects
+                        if self.wrapped_operation(obj, attempt_uuid, db_alias, in_batch=True)
+                    ]
+            except self.retry_exceptions as error:
+                description = f"batch of {len(objects)} objects from pk={objects[0].pk!r}"
+                if attempt >= self.retry_max_attempts:
+                    logger.exception("Error in migration %s trying to process %s.", self.key, description)
+                    self.mark_as_errored(db_alias, error, attempt_uuid)
+                    return []
+                self._wait_before_retry(error, attempt, description, on_retry)
+
+    def _operation_with_retries(self, obj, db_alias, on_retry=None):
+        """ Call self.operation() on the object, retrying it with exponential backoff and jitter if
+            it raises one of `retry_exceptions`.
+        """
+        for attempt in range(1, self.retry_max_attempts + 1):
+            try:
+                return self.operation(obj, db_alias)
+            except self.retry_exceptions as error:
+                if attempt >= self.retry_max_attempts:
+                    raise
+                self._wait_before_retry(error, attempt, f"{obj.__class__.__name__} (pk={obj.pk!r})", on_retry)
+
+    def _wait_before_retry(self, error, attempt, description, on_retry=None):
+        wait = min(self.retry_initial_wait * 2 ** (attempt - 1), self.retry_max_wait)
+        logger.warning(
+            "Transient error in migration %s on %s: %r. Retrying (attempt %s of %s).",
+            self.key, description, error, attempt + 1, self.retry_max_attempts,
+        )
+        if on_retry:
+            on_retry()
+        time.sleep(random.uniform(0, wait))
+
+
+class IncrementalMapperMigration(MapperMigration):
+    """ A mapper migration which can be re-run as new data arrives, processing only the objects
+        which have been added (or changed) since its last run. The highest value of
+        `watermark_field` which has been processed is stored on the migration's record, and each
+        run processes the objects above it, up to the highest value at the time the run starts.
+        Subclasses implement `get_base_queryset` rather than `get_queryset`.
+    """
+
+    # A field whose value only increases as objects are added (or changed), e.g. the PK or an
+    # `auto_now` DateTimeField
+    watermark_field: str = "pk"
+
+    def get_base_queryset(self, db_alias):
+        """ Returns the Django queryset of all of the objects which the migration applies to. """
+        raise NotImplementedError("The `get_base_queryset` method must be implemented by subclasses.")
+
+    def get_queryset(self, db_alias, watermarks=None):
+        """ Returns the objects which the current (or next) run of the migration processes, i.e.
+            those between the given `(watermark, next_watermark)` pair. If `watermarks` isn't given,
+            they're taken from the (cached) record on `db_alias`.
+        """
+        if watermarks is None:
+            record = record_cache.get_record(self.key, db_alias)
+            watermarks = (record.watermark, record.next_watermark) if record else (None, None)
+        watermark, next_watermark = watermarks
+        queryset = self.get_base_queryset(db_alias)
+        if watermark is not None:
+            queryset = queryset.filter(
+                **{f"{self.watermark_field}__gt": self._load_watermark(queryset, watermark)}
             )
-        elif record.has_error:
-            logger.warning(
-                "Migration %s is marked in the DB as having errors. Skipping processing operation.",
-                key,
+        if next_watermark is not None:
+            queryset = queryset.filter(
+                **{f"{self.watermark_field}__lte": self._load_watermark(queryset, next_watermark)}
             )
-        else:
-            # We could log the object with just str(obj) here, but as the model might have a custom
-            # __str__ method which does DB lookups, we just use the PK to ensure efficiency
+        return queryset
+
+    def get_task_queryset(self, db_alias, read_db_alias=None):
+        # The watermarks are read from the record on the primary, as the cached record (or the
+        # replica's copy of it) may not have caught up with the start of the current run yet
+        record = MigrationRecord.objects.using(db_alias).filter(key=self.key).first()
+        watermarks = (record.watermark, record.next_watermark) if record else (None, None)
+        return self.get_queryset(read_db_alias or self.get_read_db_alias(db_alias), watermarks)
+
+    def get_high_watermark(self, db_alias):
+        return self.get_base_queryset(db_alias).aggregate(high=Max(self.watermark_field))["high"]
+
+    def _dump_watermark(self, value):
+        """ Convert a value of the watermark field to the form which it's stored in on the record.
+            Dates and times are stored as full ISO strings, as the JSONField's DjangoJSONEncoder
+            would cut datetimes down to milliseconds, leaving objects above the stored watermark
+            which it would never process.
+        """
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        if isinstance(value, (Decimal, UUID)):
+            return str(value)
+        return value
+
+    def _load_watermark(self, queryset, value):
+        """ Convert a watermark stored on the record back to a value of the watermark field. """
+        opts = queryset.model._meta
+        field = opts.pk if self.watermark_field == "pk" else opts.get_field(self.watermark_field)
+        return field.to_python(value)
+
+    def has_new_objects(self, db_alias) -> bool:
+        """ Are there any objects which haven't been processed by a previous run? """
+        queryset = self.get_base_queryset(db_alias)
+        record = self.get_migration_record(db_alias)
+        if record and record.watermark is not None:
+            queryset = queryset.filter(
+                **{f"{self.watermark_field}__gt": self._load_watermark(queryset, record.watermark)}
+            )
+        return queryset.exists()
+
+    def can_be_started(self, db_alias) -> bool:
+        record = self.get_migration_record(db_alias)
+        return record is None or self._can_be_rerun(record)
+
+    def _can_be_rerun(self, record):
+        # Once the first run has finished, the migration can be re-run unless a re-run is in progress
+        return record.is_applied and not record._in_progress()
+
+    def mark_as_started(self, db_alias) -> UUID:
+        """ Mark the migration as started, or as being re-run, and set the watermark which this run
+            processes up to. Return the attempt UUID.
+        """
+        with get_transaction(db_alias).atomic(using=db_alias):
+            record = MigrationRecord.objects.using(db_alias).select_for_update().filter(key=self.key).first()
+            if record is None:
+                super().mark_as_started(db_alias)
+                record = MigrationRecord.objects.using(db_alias).get(key=self.key)
+            elif self._can_be_rerun(record):
+                # The record stays applied, so that code which requires the migration still works
+                record.attempt_uuid = uuid4()
+                record.has_error = False
+                record.last_error = ""
+                record.objects_processed = 0
+                MigrationAttempt.objects.using(db_alias).create(
+                    key=self.key, attempt_uuid=record.attempt_uuid, db_alias=db_alias
+                )
+            else:
+                raise MigrationAlreadyStarted(
+                    f"Migration {self.__class__.__name__} is already running."
+                )
+            record.next_watermark = self._dump_watermark(self.get_high_watermark(db_alias))
+            # Saving (rather than updating) the record updates the record cache which tasks check
+            record.save()
             logger.info(
-                "Running operation for migration %s on %s (pk=%r).",
-                key,
-                obj.__class__.__name__,
-                obj.pk,
+                "Started migration %s, processing objects with %s above %r, up to %r.",
+                self.key, self.watermark_field, record.watermark, record.next_watermark,
             )
+            return record.attempt_uuid
+
+    def mark_as_finished(self, db_alias):
+        """ Move the watermark up to the value which the finished run processed up to. """
+        with get_transaction(db_alias).atomic(using=db_alias):
+            record = MigrationRecord.objects.using(db_alias).select_for_update().get(key=self.key)
+            if record.next_watermark is not None:
+                record.watermark = record.next_watermark
+            record.next_watermark = None
+            record.save()
+            if record.is_applied:
+                logger.info("Re-run of migration %s finished, up to %r.", self.key, record.watermark)
+                self.finish_attempt(db_alias, record.attempt_uuid, MigrationAttempt.Status.APPLIED)
+                return
+        super().mark_as_finished(db_alias)
+
+
+class RestoreSnapshotMigration(MapperMigration):
+    """ A migration which rolls back a mapper migration which has `snapshot_fields`, by writing the
+        snapshotted values back to its objects. This maps over the snapshot's chunks (rather than
+        the objects themselves), restoring each one with `bulk_update`, so the chunks are restored
+        in parallel and the time taken depends on the number of objects which were changed.
+    """
+
+    # The (app_label, migration_name) of the migration to roll back
+    source_migration: tuple = None
+    # The attempt of the source migration to roll back. Defaults to its most recent snapshotted one.
+    source_attempt_uuid: UUID = None
+
+    def get_queryset(self, db_alias):
+        key = MigrationRecord.key_from_name_tuple(self.source_migration)
+        snapshots = MigrationSnapshot.objects.using(db_alias).filter(key=key)
+        attempt_uuid = self.source_attempt_uuid or snapshots.order_by("-created_at").values_list(
+            "attempt_uuid", flat=True
+        ).first()
+        return snapshots.filter(attempt_uuid=attempt_uuid)
+
+    def operation(self, snapshot, db_alias):
+        restore_snapshot(snapshot, db_alias)
+
+
+class ChunkedMigration(BaseMigration):
+    """ Base class for migrations which operate on a queryset in chunks of PKs with one (or a few)
+        statements per chunk, rather than calling a Python function on each object.
+        Subclasses must implement `process_chunk`.
+    """
+
+    # The maximum number of rows to process in each chunk
+    rows_per_statement: int = 1000
+
+    def get_queryset(self, db_alias):
+        """ Returns the Django queryset which is to be processed. """
+        raise NotImplementedError("The `get_queryset` method must be implemented by subclasses.")
+
+    def process_chunk(self, queryset, db_alias) -> int:
+        """ Process the rows of the given queryset (which is one chunk of the main queryset), and
+            return the number of rows processed.
+        """
+        raise NotImplementedError("The `process_chunk` method must be implemented by subclasses.")
+
+    def wrapped_chunks(self, attempt_uuid, db_alias, lower=None, upper=None, after=None):
+        """ Process the given range of PKs (lower inclusive, upper exclusive, None meaning
+            unbounded) in chunks, starting after the `after` PK if given. This is a generator which
+            yields a (last_pk, rows_processed) pair after each chunk, so that the backend can record
+            progress. Stops if the attempt is no longer current or if an error occurs, in which
+            case the migration is marked as errored.
+        """
+        queryset = filter_key_range(self.get_queryset(db_alias), lower, upper).order_by("pk")
+        while self.attempt_is_current(attempt_uuid, db_alias):
+            chunk_queryset = queryset if after is None else queryset.filter(pk__gt=after)
             try:
-                self.operation(obj, db_alias)
+                pks = list(chunk_queryset.values_list("pk", flat=True)[:self.rows_per_statement])
+                if not pks:
+                    return
+                rows_processed = self.process_chunk(
+                    queryset.filter(pk__range=(pks[0], pks[-1])), db_alias
+                )
+                self.record_progress(db_alias, attempt_uuid, rows_processed)
             except Exception as error:
                 logger.exception(
-                    "Error in migration %s trying to process object %s (pk=%r).",
-                    key,
-                    obj.__class__.__name__,
-                    obj.pk,
+                    "Error in migration %s trying to process rows after pk=%r.", self.key, after
                 )
-                self.mark_as_errored(db_alias, error)
+                self.mark_as_errored(db_alias, error, attempt_uuid)
+                return
+            logger.info(
+                "Processed %s rows for migration %s (pk %r to %r).",
+                rows_processed, self.key, pks[0], pks[-1],
+            )
+            after = pks[-1]
+            yield after, rows_processed
+            if len(pks) < self.rows_per_statement:
+                return
+
+    def record_progress(self, db_alias, attempt_uuid, rows_processed):
+        """ Add the number of rows processed by a chunk to the count on the MigrationRecord. """
+        MigrationRecord.objects.using(db_alias).filter(key=self.key, attempt_uuid=attempt_uuid).update(
+            objects_processed=models.F("objects_processed") + rows_processed
+        )
+
+
+class UpdateMigration(ChunkedMigration):
+    """ A migration which performs a set-based `update()` on a queryset, e.g. `UPDATE table SET
+        col = expr WHERE ...`, without loading any objects into Python. The update is run in chunks
+        of PKs so that no single statement holds locks on (or replicates) too many rows.
+    """
+
+    backend_method = "run_update"
+
+    # The kwargs to pass to `queryset.update()`, e.g. {"total": F("price") * F("quantity")}
+    update_kwargs: dict = None
+
+    def get_update_kwargs(self, db_alias) -> dict:
+        """ Returns the kwargs to pass to `queryset.update()`. """
+        if not self.update_kwargs:
+            raise NotImplementedError(
+                "The `update_kwargs` attribute or `get_update_kwargs` method must be set by subclasses."
+            )
+        return self.update_kwargs
+
+    def process_chunk(self, queryset, db_alias) -> int:
+        return queryset.update(**self.get_update_kwargs(db_alias))
+
+
+class DeleteMigration(ChunkedMigration):
+    """ A migration which deletes the objects in a queryset, in chunks of PKs so that no single
+        transaction holds locks on (or has to collect the cascades of) too many rows.
+    """
+
+    backend_method = "run_delete"
+
+    # Number of seconds to sleep between chunks, to reduce the load on the DB
+    pause_between_chunks: float = 0
+
+    def process_chunk(self, queryset, db_alias) -> int:
+        if Collector(using=db_alias).can_fast_delete(queryset):
+            # There are no cascades or signals, so we can just issue a DELETE statement
+            rows_deleted = queryset._raw_delete(using=db_alias)
+        else:
+            rows_deleted = queryset.delete()[1].get(queryset.model._meta.label, 0)
+        if self.pause_between_chunks:
+            time.sleep(self.pause_between_chunks)
+        return rows_deleted
+
+
+class CopyMigration(ChunkedMigration):
+    """ A migration which copies (and optionally transforms) the objects of a queryset into
+        another model, possibly on another DB, e.g. for denormalisation or splitting a table. Each
+        chunk of source objects is passed to `transform`, and the resulting objects are inserted
+        with a single `bulk_create`.
+    """
+
+    backend_method = "run_copy"
+
+    # The alias of the DB to write the new objects to. If None, the same DB as the source is used.
+    target_db_alias: str = None
+
+    # Extra kwargs for `bulk_create`, e.g. {"ignore_conflicts": True} or {"update_conflicts": True,
+    # "unique_fields": [...], "update_fields": [...]}, which allow the migration to be re-run.
+    bulk_create_kwargs: dict = {}
+
+    def transform(self, rows, db_alias) -> list:
+        """ Given a list of objects from the source queryset, return a list of (unsaved) model
+            instances to be inserted into the target model.
+        """
+        raise NotImplementedError("The `transform` method must be implemented by subclasses.")
+
+    def get_target_db_alias(self, db_alias) -> str:
+        """ Returns the alias of the DB to write the new objects to. """
+        return self.target_db_alias or db_alias
+
+    def process_chunk(self, queryset, db_alias) -> int:
+        rows = list(queryset)
+        new_objects = self.transform(rows, db_alias)
+        if new_objects:
+            target_model = new_objects[0].__class__
+            target_model._default_manager.using(self.get_target_db_alias(db_alias)).bulk_create(
+                new_objects, **(self.bulk_create_kwargs or {})
+            )
+        return len(rows)
@@ -2,6 +2,7 @@
 import uuid
 
 # Third party
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.utils import timezone
 from gcloudc.db.models.fields.computed import ComputedBooleanField
@@ -21,6 +22,7 @@ class MigrationRecord(models.Model):
         APPLIED = "APPLIED"
         ERRORED = "ERRORED"
         RUNNING = "RUNNING"
+        PAUSED = "PAUSED"
         NOT_RUN = "NOT_RUN"  # Can't be returned by this object, as this object won't exist
 
     # I'm still not sure whether the key should be computed from the app_label and name or the
@@ -47,8 +49,47 @@ class MigrationRecord(models.Model):
     )
     applied_at = ComputedDateTimeField("_applied_at", null=True)
     has_error = models.BooleanField(default=False)
+    is_paused = models.BooleanField(
+        default=False, help_text="Paused migrations stop processing until they are resumed."
+    )
     last_error = models.TextField(blank=True)
     was_faked = models.BooleanField(default=False)
+    objects_processed = models.BigIntegerField(
+        default=0, help_text="The number of rows processed so far, for migrations which count them."
+    )
+    seconds_per_object = models.FloatField(
+        null=True,
+        help_text=(
+            "The time taken to process each object, as most recently measured by a task. Used as "
+            "the starting point for adaptive chunk sizing."
+        ),
+    )
+    outstanding_tasks = models.IntegerField(
+        default=0,
+        help_text=(
+            "For backends which track their work as MigrationTasks, the number of the current "
+            "attempt's tasks which aren't done yet. The task which brings this to zero finishes "
+            "the migration."
+        ),
+    )
+    watermark = models.JSONField(
+        null=True,
+        encoder=DjangoJSONEncoder,
+        help_text=(
+            "For incremental migrations, the highest value of the watermark field which has been "
+            "processed. Later runs only process objects above it."
+        ),
+    )
+    next_watermark = models.JSONField(
+        null=True,
+        encoder=DjangoJSONEncoder,
+        help_text="For incremental migrations, the watermark which the current run is processing up to.",
+    )
+    result = models.JSONField(
+        null=True,
+        encoder=DjangoJSONEncoder,
+        help_text="For mapper migrations which define `reduce`, the aggregated result of the migration.",
+    )
 
     def _app_label(self):
         return self.key.split(":")[0]
@@ -62,7 +103,10 @@ class MigrationRecord(models.Model):
         return self.applied_at
 
     def _in_progress(self):
-        return not (self.is_applied or self.has_error)
+        if self.has_error:
+            return False
+        # Incremental migrations stay applied while they're re-run
+        return not self.is_applied or self.next_watermark is not None
 
     @staticmethod
     def key_from_name_tuple(name_tuple):
@@ -75,6 +119,140 @@ class MigrationRecord(models.Model):
     def status(self):
         if self.has_error:
             return self.Status.ERRORED
-        if self.is_applied:
+        # An incremental migration which is being re-run stays applied, but is shown as running
+        if self.is_applied and self.next_watermark is None:
             return self.Status.APPLIED
+        if self.is_paused:
+            return self.Status.PAUSED
         return self.Status.RUNNING
+
+
+class MigrationErrorSample(models.Model):
+    """ An append-only sample of an error which occurred while a migration was running.
+    Only the first error of an attempt is written to the MigrationRecord itself (to avoid
+    contention on that one row), so these allow the distinct types of failure to be seen.
+    """
+
+    key = models.CharField(max_length=250, db_index=True)
+    attempt_uuid = models.UUIDField(null=True, editable=False)
+    error_type = models.CharField(max_length=250)
+    error = models.TextField(blank=True)
+    occurred_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        ordering = ("-occurred_at",)
+
+
+class MigrationAttempt(models.Model):
+    """ The history of an attempt at running a migration, with its timings and throughput.
+    Unlike the MigrationRecord, these are kept when a migration's record is deleted, so that runs
+    can be compared across attempts and environments.
+    """
+
+    class Status(models.TextChoices):
+        RUNNING = "RUNNING"
+        APPLIED = "APPLIED"
+        ERRORED = "ERRORED"
+        DELETED = "DELETED"
+
+    key = models.CharField(max_length=250, db_index=True)
+    attempt_uuid = models.UUIDField(unique=True, editable=False)
+    db_alias = models.CharField(max_length=100)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.RUNNING)
+    started_at = models.DateTimeField(default=timezone.now, editable=False)
+    finished_at = models.DateTimeField(null=True)
+    objects_processed = models.BigIntegerField(default=0)
+    objects_per_second = models.FloatField(
+        null=True, help_text="The overall throughput of the attempt, across all of its tasks."
+    )
+    peak_task_seconds = models.FloatField(
+        null=True, help_text="The longest time taken by any one task (shard) of the attempt."
+    )
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ("-started_at",)
+
+    def duration(self):
+        return self.finished_at - self.started_at if self.finished_at else None
+
+
+class MigrationTask(models.Model):
+    """ A unit of work for a migration, e.g. one key range (shard) of a mapper migration's queryset.
+    These are used by backends which track the work themselves rather than handing it off to a
+    task queue service, and are stored on the same DB as the migration's MigrationRecord.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "PENDING"
+        RUNNING = "RUNNING"
+        DONE = "DONE"
+
+    class Phase(models.TextChoices):
+        PROCESS = "PROCESS"
+        # Checking for (and re-processing) objects which still need migrating. See
+        # `MapperMigration.verify_queryset`.
+        VERIFY = "VERIFY"
+
+    key = models.CharField(max_length=250, db_index=True)
+    attempt_uuid = models.UUIDField(null=True, db_index=True, editable=False)
+    backend_method = models.CharField(
+        max_length=100, help_text="The `backend_method` of the migration which this task is part of."
+    )
+    phase = models.CharField(max_length=10, choices=Phase.choices, default=Phase.PROCESS)
+    # The range of PKs which this task covers, lower inclusive and upper exclusive. None means unbounded.
+    lower_bound = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    upper_bound = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    cursor = models.JSONField(
+        null=True,
+        encoder=DjangoJSONEncoder,
+        help_text="The PK of the last object processed, so that a re-queued task doesn't redo work.",
+    )
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING, db_index=True)
+    worker = models.CharField(max_length=250, blank=True)
+    claim_count = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(null=True)
+    available_at = models.DateTimeField(
+        null=True, help_text="The task won't be claimed before this time, e.g. while its migration is paused."
+    )
+    heartbeat_at = models.DateTimeField(null=True)
+    lease_expires_at = models.DateTimeField(null=True)
+    objects_processed = models.BigIntegerField(default=0)
+    seconds_per_object = models.FloatField(null=True)
+    operation_retries = models.BigIntegerField(
+        default=0, help_text="The number of times an object (or batch) was retried after a transient error."
+    )
+    partial_result = models.JSONField(
+        null=True,
+        encoder=DjangoJSONEncoder,
+        help_text="For mapper migrations which define `reduce`, the aggregate of this task's results so far.",
+    )
+    residual_count = models.BigIntegerField(
+        null=True, help_text="For verification tasks, the number of objects still needing migrating."
+    )
+    peak_memory = models.BigIntegerField(
+        null=True,
+        help_text="The highest memory usage (RSS, in bytes) of a process while it was running this task.",
+    )
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        ordering = ("created_at", "pk")
+
+
+class MigrationSnapshot(models.Model):
+    """ A compressed snapshot of the values of some objects from before a mapper migration changed
+    them, for rolling the migration back. See `MapperMigration.snapshot_fields`. Each one covers one
+    chunk of one task, and is stored as a gzipped JSON Lines file in the snapshot storage.
+    """
+
+    key = models.CharField(max_length=250, db_index=True)
+    attempt_uuid = models.UUIDField(db_index=True, editable=False)
+    model = models.CharField(max_length=250, help_text="The label of the model which the objects are from.")
+    path = models.CharField(max_length=500, unique=True)
+    object_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        ordering = ("created_at", "pk")
@@ -0,0 +1,190 @@
+""" Working out what launching a migration will involve, before it's launched: how many objects its
+    queryset contains, how the DB will execute the query, and how the backend will split it up.
+"""
+
+# Standard library
+import logging
+import re
+
+# Third party
+from django.db import NotSupportedError, connections
+
+# Mass Migration
+from .migrations import get_all_db_aliases
+from .models import MigrationAttempt, MigrationRecord
+from .utils.key_ranges import filter_key_range
+
+logger = logging.getLogger(__name__)
+
+
+# Query plans which scan the whole of a table with more rows than this are flagged
+LARGE_TABLE_ROW_COUNT = 1000000
+
+# Patterns which indicate a full table scan in the output of `QuerySet.explain()`, by DB vendor
+FULL_SCAN_PATTERNS = {
+    "postgresql": re.compile(r"\bSeq Scan\b"),
+    "mysql": re.compile(r"\bALL\b"),
+    "sqlite": re.compile(r"\bSCAN (TABLE )?\w+\s*$", re.MULTILINE),
+}
+
+
+class MigrationPlan:
+    """ The projected work of launching a migration on a DB. See `plan_migration`. """
+
+    def __init__(self, migration, db_alias):
+        self.migration = migration
+        self.db_alias = db_alias
+        # The number of objects in the migration's queryset, or if `row_count_is_estimate` is
+        # True, the DB's estimate of the number of rows in the whole table. None if unknown.
+        self.row_count = None
+        self.row_count_is_estimate = False
+        self.table_row_estimate = None
+        # The output of `QuerySet.explain()`, where supported
+        self.query_plan = None
+        self.full_scan = False
+        # A (lower, upper, size) tuple for each key range which the backend will create a task
+        # for, or None if they're unknown because the plan is only an estimate
+        self.shards = []
+        # The time taken per object by previous runs of the migration, if known
+        self.seconds_per_object = None
+        # The overall throughput of the last successful attempt at the migration, if known
+        self.objects_per_second = None
+
+    @property
+    def task_count(self):
+        if self.shards is None:
+            return None
+        return len(self.shards) or 1
+
+    @property
+    def estimated_seconds(self):
+        """ The projected time to run the migration, assuming that all of its tasks run in
+            parallel, or None if there's no previous rate to base it on.
+        """
+        if self.row_count is None:
+            return None
+        if self.seconds_per_object is None:
+            if self.objects_per_second:
+                return self.row_count / self.objects_per_second
+            return None
+        if self.task_count is None:
+            return None
+        sizes = [size for _, _, size in self.shards if size is not None]
+        largest_shard = max(sizes) if sizes else self.row_count / self.task_count
+        return largest_shard * self.seconds_per_object
+
+    @property
+    def warnings(self):
+        warnings = []
+        table_rows = self.table_row_estimate or self.row_count or 0
+        if self.full_scan and table_rows > LARGE_TABLE_ROW_COUNT:
+            warnings.append(
+                f"The query plan includes a full scan of a table with around {table_rows} rows."
+            )
+        return warnings
+
+
+def plan_migration(migration, db_alias, estimate=True):
+    """ Return a MigrationPlan for launching the given migration on the given DB.
+
+        By default, the plan is only an estimate, which doesn't run any queries which scale with the
+        size of the table: the number of rows is the DB's estimate for the queryset's whole table,
+        from its table statistics, and the key ranges aren't worked out. Only PostgreSQL and MySQL
+        have table statistics; on other DBs (e.g. SQLite, or Datastore/Firestore) the number of
+        rows is reported as unknown. If `estimate` is False, a `COUNT` query is run on the
+        migration's queryset and on each of its key ranges instead, which can be slow for large
+        tables.
+    """
+    plan = MigrationPlan(migration, db_alias)
+    plan.seconds_per_object = _get_previous_seconds_per_object(migration)
+    plan.objects_per_second = _get_previous_objects_per_second(migration)
+    get_queryset = getattr(migration, "get_queryset", None)
+    if not get_queryset:
+        # Simple migrations are a single function, so there's nothing to plan
+        return plan
+
+    # The queryset is counted and explained on the DB which the migration will read it from
+    read_db_alias = migration.get_read_db_alias(db_alias)
+    queryset = migration.get_task_queryset(db_alias)
+    plan.table_row_estimate = _get_table_row_estimate(queryset, read_db_alias)
+    if not estimate:
+        plan.row_count = queryset.count()
+    elif plan.table_row_estimate is not None:
+        plan.row_count = plan.table_row_estimate
+        plan.row_count_is_estimate = True
+
+    plan.query_plan = _explain(queryset, read_db_alias)
+    pattern = FULL_SCAN_PATTERNS.get(connections[read_db_alias].vendor)
+    plan.full_scan = bool(plan.query_plan and pattern and pattern.search(plan.query_plan))
+
+    if estimate:
+        # Splitting the queryset into key ranges can mean scanning its PKs
+        plan.shards = None
+        return plan
+    key_ranges = migration.get_backend().get_key_ranges(migration, db_alias) or []
+    plan.shards = [
+        (lower, upper, filter_key_range(queryset, lower, upper).count()) for lower, upper in key_ranges
+    ]
+    return plan
+
+
+def _get_previous_seconds_per_object(migration):
+    """ Get the time taken per object by a previous run of the migration, on any DB. """
+    for db_alias in get_all_db_aliases():
+        seconds_per_object = MigrationRecord.objects.using(db_alias).filter(
+            key=migration.key, seconds_per_object__isnull=False
+        ).values_list("seconds_per_object", flat=True).first()
+        if seconds_per_object is not None:
+            return seconds_per_object
+    return None
+
+
+def _get_previous_objects_per_second(migration):
+    """ Get the throughput of the most recent successful attempt at the migration, on any DB. """
+    attempts = [
+        MigrationAttempt.objects.using(db_alias).filter(
+            key=migration.key, status=MigrationAttempt.Status.APPLIED, objects_per_second__isnull=False
+        ).first()
+        for db_alias in get_all_db_aliases()
+    ]
+    attempts = [attempt for attempt in attempts if attempt]
+    if not attempts:
+        return None
+    return max(attempts, key=lambda attempt: attempt.started_at).objects_per_second
+
+
+def _get_table_row_estimate(queryset, db_alias):
+    """ Get the DB's estimate of the number of rows in the queryset's table, from its statistics,
+        or None if it doesn't have one.
+    """
+    connection = connections[db_alias]
+    table = queryset.model._meta.db_table
+    if connection.vendor == "postgresql":
+        sql = "SELECT reltuples FROM pg_class WHERE oid = %s::regclass"
+    elif connection.vendor == "mysql":
+        sql = (
+            "SELECT table_rows FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = %s"
+        )
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    # PostgreSQL gives -1 for tables which have never been analyzed
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+def _explain(queryset, db_alias):
+    """ Return the DB's query plan for iterating over the queryset, or None if not supported. """
+    features = connections[db_alias].features
+    if not getattr(features, "supports_explaining_query_execution", False):
+        return None
+    try:
+        # Tasks fetch their objects in PK order
+        return queryset.order_by("pk").explain()
+    except NotSupportedError:
+        logger.exception("Failed to get query plan for %s.", queryset.model)
+        return None
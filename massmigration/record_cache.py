@@ -1,9 +1,13 @@
 """ Utilities for getting information about MigrationRecord objects without hammering the DB too much."""
 
+# Standard library
+import threading
+import time
+
 # Third party
 from django.conf import settings
 from django.core.cache import cache
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 
 # Mass Migration
 from massmigration.models import MigrationRecord
@@ -11,35 +15,125 @@ from massmigration.models import MigrationRecord
 
 DEFAULT_CACHE_TIMEOUT = 60
 
+# How long the flag which marks an attempt as cancelled is kept. Tasks which are still queued after
+# this fall back to checking the (cached) record.
+CANCELLED_FLAG_TIMEOUT = 24 * 60 * 60
+
+# Per-process locks which ensure that only one thread refreshes a given cache key at a time. Cache
+# keys share a fixed pool of locks (rather than having one each) so that the pool can't grow.
+# Two keys which share a lock just refresh one after the other.
+REFRESH_LOCK_COUNT = 64
+_refresh_locks = [threading.Lock() for _ in range(REFRESH_LOCK_COUNT)]
+
 
 def get_record(key, db_alias):
     """ Get the MigrationRecord for the given key. This is designed to be called heavily, i.e. for
         every object in a MapperMigration, so the result is cached with a best-effort attempt to
         refresh that cache when the record changes, but with no guarantee of it.
+
+        The absence of a record is cached too (as a tombstone), so that stale tasks from a deleted
+        migration don't all query the DB. Once an entry has expired, only one caller per process
+        refreshes it; any other callers get the stale value in the meantime.
     """
     cache_key = get_cache_key(key, db_alias)
-    record = cache.get(cache_key)
-    if not record:
+    entry = _get_entry(cache_key)
+    lock = _get_refresh_lock(cache_key)
+    if entry:
+        record, fresh_until = entry
+        if fresh_until > time.time():
+            return record
+        if not lock.acquire(blocking=False):
+            # Another thread is already refreshing it
+            return record
+    else:
+        # With nothing to fall back on we have to wait, but another thread may have populated the
+        # cache while we were waiting
+        lock.acquire()
+        entry = _get_entry(cache_key)
+        if entry and entry[1] > time.time():
+            lock.release()
+            return entry[0]
+    try:
         record = MigrationRecord.objects.using(db_alias).filter(key=key).first()
-        cache.set(cache_key, record, cache_timeout())
+        _set_entry(cache_key, record)
+    finally:
+        lock.release()
+    return record
+
+
+def refresh_record(key, db_alias):
+    """ Re-fetch the MigrationRecord from the DB and update the cache. This is for when the record
+        has been changed via a queryset `update()`, which doesn't trigger the `post_save` signal.
+    """
+    record = MigrationRecord.objects.using(db_alias).filter(key=key).first()
+    _set_entry(get_cache_key(key, db_alias), record)
     return record
 
 
+def cancel_attempt(attempt_uuid):
+    """ Flag the given attempt as cancelled, so that its tasks stop at their next chunk. Unlike the
+        cached record, this flag is never refreshed, so it can't be overwritten by a refresh which
+        read the record just before it was deleted.
+    """
+    cache.set(get_cancelled_cache_key(attempt_uuid), True, CANCELLED_FLAG_TIMEOUT)
+
+
+def attempt_is_cancelled(attempt_uuid):
+    """ Whether the given attempt has been cancelled, i.e. its record has been deleted. This is a
+        single cache lookup, so it's cheap enough to call for every chunk of every task.
+    """
+    return bool(attempt_uuid and cache.get(get_cancelled_cache_key(attempt_uuid)))
+
+
 def get_cache_key(migration_key, db_alias):
     return f"massmigration_record:{migration_key}:{db_alias}"
 
 
+def get_cancelled_cache_key(attempt_uuid):
+    return f"massmigration_cancelled:{attempt_uuid}"
+
+
 def cache_timeout():
     return getattr(settings, "MASSMIGRATION_RECORD_CACHE_TIMEOUT", DEFAULT_CACHE_TIMEOUT)
 
 
+def _get_entry(cache_key):
+    """ Return the (record, fresh_until) pair from the cache, or None if there's no entry. A record
+        of None is a tombstone, meaning that the record is known not to exist.
+    """
+    entry = cache.get(cache_key)
+    if not isinstance(entry, tuple):
+        # Either a cache miss or a value cached by an older version of this module
+        return None
+    return entry
+
+
+def _set_entry(cache_key, record):
+    timeout = cache_timeout()
+    # The entry is kept for twice the timeout so that it can be served stale while it's refreshed
+    cache.set(cache_key, (record, time.time() + timeout), timeout * 2)
+
+
+def _get_refresh_lock(cache_key):
+    return _refresh_locks[hash(cache_key) % REFRESH_LOCK_COUNT]
+
+
 def record_post_save(sender, **kwargs):
     """ Update the cache when a MigrationRecord is changed (the relevant scenarios being when it's
         marked as started, marked as errored or marked as finished).
     """
     record = kwargs["instance"]
-    cache_key = get_cache_key(record.key, record._state.db)
-    cache.set(cache_key, record, cache_timeout())
+    _set_entry(get_cache_key(record.key, record._state.db), record)
+
+
+def record_post_delete(sender, **kwargs):
+    """ Store a tombstone in the cache when a MigrationRecord is deleted, and flag its attempt as
+        cancelled, so that any tasks from the deleted attempt stop without needing to query the DB.
+    """
+    record = kwargs["instance"]
+    cancel_attempt(record.attempt_uuid)
+    _set_entry(get_cache_key(record.key, record._state.db), None)
 
 
 post_save.connect(record_post_save, sender=MigrationRecord)
+post_delete.connect(record_post_delete, sender=MigrationRecord)
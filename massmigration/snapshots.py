@@ -0,0 +1,157 @@
+""" Snapshots of the values of objects from before a mapper migration changed them, so that the
+    migration can be rolled back by writing those values back.
+    See `MapperMigration.snapshot_fields` and `RestoreSnapshotMigration`.
+"""
+
+# Standard library
+import gzip
+import json
+import logging
+
+# Third party
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+# Mass Migration
+from .models import MigrationSnapshot, MigrationTask
+
+logger = logging.getLogger(__name__)
+
+
+# The number of objects updated per query when restoring a snapshot
+RESTORE_BATCH_SIZE = 500
+
+
+def get_snapshot_storage():
+    """ The storage which snapshot files are kept in. This is an instance of the storage class given
+        by `settings.MASSMIGRATION_SNAPSHOT_STORAGE` if it's set, otherwise Django's default storage.
+    """
+    storage_class = getattr(settings, "MASSMIGRATION_SNAPSHOT_STORAGE", None)
+    return import_string(storage_class)() if storage_class else default_storage
+
+
+def write_snapshot(migration, task, objects, refetch=False, skip_pks=None):
+    """ Store the current values of the migration's `snapshot_fields` for the given objects, which
+        are one chunk of the given task, as one compressed file. If the task is being retried part
+        way through the chunk, then the chunk's objects which are in its earlier snapshot are left
+        out, as they may already have been changed. So are any whose (JSON) PKs are in `skip_pks`.
+        If `refetch` is True (e.g. because the objects were read from a replica, which may be
+        behind), the values are re-fetched from the task's DB rather than taken from the objects.
+        Objects which no longer exist there are left out.
+    """
+    db_alias = task._state.db
+    storage = get_snapshot_storage()
+    prefix = "/".join([
+        _get_attempt_prefix(migration.key, task.attempt_uuid),
+        f"{task.phase.lower()}-{task.pk}-{task.objects_processed}",
+    ])
+    previous = MigrationSnapshot.objects.using(db_alias).filter(path__startswith=f"{prefix}.")
+    snapshotted_pks = set(skip_pks or ())
+    for snapshot in previous:
+        snapshotted_pks.update(row["pk"] for row in read_snapshot(snapshot.path, storage))
+    fields = [objects[0]._meta.get_field(name) for name in migration.snapshot_fields] if objects else []
+    if refetch and objects:
+        queryset = type(objects[0])._base_manager.using(db_alias).only(*migration.snapshot_fields)
+        current = queryset.in_bulk([obj.pk for obj in objects])
+        objects = [current[obj.pk] for obj in objects if obj.pk in current]
+    rows = [
+        {"pk": obj.pk, "fields": {field.attname: getattr(obj, field.attname) for field in fields}}
+        for obj in objects
+    ]
+    # Compare the PKs as they are once they've been through JSON, e.g. UUIDs become strings
+    rows = [row for row in rows if _to_json(row["pk"]) not in snapshotted_pks]
+    if not rows:
+        return None
+    content = "".join(json.dumps(row, cls=DjangoJSONEncoder) + "\n" for row in rows)
+    suffix = f".{len(previous)}" if previous else ""
+    path = storage.save(f"{prefix}{suffix}.jsonl.gz", ContentFile(gzip.compress(content.encode())))
+    return MigrationSnapshot.objects.using(db_alias).create(
+        key=migration.key,
+        attempt_uuid=task.attempt_uuid,
+        model=objects[0]._meta.label,
+        path=path,
+        object_count=len(rows),
+    )
+
+
+def get_processing_snapshot_pks(migration, task):
+    """ Return the (JSON) PKs of the objects in the snapshots which the processing phase of the
+        given verification task's attempt took of its key range. The verification phase mustn't
+        snapshot these objects again, as the processing phase may already have changed them, and
+        their snapshots would be restored in no particular order.
+    """
+    db_alias = task._state.db
+    storage = get_snapshot_storage()
+    attempt_prefix = _get_attempt_prefix(migration.key, task.attempt_uuid)
+    # Each verification task covers the same key range as one (possibly split) processing task
+    process_tasks = MigrationTask.objects.using(db_alias).filter(
+        attempt_uuid=task.attempt_uuid, phase=MigrationTask.Phase.PROCESS
+    ).values_list("pk", "lower_bound", "upper_bound")
+    pks = set()
+    for task_pk, lower, upper in process_tasks:
+        if (lower, upper) != (task.lower_bound, task.upper_bound):
+            continue
+        paths = MigrationSnapshot.objects.using(db_alias).filter(
+            path__startswith=f"{attempt_prefix}/process-{task_pk}-"
+        ).values_list("path", flat=True)
+        for path in paths:
+            pks.update(row["pk"] for row in read_snapshot(path, storage))
+    return pks
+
+
+def read_snapshot(path, storage=None):
+    """ Return the rows of the given snapshot file, each being a dict of the object's `pk` and its
+        `fields`, a dict of field attnames to JSON values.
+    """
+    storage = storage or get_snapshot_storage()
+    with storage.open(path, "rb") as file:
+        content = gzip.decompress(file.read()).decode()
+    return [json.loads(line) for line in content.splitlines() if line]
+
+
+def restore_snapshot(snapshot, db_alias):
+    """ Write the values in the given MigrationSnapshot back to its objects, with `bulk_update`.
+        Objects which have since been deleted are ignored. Returns the number of objects updated.
+    """
+    model = apps.get_model(snapshot.model)
+    rows = read_snapshot(snapshot.path)
+    if not rows:
+        return 0
+    fields = [model._meta.get_field(attname) for attname in rows[0]["fields"]]
+    objects = []
+    for row in rows:
+        obj = model(pk=model._meta.pk.to_python(row["pk"]))
+        for field in fields:
+            setattr(obj, field.attname, field.to_python(row["fields"][field.attname]))
+        objects.append(obj)
+    updated = model._default_manager.using(db_alias).bulk_update(
+        objects, [field.name for field in fields], batch_size=RESTORE_BATCH_SIZE
+    )
+    logger.info("Restored %s objects from snapshot %s.", len(objects), snapshot.path)
+    # Django < 4.0 returns None
+    return updated if updated is not None else len(objects)
+
+
+def delete_snapshots(key, db_alias, attempt_uuid=None):
+    """ Delete the snapshot files (and their MigrationSnapshots) of the given migration, optionally
+        only those of the given attempt.
+    """
+    storage = get_snapshot_storage()
+    snapshots = MigrationSnapshot.objects.using(db_alias).filter(key=key)
+    if attempt_uuid:
+        snapshots = snapshots.filter(attempt_uuid=attempt_uuid)
+    for path in snapshots.values_list("path", flat=True):
+        storage.delete(path)
+    snapshots.delete()
+
+
+def _get_attempt_prefix(key, attempt_uuid):
+    return "/".join(["massmigration", "snapshots", key.replace(":", "/"), str(attempt_uuid)])
+
+
+def _to_json(value):
+    return json.loads(json.dumps(value, cls=DjangoJSONEncoder))
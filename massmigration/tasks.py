@@ -0,0 +1,603 @@
+""" Utilities for processing MigrationTask objects. These are shared by the backends which track the
+    work of a migration themselves (as MigrationTasks), rather than leaving it to a task queue library.
+"""
+
+# Standard library
+import logging
+import time
+
+# Third party
+from django.conf import settings
+from django.db import reset_queries
+from django.utils import timezone
+
+# Mass Migration
+from . import record_cache
+from .exceptions import VerificationFailed
+from .loader import store
+from .migrations import ChunkedMigration
+from .models import MigrationRecord, MigrationTask
+from .snapshots import get_processing_snapshot_pks, write_snapshot
+from .utils.key_ranges import filter_key_range, get_split_point, iterate_in_chunks
+from .utils.memory import get_memory_usage
+from .utils.processed import ProcessedSet
+from .utils.replication import get_replication_lag
+from .utils.transaction import get_transaction
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_MIN_CHUNK_SIZE = 10
+DEFAULT_MAX_CHUNK_SIZE = 10000
+DEFAULT_SHARD_COUNT = 10
+DEFAULT_MIN_SPLIT_SIZE = 1000
+DEFAULT_PAUSED_TASK_DELAY = 60
+
+
+def get_shard_count(migration):
+    """ The number of tasks to split the given migration's queryset into. """
+    return migration.get_backend_params().get(
+        "shard_count", getattr(settings, "MASSMIGRATION_SHARD_COUNT", DEFAULT_SHARD_COUNT)
+    )
+
+
+def get_paused_task_delay():
+    """ The number of seconds for which the tasks of a paused migration (or of one whose replica is
+        lagging) wait before checking again.
+    """
+    return getattr(settings, "MASSMIGRATION_PAUSED_TASK_DELAY", DEFAULT_PAUSED_TASK_DELAY)
+
+
+def migration_is_paused(task):
+    """ Whether the migration which the task belongs to is paused. This uses the record cache, which
+        is updated when a migration is paused or resumed.
+    """
+    record = record_cache.get_record(task.key, task._state.db)
+    return bool(record and record.is_paused)
+
+
+def replica_is_lagging(task):
+    """ Whether the replica which the task's migration reads from is further behind its primary
+        than the migration's `max_replication_lag` allows.
+    """
+    migration = store.by_key.get(task.key)
+    max_lag = getattr(migration, "max_replication_lag", None)
+    if not max_lag:
+        return False
+    read_db_alias = migration.get_read_db_alias(task._state.db)
+    lag = get_replication_lag(read_db_alias)
+    if lag is not None and lag > max_lag:
+        logger.warning(
+            "DB %s is %.1f seconds behind its primary, which is more than migration %s allows.",
+            read_db_alias, lag, task.key,
+        )
+        return True
+    return False
+
+
+def task_must_wait(task):
+    """ Whether the task should be put back to be continued after a delay, because its migration is
+        paused or because the replica which it reads from is lagging too far behind.
+    """
+    return migration_is_paused(task) or replica_is_lagging(task)
+
+
+def attempt_is_cancelled(task):
+    """ Whether the task's migration attempt has been cancelled (see `record_cache.cancel_attempt`).
+        This is checked for every chunk, so that stale tasks stop within a chunk of a migration's
+        record being deleted, rather than once the cached record expires.
+    """
+    if record_cache.attempt_is_cancelled(task.attempt_uuid):
+        logger.warning(
+            "Attempt %s of migration %s has been cancelled. Dropping task %s.",
+            task.attempt_uuid, task.key, task.pk,
+        )
+        return True
+    return False
+
+
+class ChunkSizer:
+    """ Chooses the number of objects for a mapper task to process in each chunk. By default this is
+        the fixed `chunk_size` from the backend params, but if `target_chunk_seconds` is set, then
+        the time taken per object is measured and each chunk is sized to take roughly that long.
+    """
+
+    def __init__(self, migration, task):
+        params = migration.get_backend_params()
+        self.migration = migration
+        self.task = task
+        self.chunk_size = params.get("chunk_size", DEFAULT_CHUNK_SIZE)
+        self.target_seconds = params.get("target_chunk_seconds")
+        self.min_size = params.get("min_chunk_size", DEFAULT_MIN_CHUNK_SIZE)
+        self.max_size = params.get("max_chunk_size", DEFAULT_MAX_CHUNK_SIZE)
+        self.seconds_per_object = task.seconds_per_object
+        if self.target_seconds and self.seconds_per_object is None:
+            # Start from the rate learned by previous tasks of the migration, if there is one
+            record = record_cache.get_record(task.key, task._state.db)
+            self.seconds_per_object = record and record.seconds_per_object
+        self._measured = False
+
+    def next_size(self):
+        if not self.target_seconds:
+            return self.chunk_size
+        if not self.seconds_per_object:
+            return self.min_size
+        size = int(self.target_seconds / self.seconds_per_object)
+        return max(self.min_size, min(self.max_size, size))
+
+    def record(self, object_count, seconds):
+        """ Record that processing the given number of objects took the given number of seconds. """
+        rate = seconds / object_count
+        if self.seconds_per_object is None:
+            self.seconds_per_object = rate
+        else:
+            # Smooth out the variations between chunks
+            self.seconds_per_object = (self.seconds_per_object + rate) / 2
+        self._measured = True
+
+    def store_learned_rate(self, db_alias):
+        """ Store the measured rate on the MigrationRecord so that later tasks can start from it. """
+        if self.target_seconds and self._measured:
+            MigrationRecord.objects.using(db_alias).filter(
+                key=self.task.key, attempt_uuid=self.task.attempt_uuid
+            ).update(seconds_per_object=self.seconds_per_object)
+            # Later tasks read the rate from the record cache
+            record_cache.refresh_record(self.task.key, db_alias)
+
+
+class TaskSplitter:
+    """ Splits off the upper half of a task's remaining key range into a new task each time the task
+        has been running for `split_after_seconds` (from the backend params), so that one densely
+        populated or slow range doesn't leave a single task running long after the others are done.
+        Ranges with fewer than `min_split_size` objects remaining are not split.
+    """
+
+    def __init__(self, migration, task, on_split=None):
+        params = migration.get_backend_params()
+        self.migration = migration
+        self.task = task
+        self.on_split = on_split
+        self.split_after = params.get("split_after_seconds")
+        self.min_size = params.get("min_split_size", DEFAULT_MIN_SPLIT_SIZE)
+        self.started = time.monotonic()
+
+    def maybe_split(self):
+        """ Split the task if it's due. Returns True if its range was narrowed. """
+        if not self.split_after or time.monotonic() - self.started < self.split_after:
+            return False
+        # Whether or not the range can be split, don't check again until the next period
+        self.started = time.monotonic()
+        return split_task(self.task, self.migration, self.min_size, self.on_split) is not None
+
+
+def split_task(task, migration, min_size=DEFAULT_MIN_SPLIT_SIZE, on_split=None):
+    """ Narrow the given running task's range to the lower half of its remaining objects, and create
+        and return a new task for the upper half. `on_split(new_task)` is called inside the same
+        transaction, so that the backend can queue the new task. Returns None if the remaining
+        range is too small to split, or if the task is no longer running on the same worker.
+        The new task is added to the record's `outstanding_tasks` count before this one can
+        complete, so the migration still only gets marked as finished once all of the tasks are done.
+    """
+    db_alias = task._state.db
+    queryset = migration.get_task_queryset(db_alias)
+    split_point = get_split_point(queryset, task.lower_bound, task.upper_bound, task.cursor, min_size)
+    if split_point is None:
+        return None
+    with get_transaction(db_alias).atomic(using=db_alias):
+        narrowed = MigrationTask.objects.using(db_alias).filter(
+            pk=task.pk, worker=task.worker, status=MigrationTask.Status.RUNNING
+        ).update(upper_bound=split_point)
+        if not narrowed:
+            return None
+        new_task = MigrationTask.objects.using(db_alias).create(
+            key=task.key,
+            attempt_uuid=task.attempt_uuid,
+            backend_method=task.backend_method,
+            lower_bound=split_point,
+            upper_bound=task.upper_bound,
+            seconds_per_object=task.seconds_per_object,
+        )
+        record = get_locked_record(db_alias, task.key, task.attempt_uuid)
+        if record:
+            record.outstanding_tasks += 1
+            record.save(update_fields=["outstanding_tasks"])
+        if on_split:
+            on_split(new_task)
+    logger.info(
+        "Split task %s for migration %s at pk %r. The rest of its range is in task %s.",
+        task.pk, task.key, split_point, new_task.pk,
+    )
+    task.upper_bound = split_point
+    return new_task
+
+
+def create_tasks(migration, db_alias, attempt_uuid, key_ranges, worker=""):
+    """ Create and return a MigrationTask for each of the given key ranges. This must be called
+        inside the same transaction which marks the migration as started.
+    """
+    tasks = [
+        MigrationTask.objects.using(db_alias).create(
+            key=migration.key,
+            attempt_uuid=attempt_uuid,
+            backend_method=migration.backend_method,
+            lower_bound=lower,
+            upper_bound=upper,
+            worker=worker,
+        )
+        for lower, upper in key_ranges
+    ]
+    record = get_locked_record(db_alias, migration.key, attempt_uuid)
+    record.outstanding_tasks = len(tasks)
+    record.save(update_fields=["outstanding_tasks"])
+    return tasks
+
+
+def get_locked_record(db_alias, key, attempt_uuid):
+    """ Return the migration's MigrationRecord, locked for update, or None if it no longer belongs
+        to the given attempt. This must be called inside a transaction. The record is fetched by its
+        PK, so on Datastore and Firestore (which don't lock rows) the transaction fails if another
+        one changes the record first. This makes its `outstanding_tasks` count safe to update,
+        whereas the result of a query for the attempt's outstanding tasks wouldn't be.
+    """
+    record = MigrationRecord.objects.using(db_alias).select_for_update().filter(pk=key).first()
+    if record and record.attempt_uuid == attempt_uuid:
+        return record
+    return None
+
+
+def record_memory_usage(task):
+    """ Free what memory we can after processing a chunk, and update the task's peak memory usage. """
+    # When DEBUG is on, Django keeps a log of every query, which would grow for the whole task
+    reset_queries()
+    task.peak_memory = max(task.peak_memory or 0, get_memory_usage())
+
+
+def run_task(task, on_progress, on_split=None, deadline=None):
+    """ Perform the work of the given task. For tasks which process a range of objects,
+        `on_progress(task)` is called after each chunk, once `task.cursor`, `task.objects_processed`
+        and `task.peak_memory` have been updated. If it returns False, processing stops.
+        If the task's range gets split (see `TaskSplitter`), `on_split(new_task)` is called so that
+        the backend can queue the new task. Returns True if the task's work was completed.
+        If a `deadline` (a `time.monotonic()` value) is given, mapper tasks which reach it stop
+        part way through their chunk, after the last object they processed, and call `on_progress`
+        with the cursor at that object, so that the backend can continue the task from there.
+    """
+    db_alias = task._state.db
+    migration = store.by_key.get(task.key)
+    if not migration:
+        logger.error("Migration %s for task %s not found. Abandoning task.", task.key, task.pk)
+        return True
+
+    if task.backend_method == "run_simple":
+        migration.wrapped_operation(db_alias, task.attempt_uuid)
+        return True
+
+    # Drop tasks from deleted or replaced attempts before evaluating any querysets
+    if attempt_is_cancelled(task) or not migration.attempt_is_current(task.attempt_uuid, db_alias):
+        return True
+
+    if task.phase == MigrationTask.Phase.VERIFY:
+        return _run_verify_task(task, migration, on_progress, deadline)
+
+    # When the task's range is split, iteration is restarted over the narrowed range
+    splitter = TaskSplitter(migration, task, on_split)
+
+    if task.backend_method == "run_mapper":
+        sizer = ChunkSizer(migration, task)
+        read_db_alias = migration.get_read_db_alias(db_alias)
+        task_queryset = migration.get_task_queryset(db_alias)
+        primary_queryset = None
+        if read_db_alias != db_alias and migration.refetch_from_primary:
+            primary_queryset = migration.get_task_queryset(db_alias, db_alias)
+        processed = None
+        if migration.skip_processed_objects:
+            processed = ProcessedSet(task.key, task.attempt_uuid, task_queryset.model)
+        try:
+            while True:
+                queryset = filter_key_range(task_queryset, task.lower_bound, task.upper_bound)
+                chunk_started = time.monotonic()
+                for chunk in iterate_in_chunks(queryset, sizer.next_size, after=task.cursor):
+                    if attempt_is_cancelled(task):
+                        return True
+                    objects = processed.filter_unprocessed(chunk) if processed else chunk
+                    if read_db_alias != db_alias:
+                        objects = _switch_to_primary(migration, objects, db_alias, primary_queryset)
+                    if migration.snapshot_fields:
+                        # Objects which weren't re-fetched from the primary may have stale values
+                        refetch = read_db_alias != db_alias and not migration.refetch_from_primary
+                        write_snapshot(migration, task, objects, refetch=refetch)
+                    done = _map_objects(migration, objects, task, processed, deadline)
+                    if done is None:
+                        return True
+                    finished_chunk = _advance_cursor(task, chunk, objects, done)
+                    if finished_chunk:
+                        sizer.record(len(chunk), time.monotonic() - chunk_started)
+                        task.seconds_per_object = sizer.seconds_per_object
+                    record_memory_usage(task)
+                    if not on_progress(task):
+                        return False
+                    # If the deadline stopped it part way through the chunk, continue from the cursor
+                    if not finished_chunk or splitter.maybe_split():
+                        break
+                    chunk_started = time.monotonic()
+                else:
+                    return True
+        finally:
+            sizer.store_learned_rate(db_alias)
+
+    if isinstance(migration, ChunkedMigration):
+        while True:
+            for cursor, rows_processed in migration.wrapped_chunks(
+                task.attempt_uuid, db_alias, task.lower_bound, task.upper_bound, after=task.cursor
+            ):
+                task.cursor = cursor
+                task.objects_processed += rows_processed
+                record_memory_usage(task)
+                if not on_progress(task):
+                    return False
+                if attempt_is_cancelled(task):
+                    return True
+                if splitter.maybe_split():
+                    break
+            else:
+                return True
+
+    raise NotImplementedError(f"Backend method '{task.backend_method}' is not supported.")
+
+
+def _switch_to_primary(migration, objects, db_alias, queryset=None):
+    """ Switch objects which were read from a replica to the given (primary) DB, so that saving them
+        writes to it, or if the migration's `refetch_from_primary` is set, re-fetch them from it
+        using `queryset` (by default, the migration's queryset on that DB). Re-fetched objects
+        which no longer exist (or no longer match the queryset) are dropped.
+    """
+    if migration.refetch_from_primary:
+        if queryset is None:
+            queryset = migration.get_task_queryset(db_alias, db_alias)
+        objects_by_pk = queryset.in_bulk([obj.pk for obj in objects])
+        return [objects_by_pk[obj.pk] for obj in objects if obj.pk in objects_by_pk]
+    for obj in objects:
+        obj._state.db = db_alias
+    return objects
+
+
+def _map_objects(migration, objects, task, processed=None, deadline=None):
+    """ Call the mapper migration's operation on each of the objects, in batches of
+        `objects_per_transaction` objects per transaction if that's set. Successfully processed
+        objects are added to the `processed` ProcessedSet (if given) once they've been committed,
+        which is written to the cache after each batch (or `WRITE_BATCH_SIZE` objects) and when
+        this returns.
+        Their results (see `MapperMigration.map_result`) are aggregated into `task.partial_result`,
+        which is saved along with the task's cursor.
+        If the `deadline` is reached, this stops before the next object (or batch). Returns the
+        number of the objects which were processed, or None if aggregating their results failed, in
+        which case the migration has been marked as errored and the task should stop.
+    """
+    db_alias = task._state.db
+    batch_size = migration.objects_per_transaction or 1
+
+    def on_retry():
+        task.operation_retries += 1
+
+    try:
+        for start in range(0, len(objects), batch_size):
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.info(
+                    "Task %s for migration %s reached its deadline after %s of %s objects in its chunk.",
+                    task.pk, task.key, start, len(objects),
+                )
+                return start
+            batch = objects[start:start + batch_size]
+            if migration.objects_per_transaction:
+                succeeded = migration.wrapped_batch(batch, task.attempt_uuid, db_alias, on_retry)
+            else:
+                succeeded = [
+                    instance for instance in batch
+                    if migration.wrapped_operation(instance, task.attempt_uuid, db_alias, on_retry)
+                ]
+            if processed:
+                for instance in succeeded:
+                    processed.add(instance.pk)
+                if migration.objects_per_transaction:
+                    processed.flush()
+            if not _aggregate_results(migration, task, succeeded):
+                return None
+        return len(objects)
+    finally:
+        if processed:
+            processed.flush()
+
+
+def _aggregate_results(migration, task, objects):
+    """ Aggregate the results of the given (processed) objects into `task.partial_result`. Returns
+        False if `map_result` or `reduce` raised an error, in which case the migration is marked as
+        errored.
+    """
+    try:
+        results = [migration.map_result(instance) for instance in objects]
+        results = [result for result in results if result is not None]
+        if results:
+            partials = [] if task.partial_result is None else [task.partial_result]
+            task.partial_result = migration.reduce(partials + results)
+    except Exception as error:
+        logger.exception("Error aggregating the results of migration %s in task %s.", migration.key, task.pk)
+        migration.mark_as_errored(task._state.db, error, task.attempt_uuid)
+        return False
+    return True
+
+
+def _advance_cursor(task, chunk, objects, done):
+    """ Move the task's cursor past the objects of the chunk which have been dealt with, given that
+        the first `done` of `objects` (those of the chunk which were processed) were processed.
+        Returns True if the whole chunk was dealt with.
+    """
+    if done == len(objects):
+        task.cursor = chunk[-1].pk
+        task.objects_processed += len(chunk)
+        return True
+    if done:
+        task.cursor = objects[done - 1].pk
+        task.objects_processed += sum(1 for obj in chunk if obj.pk <= task.cursor)
+    return False
+
+
+def _run_verify_task(task, migration, on_progress, deadline=None):
+    """ Count the objects in the task's range which still need migrating, re-process them if there
+        are any, and store the number which remain as `task.residual_count`.
+    """
+    db_alias = task._state.db
+
+    def get_residual_queryset():
+        return filter_key_range(migration.verify_queryset(db_alias), task.lower_bound, task.upper_bound)
+
+    residual_count = get_residual_queryset().count()
+    if residual_count:
+        logger.warning(
+            "Verification found %s objects still to be migrated for migration %s in task %s. "
+            "Re-processing them.",
+            residual_count, task.key, task.pk,
+        )
+        chunk_size = migration.get_backend_params().get("chunk_size", DEFAULT_CHUNK_SIZE)
+        # Objects which were snapshotted before the processing phase changed them are left out
+        skip_pks = get_processing_snapshot_pks(migration, task) if migration.snapshot_fields else None
+        while True:
+            for chunk in iterate_in_chunks(get_residual_queryset(), chunk_size, after=task.cursor):
+                if attempt_is_cancelled(task):
+                    return True
+                if migration.snapshot_fields:
+                    write_snapshot(migration, task, chunk, skip_pks=skip_pks)
+                done = _map_objects(migration, chunk, task, deadline=deadline)
+                if done is None:
+                    return True
+                finished_chunk = _advance_cursor(task, chunk, chunk, done)
+                record_memory_usage(task)
+                if not on_progress(task):
+                    return False
+                if not finished_chunk:
+                    break
+            else:
+                break
+        residual_count = get_residual_queryset().count()
+    task.residual_count = residual_count
+    return True
+
+
+def _create_verify_tasks(migration, db_alias, attempt_uuid):
+    """ Create a verification task for each key range which was processed by the given attempt.
+        The caller must update the record's `outstanding_tasks` count.
+    """
+    key_ranges = MigrationTask.objects.using(db_alias).filter(
+        attempt_uuid=attempt_uuid, phase=MigrationTask.Phase.PROCESS
+    ).values_list("lower_bound", "upper_bound")
+    return [
+        MigrationTask.objects.using(db_alias).create(
+            key=migration.key,
+            attempt_uuid=attempt_uuid,
+            backend_method=migration.backend_method,
+            phase=MigrationTask.Phase.VERIFY,
+            lower_bound=lower,
+            upper_bound=upper,
+        )
+        for lower, upper in key_ranges
+    ]
+
+
+def complete_task(task, on_new_tasks=None):
+    """ Mark the task as done and, if it was the last outstanding task of its migration attempt,
+        mark the migration as finished. Only has an effect if the task is still running on the
+        same worker, so that a task which has been taken over by another worker doesn't get
+        completed twice.
+        For mapper migrations with a `verify_queryset`, the last processing task instead creates
+        the verification tasks, and `on_new_tasks(tasks)` is called (inside the transaction) so
+        that the backend can queue them.
+    """
+    db_alias = task._state.db
+    with get_transaction(db_alias).atomic(using=db_alias):
+        completed = MigrationTask.objects.using(db_alias).filter(
+            pk=task.pk, worker=task.worker, status=MigrationTask.Status.RUNNING
+        ).update(
+            status=MigrationTask.Status.DONE,
+            finished_at=timezone.now(),
+            residual_count=task.residual_count,
+            operation_retries=task.operation_retries,
+            partial_result=task.partial_result,
+        )
+        migration = store.by_key.get(task.key)
+        if not (completed and migration and task.attempt_uuid) or task.backend_method == "run_simple":
+            # Simple migrations mark themselves as finished
+            return
+        # Counting down on the locked record (rather than querying for the attempt's other tasks)
+        # ensures that exactly one task sees that it was the last one, on any DB
+        record = get_locked_record(db_alias, task.key, task.attempt_uuid)
+        if not record:
+            logger.warning(
+                "Migration %s no longer has attempt %s. Not marking it as finished.",
+                task.key, task.attempt_uuid,
+            )
+            return
+        record.outstanding_tasks -= 1
+        record.save(update_fields=["outstanding_tasks"])
+        if record.outstanding_tasks > 0:
+            return
+        if record.has_error:
+            logger.warning(
+                "Migration %s (attempt %s) has errored. Not marking it as finished.",
+                task.key, task.attempt_uuid,
+            )
+            return
+        if task.phase == MigrationTask.Phase.PROCESS and _needs_verification(migration, db_alias):
+            verify_tasks = _create_verify_tasks(migration, db_alias, task.attempt_uuid)
+            record.outstanding_tasks = len(verify_tasks)
+            record.save(update_fields=["outstanding_tasks"])
+            logger.info(
+                "Created %s tasks to verify migration %s (attempt %s).",
+                len(verify_tasks), task.key, task.attempt_uuid,
+            )
+            if on_new_tasks:
+                on_new_tasks(verify_tasks)
+            return
+        if task.phase == MigrationTask.Phase.VERIFY:
+            residual_count = sum(
+                count or 0 for count in MigrationTask.objects.using(db_alias).filter(
+                    attempt_uuid=task.attempt_uuid, phase=MigrationTask.Phase.VERIFY
+                ).values_list("residual_count", flat=True)
+            )
+            if residual_count > migration.verify_threshold:
+                migration.mark_as_errored(
+                    db_alias,
+                    VerificationFailed(f"{residual_count} objects still need migrating after verification."),
+                    task.attempt_uuid,
+                )
+                return
+        if not _store_result(migration, db_alias, task.attempt_uuid):
+            return
+        logger.info("Marking migration %s (attempt %s) as finished.", task.key, task.attempt_uuid)
+        migration.mark_as_finished(db_alias)
+
+
+def _store_result(migration, db_alias, attempt_uuid):
+    """ Reduce the partial results of the attempt's tasks (if there are any) into the migration's
+        result, and store it on its record. Returns False if reducing them failed, in which case
+        the migration is marked as errored.
+    """
+    partials = list(MigrationTask.objects.using(db_alias).filter(
+        attempt_uuid=attempt_uuid, partial_result__isnull=False
+    ).values_list("partial_result", flat=True))
+    if not partials:
+        return True
+    try:
+        result = migration.reduce(partials)
+    except Exception as error:
+        logger.exception("Error reducing the results of migration %s.", migration.key)
+        migration.mark_as_errored(db_alias, error, attempt_uuid)
+        return False
+    MigrationRecord.objects.using(db_alias).filter(
+        key=migration.key, attempt_uuid=attempt_uuid
+    ).update(result=result)
+    return True
+
+
+def _needs_verification(migration, db_alias):
+    verify_queryset = getattr(migration, "verify_queryset", None)
+    return bool(verify_queryset) and verify_queryset(db_alias) is not None
@@ -0,0 +1,49 @@
+from massmigration.migrations import CopyMigration
+
+
+class Migration(CopyMigration):
+    """ YOUR DESCRIPTION HERE. This will appear in the Django admin. """
+
+    # This can be set to make a migration run on a specific backend, rather than the one that's
+    backend: str = None
+    # specified in the Django settings
+
+    # If you need to configure the backend differently for each migration, this is a place for
+    # passing parameters to it.
+    backend_params: dict = {}
+
+    # This can be set to specify the list of database aliases on which the migration can be applied.
+    # The migration is not forced on a specific DB but rather the `db_alias` for the DB is passed to `get_queryset`
+    # allowing to customise what is retrieved by the migration.
+    # If None the migration can be applied to all databases.
+    allowed_db_aliases: list = None
+
+    # The alias of the database to write the new objects to. If None, the same database as the
+    # source queryset is used.
+    target_db_alias: str = None
+
+    # Extra kwargs for `bulk_create`. Use {"ignore_conflicts": True} or {"update_conflicts": True, ...}
+    # so that the migration can be safely re-run.
+    bulk_create_kwargs: dict = {"ignore_conflicts": True}
+
+    # The maximum number of source objects to fetch and insert in each chunk.
+    rows_per_statement: int = 1000
+
+    dependencies = [{% for dependency in dependencies %}
+        ("{{dependency.0}}", "{{dependency.1}}"),{% endfor %}
+    ]
+
+    def get_queryset(self, db_alias):
+
+        # PUT YOUR CODE HERE.
+        # It must return a queryset for the objects which you wish to copy.
+
+        raise NotImplementedError
+
+    def transform(self, rows, db_alias):
+
+        # PUT YOUR CODE HERE.
+        # It should return a list of unsaved model instances to insert, given a list of objects
+        # from the queryset.
+
+        raise NotImplementedError
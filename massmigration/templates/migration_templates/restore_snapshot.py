@@ -0,0 +1,29 @@
+from massmigration.migrations import RestoreSnapshotMigration
+
+
+class Migration(RestoreSnapshotMigration):
+    """ YOUR DESCRIPTION HERE. This will appear in the Django admin. """
+
+    # This can be set to make a migration run on a specific backend, rather than the one that's
+    backend: str = None
+    # specified in the Django settings
+
+    # If you need to configure the backend differently for each migration, this is a place for
+    # passing parameters to it.
+    backend_params: dict = {}
+
+    # This can be set to specify the list of database aliases on which the migration can be applied.
+    # If None the migration can be applied to all databases.
+    allowed_db_aliases: list = None
+
+    # PUT YOUR CODE HERE.
+    # The (app_label, migration_name) of the mapper migration to roll back. It must have `snapshot_fields` set.
+    source_migration: tuple = None
+
+    # The attempt of the source migration to roll back. If None, its most recent snapshotted attempt is used.
+    source_attempt_uuid = None
+
+
+    dependencies = [{% for dependency in dependencies %}
+        ("{{dependency.0}}", "{{dependency.1}}"),{% endfor %}
+    ]
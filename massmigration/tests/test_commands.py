@@ -60,6 +60,9 @@ class MakeMassMigrationTestCase(TestCase):
             ("simple", "SimpleMigration"),
             ("mapper", "MapperMigration"),
             ("custom", "BaseMigration"),
+            ("update", "UpdateMigration"),
+            ("delete", "DeleteMigration"),
+            ("copy", "CopyMigration"),
         ]):
             self.run_command("my_migration", "--template", template)
             file_contents = self.get_migration_file(f"000{index + 1}_my_migration.py")
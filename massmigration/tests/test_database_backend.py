@@ -0,0 +1,706 @@
+# Standard library
+from collections import Counter
+from datetime import timedelta
+from io import StringIO
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+# Third party
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+# Mass Migration
+from massmigration import record_cache
+from massmigration.api import run_incremental_migration
+from massmigration.backends.database import DatabaseBackend
+from massmigration.exceptions import MigrationNotRunning
+from massmigration.loader import store
+from massmigration.migrations import (
+    CopyMigration,
+    DeleteMigration,
+    IncrementalMapperMigration,
+    MapperMigration,
+    RestoreSnapshotMigration,
+    SimpleMigration,
+    UpdateMigration,
+)
+from massmigration.models import MigrationAttempt, MigrationRecord, MigrationSnapshot, MigrationTask
+from massmigration.snapshots import read_snapshot, write_snapshot
+from massmigration.tests.utils import call_without_retrying
+from massmigration.utils.key_ranges import filter_key_range, get_key_ranges, get_split_point
+from testing.models import Item, ItemCopy, ItemNote
+
+
+class IncrementMigration(MapperMigration):
+    """ Test migration which increments the value of every Item. """
+
+    backend = "massmigration.backends.database.DatabaseBackend"
+    backend_params = {"shard_count": 3, "chunk_size": 2}
+
+    def get_queryset(self, db_alias):
+        return Item.objects.using(db_alias)
+
+    def operation(self, obj, db_alias):
+        obj.value += 1
+        obj.save()
+
+
+class VerifiedIncrementMigration(IncrementMigration):
+    """ Test migration which increments the value of every Item, but misses some Items the first
+        time it sees them (or always, if `always_skip` is set), to be caught by verification.
+    """
+
+    always_skip = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.skip_pks = set()
+
+    def verify_queryset(self, db_alias):
+        return Item.objects.using(db_alias).filter(value=0)
+
+    def operation(self, obj, db_alias):
+        if obj.pk in self.skip_pks:
+            if not self.always_skip:
+                self.skip_pks.remove(obj.pk)
+            return
+        super().operation(obj, db_alias)
+
+
+class IncrementalIncrementMigration(IncrementalMapperMigration):
+    """ Test migration which increments the value of every new Item. """
+
+    backend = "massmigration.backends.database.DatabaseBackend"
+    backend_params = {"shard_count": 2, "chunk_size": 2}
+
+    def get_base_queryset(self, db_alias):
+        return Item.objects.using(db_alias)
+
+    def operation(self, obj, db_alias):
+        obj.value += 1
+        obj.save()
+
+
+class UpdatedAtIncrementMigration(IncrementalIncrementMigration):
+    """ Test migration which increments the value of every Item updated since its last run. """
+
+    watermark_field = "updated_at"
+
+    def get_base_queryset(self, db_alias):
+        return Item.objects.using(db_alias).filter(updated_at__isnull=False)
+
+
+class SnapshottedIncrementMigration(IncrementMigration):
+    snapshot_fields = ["value"]
+
+
+class SnapshottedVerifiedMigration(SnapshottedIncrementMigration):
+    """ Test migration whose objects still need migrating after one increment, so that they get
+        processed again by its verification pass.
+    """
+
+    def verify_queryset(self, db_alias):
+        return Item.objects.using(db_alias).filter(value__lt=2)
+
+
+class RestoreIncrementMigration(RestoreSnapshotMigration):
+    backend = "massmigration.backends.database.DatabaseBackend"
+    source_migration = ("testing", "0007_snapshotted")
+
+
+class CountingIncrementMigration(IncrementMigration):
+    """ Test migration which increments every Item and counts the odd and even values it saw. """
+
+    def map_result(self, obj):
+        return {"odd" if obj.value % 2 else "even": 1}
+
+    def reduce(self, partials):
+        totals = Counter()
+        for partial in partials:
+            totals.update(partial)
+        return totals
+
+
+class AddTenMigration(UpdateMigration):
+    """ Test migration which adds 10 to the value of every Item with a value of less than 10. """
+
+    backend = "massmigration.backends.database.DatabaseBackend"
+    backend_params = {"shard_count": 2}
+    rows_per_statement = 3
+    update_kwargs = {"value": F("value") + 10}
+
+    def get_queryset(self, db_alias):
+        return Item.objects.using(db_alias).filter(value__lt=10)
+
+
+class DeleteSmallMigration(DeleteMigration):
+    """ Test migration which deletes every Item with a value of less than 5. """
+
+    backend = "massmigration.backends.database.DatabaseBackend"
+    backend_params = {"shard_count": 2}
+    rows_per_statement = 2
+
+    def get_queryset(self, db_alias):
+        return Item.objects.using(db_alias).filter(value__lt=5)
+
+
+class DeleteSmallNotesMigration(DeleteSmallMigration):
+    """ Test migration which deletes every ItemNote of an Item with a value of less than 5. """
+
+    def get_queryset(self, db_alias):
+        return ItemNote.objects.using(db_alias).filter(item__value__lt=5)
+
+
+class CopyItemsMigration(CopyMigration):
+    """ Test migration which copies every Item into ItemCopy, doubling its value. """
+
+    backend = "massmigration.backends.database.DatabaseBackend"
+    bulk_create_kwargs = {"ignore_conflicts": True}
+    rows_per_statement = 3
+
+    def get_queryset(self, db_alias):
+        return Item.objects.using(db_alias)
+
+    def transform(self, rows, db_alias):
+        return [ItemCopy(source_id=row.pk, value=row.value * 2) for row in rows]
+
+
+class SimpleDatabaseMigration(SimpleMigration):
+    """ Test migration which creates an Item, after waiting for `wait_seconds`. """
+
+    backend = "massmigration.backends.database.DatabaseBackend"
+    wait_seconds = 0
+
+    def operation(self, db_alias):
+        time.sleep(self.wait_seconds)
+        Item.objects.using(db_alias).create(value=1)
+
+
+@mock.patch("djangae.utils.retry", call_without_retrying)
+class DatabaseBackendTestCase(TestCase):
+    """ Tests for the DatabaseBackend and the 'massmigration_worker' command. """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.migration = IncrementMigration("testing", "0001_increment")
+        patcher = mock.patch.dict(store.by_key, {self.migration.key: self.migration})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_worker(self):
+        call_command("massmigration_worker", "--burst", stdout=mock.Mock())
+
+    def test_get_key_ranges_covers_queryset(self):
+        Item.objects.bulk_create([Item() for _ in range(10)])
+        queryset = Item.objects.all()
+        key_ranges = get_key_ranges(queryset, 3)
+        self.assertEqual(len(key_ranges), 3)
+        pks = []
+        for lower, upper in key_ranges:
+            pks.extend(filter_key_range(queryset, lower, upper).values_list("pk", flat=True))
+        self.assertEqual(sorted(pks), sorted(queryset.values_list("pk", flat=True)))
+
+    def test_get_split_point(self):
+        items = Item.objects.bulk_create([Item() for _ in range(10)])
+        queryset = Item.objects.all()
+        split_point = get_split_point(queryset, None, None, after=items[3].pk)
+        self.assertEqual(filter_key_range(queryset, items[4].pk, split_point).count(), 3)
+        self.assertEqual(filter_key_range(queryset, split_point, None).count(), 3)
+        self.assertIsNone(get_split_point(queryset, None, None, after=items[8].pk))
+        self.assertIsNone(get_split_point(queryset, None, None, after=items[3].pk, min_size=7))
+
+    def test_runs_mapper_to_completion(self):
+        Item.objects.bulk_create([Item() for _ in range(10)])
+        self.migration.launch("default")
+        self.assertEqual(MigrationTask.objects.count(), 3)
+        self.assertFalse(MigrationRecord.objects.get(key=self.migration.key).is_applied)
+        self.run_worker()
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        self.assertTrue(MigrationRecord.objects.get(key=self.migration.key).is_applied)
+        self.assertFalse(MigrationTask.objects.exclude(status=MigrationTask.Status.DONE).exists())
+        attempt = MigrationAttempt.objects.get()
+        self.assertEqual(attempt.status, MigrationAttempt.Status.APPLIED)
+        self.assertEqual(attempt.objects_processed, 10)
+        self.assertIsNotNone(attempt.peak_task_seconds)
+
+    def test_splits_long_running_task(self):
+        Item.objects.bulk_create([Item() for _ in range(10)])
+        self.migration.backend_params = {
+            "shard_count": 1, "chunk_size": 2, "split_after_seconds": 0.000001, "min_split_size": 2
+        }
+        self.migration.launch("default")
+        with mock.patch.object(
+            self.migration, "mark_as_finished", wraps=self.migration.mark_as_finished
+        ) as mark_as_finished:
+            self.run_worker()
+        mark_as_finished.assert_called_once()
+        self.assertGreater(MigrationTask.objects.count(), 1)
+        self.assertFalse(MigrationTask.objects.exclude(status=MigrationTask.Status.DONE).exists())
+        self.assertEqual(sum(MigrationTask.objects.values_list("objects_processed", flat=True)), 10)
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        self.assertTrue(MigrationRecord.objects.get(key=self.migration.key).is_applied)
+
+    def run_verified_migration(self, always_skip=False, verify_threshold=0):
+        items = Item.objects.bulk_create([Item() for _ in range(10)])
+        migration = VerifiedIncrementMigration("testing", "0004_verified_increment")
+        migration.always_skip = always_skip
+        migration.verify_threshold = verify_threshold
+        migration.skip_pks = {items[1].pk, items[7].pk}
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            migration.launch("default")
+            self.run_worker()
+        return MigrationRecord.objects.get(key=migration.key)
+
+    def test_verification_reprocesses_residual_objects(self):
+        record = self.run_verified_migration()
+        self.assertTrue(record.is_applied)
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        verify_tasks = MigrationTask.objects.filter(phase=MigrationTask.Phase.VERIFY)
+        self.assertEqual(verify_tasks.count(), 3)
+        self.assertEqual(sum(verify_tasks.values_list("objects_processed", flat=True)), 2)
+        self.assertEqual(set(verify_tasks.values_list("residual_count", flat=True)), {0})
+
+    def test_verification_failure_marks_migration_as_errored(self):
+        record = self.run_verified_migration(always_skip=True)
+        self.assertFalse(record.is_applied)
+        self.assertTrue(record.has_error)
+        self.assertIn("VerificationFailed: 2 objects", record.last_error)
+
+    def test_verification_allows_residual_under_threshold(self):
+        record = self.run_verified_migration(always_skip=True, verify_threshold=2)
+        self.assertTrue(record.is_applied)
+
+    def test_empty_queryset_is_finished(self):
+        self.migration.launch("default")
+        self.run_worker()
+        self.assertTrue(MigrationRecord.objects.get(key=self.migration.key).is_applied)
+
+    def test_reclaims_expired_task_from_cursor(self):
+        items = Item.objects.bulk_create([Item() for _ in range(4)])
+        self.migration.backend_params = {"shard_count": 1}
+        backend = DatabaseBackend()
+        backend.run_mapper(self.migration, "default")
+        # Simulate a worker which processed the first item and then died
+        MigrationTask.objects.update(
+            status=MigrationTask.Status.RUNNING,
+            worker="dead",
+            cursor=items[0].pk,
+            lease_expires_at=timezone.now() - timedelta(seconds=1),
+        )
+        task = backend.claim_task("default", "alive")
+        self.assertEqual(task.worker, "alive")
+        backend.process_task(task)
+        self.assertEqual(Item.objects.get(pk=items[0].pk).value, 0)
+        self.assertEqual(Item.objects.filter(value=1).count(), len(items) - 1)
+
+    def test_simple_task_belongs_to_attempt(self):
+        migration = SimpleDatabaseMigration("testing", "0013_simple")
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            migration.launch("default")
+            record = MigrationRecord.objects.get(key=migration.key)
+            self.assertEqual(MigrationTask.objects.get().attempt_uuid, record.attempt_uuid)
+            self.run_worker()
+        record = MigrationRecord.objects.get(key=migration.key)
+        self.assertTrue(record.is_applied)
+        self.assertEqual(MigrationTask.objects.get().status, MigrationTask.Status.DONE)
+        self.assertEqual(Item.objects.count(), 1)
+
+    def test_abandoned_task_does_not_error_applied_migration(self):
+        migration = SimpleDatabaseMigration("testing", "0013_simple")
+        migration.backend_params = {"max_claims": 1}
+        backend = DatabaseBackend()
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            migration.launch("default")
+            task = backend.claim_task("default", "first", lease_seconds=0)
+            # The first worker finishes the migration, but dies before marking its task as done
+            migration.wrapped_operation("default", task.attempt_uuid)
+            self.assertIsNone(backend.claim_task("default", "second"))
+        record = MigrationRecord.objects.get(key=migration.key)
+        self.assertTrue(record.is_applied)
+        self.assertFalse(record.has_error)
+        self.assertEqual(MigrationTask.objects.get().status, MigrationTask.Status.DONE)
+        self.assertEqual(Item.objects.count(), 1)
+
+    def test_abandons_task_after_max_claims(self):
+        """ A task whose processing keeps failing shouldn't be re-claimed forever. """
+        Item.objects.bulk_create([Item() for _ in range(4)])
+        self.migration.backend_params = {"shard_count": 1, "max_claims": 3}
+        self.migration.launch("default")
+        with mock.patch.object(self.migration, "get_queryset", side_effect=DatabaseError("Gone away")):
+            # With no lease, each failed task can be re-claimed straight away
+            call_command("massmigration_worker", "--burst", "--lease-seconds=0", stdout=mock.Mock())
+        task = MigrationTask.objects.get()
+        self.assertEqual(task.status, MigrationTask.Status.DONE)
+        self.assertEqual(task.claim_count, 3)
+        record = MigrationRecord.objects.get(key=self.migration.key)
+        self.assertTrue(record.has_error)
+        self.assertIn("TaskClaimLimitExceeded", record.last_error)
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {0})
+
+    @override_settings(MASSMIGRATION_MEMORY_LIMIT_MB=1)
+    def test_releases_task_when_memory_limit_reached(self):
+        Item.objects.bulk_create([Item() for _ in range(4)])
+        self.migration.backend_params = {"shard_count": 1, "chunk_size": 2}
+        self.migration.launch("default")
+        stdout = StringIO()
+        call_command("massmigration_worker", "--burst", stdout=stdout)
+        self.assertIn("Memory limit reached", stdout.getvalue())
+        # The worker stopped after the first chunk and put the task back for another worker
+        task = MigrationTask.objects.get()
+        self.assertEqual(task.status, MigrationTask.Status.PENDING)
+        self.assertEqual(task.worker, "")
+        self.assertEqual(task.objects_processed, 2)
+        self.assertGreater(task.peak_memory, 1024 * 1024)
+        with override_settings(MASSMIGRATION_MEMORY_LIMIT_MB=None):
+            self.run_worker()
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        self.assertTrue(MigrationRecord.objects.get(key=self.migration.key).is_applied)
+
+    @mock.patch("djangae.utils.retry", call_without_retrying)
+    def test_pause_and_resume(self):
+        Item.objects.bulk_create([Item() for _ in range(4)])
+        self.migration.backend_params = {"shard_count": 1, "chunk_size": 2}
+        self.migration.launch("default")
+        backend = DatabaseBackend()
+        task = backend.claim_task("default", "worker")
+        self.migration.pause("default")
+        self.assertEqual(MigrationRecord.objects.get().status(), MigrationRecord.Status.PAUSED)
+        # The task is put back, to be checked again later
+        backend.process_task(task)
+        task.refresh_from_db()
+        self.assertEqual(task.status, MigrationTask.Status.PENDING)
+        self.assertGreater(task.available_at, timezone.now())
+        self.assertIsNone(backend.claim_task("default", "worker"))
+        self.assertEqual(Item.objects.filter(value=1).count(), 0)
+        self.migration.resume("default")
+        record = MigrationRecord.objects.get()
+        self.run_worker()
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        # It's the same attempt
+        self.assertEqual(MigrationRecord.objects.get().attempt_uuid, record.attempt_uuid)
+        self.assertTrue(MigrationRecord.objects.get().is_applied)
+
+    def test_deleted_attempt_stops_at_next_chunk(self):
+        Item.objects.bulk_create([Item() for _ in range(6)])
+        self.migration.backend_params = {"shard_count": 1, "chunk_size": 2}
+        self.migration.launch("default")
+        record = MigrationRecord.objects.get()
+        backend = DatabaseBackend()
+        task = backend.claim_task("default", "worker")
+        original_on_progress = backend._on_progress
+
+        def on_progress(task, lease_seconds):
+            record.delete()
+            # Simulate a refresh which read the record just before it was deleted
+            record_cache._set_entry(record_cache.get_cache_key(record.key, "default"), record)
+            return original_on_progress(task, lease_seconds)
+
+        with mock.patch.object(backend, "_on_progress", side_effect=on_progress):
+            backend.process_task(task)
+        self.assertEqual(Item.objects.filter(value=1).count(), 2)
+        self.assertEqual(MigrationTask.objects.get().status, MigrationTask.Status.DONE)
+
+    def test_stale_task_is_dropped_when_claimed(self):
+        Item.objects.bulk_create([Item() for _ in range(4)])
+        self.migration.launch("default")
+        MigrationRecord.objects.get().delete()
+        with mock.patch.object(IncrementMigration, "get_queryset") as get_queryset:
+            self.run_worker()
+        get_queryset.assert_not_called()
+        self.assertFalse(MigrationTask.objects.exclude(status=MigrationTask.Status.DONE).exists())
+        self.assertEqual(Item.objects.filter(value=1).count(), 0)
+
+    def test_waits_for_lagging_replica(self):
+        Item.objects.bulk_create([Item() for _ in range(4)])
+        self.migration.backend_params = {"shard_count": 1, "chunk_size": 2}
+        self.migration.read_db_alias = "default"
+        self.migration.max_replication_lag = 5
+        self.migration.launch("default")
+        backend = DatabaseBackend()
+        with mock.patch("massmigration.tasks.get_replication_lag", return_value=10):
+            backend.process_task(backend.claim_task("default", "worker"))
+        task = MigrationTask.objects.get()
+        self.assertEqual(task.status, MigrationTask.Status.PENDING)
+        self.assertGreater(task.available_at, timezone.now())
+        self.assertEqual(Item.objects.filter(value=1).count(), 0)
+        MigrationTask.objects.update(available_at=None)
+        with mock.patch("massmigration.tasks.get_replication_lag", return_value=1):
+            self.run_worker()
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+
+    def test_incremental_migration_keeps_datetime_watermark_precision(self):
+        migration = UpdatedAtIncrementMigration("testing", "0012_updated_at")
+        base = timezone.now().replace(microsecond=0)
+        Item.objects.bulk_create([
+            Item(updated_at=base + timedelta(microseconds=123000)),
+            Item(updated_at=base + timedelta(microseconds=123456)),
+        ])
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            self.assertTrue(run_incremental_migration(migration, "default"))
+            self.run_worker()
+            self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+            self.assertFalse(migration.has_new_objects("default"))
+            self.assertFalse(run_incremental_migration(migration, "default"))
+            Item.objects.create(updated_at=base + timedelta(microseconds=123457))
+            self.assertTrue(run_incremental_migration(migration, "default"))
+            self.run_worker()
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        record = MigrationRecord.objects.get(key=migration.key)
+        self.assertEqual(record.watermark, (base + timedelta(microseconds=123457)).isoformat())
+
+    def test_incremental_migration_reads_watermarks_from_primary_record(self):
+        """ Tasks shouldn't process the objects of a previous run because of a stale cached record. """
+        migration = IncrementalIncrementMigration("testing", "0006_incremental")
+        Item.objects.bulk_create([Item() for _ in range(5)])
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            run_incremental_migration(migration, "default")
+            self.run_worker()
+            Item.objects.bulk_create([Item() for _ in range(3)])
+            run_incremental_migration(migration, "default")
+            # As if the cached record hadn't caught up with the start of the re-run
+            stale_record = MigrationRecord.objects.get(key=migration.key)
+            stale_record.watermark = stale_record.next_watermark = None
+            with mock.patch("massmigration.record_cache.get_record", return_value=stale_record):
+                self.run_worker()
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+
+    def test_run_incremental_command_skips_migration_launched_by_another_process(self):
+        migration = IncrementalIncrementMigration("testing", "0006_incremental")
+        Item.objects.create()
+        stdout = StringIO()
+        with mock.patch.object(store, "_all", [migration]), mock.patch.object(store, "_loaded", True):
+            with mock.patch.dict(store.by_key, {migration.key: migration}):
+                migration.launch("default")
+                # As if the check ran just before the other process launched it
+                with mock.patch.object(migration, "can_be_started", return_value=True):
+                    call_command("massmigration_run_incremental", "--database=default", stdout=stdout)
+        self.assertIn(f"Migration {migration.key} is already running on default.", stdout.getvalue())
+
+    def test_incremental_migration_only_processes_new_objects(self):
+        migration = IncrementalIncrementMigration("testing", "0006_incremental")
+        items = Item.objects.bulk_create([Item() for _ in range(5)])
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            self.assertTrue(run_incremental_migration(migration, "default"))
+            self.run_worker()
+            record = MigrationRecord.objects.get(key=migration.key)
+            self.assertTrue(record.is_applied)
+            self.assertEqual(record.watermark, items[-1].pk)
+            self.assertFalse(run_incremental_migration(migration, "default"))
+
+            new_items = Item.objects.bulk_create([Item() for _ in range(3)])
+            self.assertTrue(run_incremental_migration(migration, "default"))
+            record = MigrationRecord.objects.get(key=migration.key)
+            # The record stays applied while it's re-run
+            self.assertTrue(record.is_applied)
+            self.assertEqual(record.status(), MigrationRecord.Status.RUNNING)
+            self.assertFalse(run_incremental_migration(migration, "default"))
+            self.run_worker()
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        record = MigrationRecord.objects.get(key=migration.key)
+        self.assertEqual(record.status(), MigrationRecord.Status.APPLIED)
+        self.assertEqual(record.watermark, new_items[-1].pk)
+        attempts = MigrationAttempt.objects.filter(key=migration.key)
+        self.assertEqual([attempt.objects_processed for attempt in attempts], [3, 5])
+        self.assertEqual({attempt.status for attempt in attempts}, {MigrationAttempt.Status.APPLIED})
+
+    def test_restores_snapshot(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        Item.objects.bulk_create([Item(value=value) for value in range(10)])
+        migration = SnapshottedIncrementMigration("testing", "0007_snapshotted")
+        reverse_migration = RestoreIncrementMigration("testing", "0008_restore")
+        migrations = {migration.key: migration, reverse_migration.key: reverse_migration}
+        with override_settings(MEDIA_ROOT=media_root), mock.patch.dict(store.by_key, migrations):
+            migration.launch("default")
+            self.run_worker()
+            self.assertEqual(list(Item.objects.order_by("pk").values_list("value", flat=True)), list(range(1, 11)))
+            # One snapshot per chunk
+            self.assertEqual(MigrationSnapshot.objects.count(), 6)
+            self.assertEqual(sum(MigrationSnapshot.objects.values_list("object_count", flat=True)), 10)
+            reverse_migration.launch("default")
+            self.run_worker()
+        self.assertEqual(list(Item.objects.order_by("pk").values_list("value", flat=True)), list(range(10)))
+        self.assertTrue(MigrationRecord.objects.get(key=reverse_migration.key).is_applied)
+
+    def test_verification_does_not_snapshot_processed_objects_again(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        Item.objects.bulk_create([Item() for _ in range(6)])
+        migration = SnapshottedVerifiedMigration("testing", "0007_snapshotted")
+        reverse_migration = RestoreIncrementMigration("testing", "0008_restore")
+        migrations = {migration.key: migration, reverse_migration.key: reverse_migration}
+        with override_settings(MEDIA_ROOT=media_root), mock.patch.dict(store.by_key, migrations):
+            migration.launch("default")
+            self.run_worker()
+            self.assertTrue(MigrationRecord.objects.get(key=migration.key).is_applied)
+            self.assertEqual(set(Item.objects.values_list("value", flat=True)), {2})
+            paths = MigrationSnapshot.objects.values_list("path", flat=True)
+            pks = [row["pk"] for path in paths for row in read_snapshot(path)]
+            self.assertEqual(sorted(pks), sorted(Item.objects.values_list("pk", flat=True)))
+            reverse_migration.launch("default")
+            self.run_worker()
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {0})
+
+    def test_retried_chunk_keeps_earlier_snapshot(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        items = Item.objects.bulk_create([Item() for _ in range(4)])
+        migration = SnapshottedIncrementMigration("testing", "0007_snapshotted")
+        attempt_uuid = migration.mark_as_started("default")
+        task = MigrationTask.objects.create(key=migration.key, attempt_uuid=attempt_uuid)
+        with override_settings(MEDIA_ROOT=media_root):
+            write_snapshot(migration, task, items[:2])
+            # The task died part way through the chunk, and is retried with a bigger chunk
+            Item.objects.update(value=5)
+            snapshot = write_snapshot(migration, task, list(Item.objects.order_by("pk")))
+            self.assertEqual(
+                read_snapshot(snapshot.path), [{"pk": item.pk, "fields": {"value": 5}} for item in items[2:]]
+            )
+
+    def test_snapshot_values_are_refetched_from_primary(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        items = Item.objects.bulk_create([Item(value=5) for _ in range(3)])
+        Item.objects.filter(pk=items[2].pk).delete()
+        migration = SnapshottedIncrementMigration("testing", "0007_snapshotted")
+        attempt_uuid = migration.mark_as_started("default")
+        task = MigrationTask.objects.create(key=migration.key, attempt_uuid=attempt_uuid)
+        # As read from a replica which hasn't caught up with the primary
+        stale_items = [Item(pk=item.pk, value=1) for item in items]
+        with override_settings(MEDIA_ROOT=media_root):
+            snapshot = write_snapshot(migration, task, stale_items, refetch=True)
+            self.assertEqual(
+                read_snapshot(snapshot.path), [{"pk": item.pk, "fields": {"value": 5}} for item in items[:2]]
+            )
+
+    def test_reduces_results(self):
+        Item.objects.bulk_create([Item(value=value) for value in range(7)])
+        migration = CountingIncrementMigration("testing", "0009_counting")
+        migration.backend_params = {
+            "shard_count": 2, "chunk_size": 2, "split_after_seconds": 0.000001, "min_split_size": 2
+        }
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            migration.launch("default")
+            self.run_worker()
+        record = MigrationRecord.objects.get(key=migration.key)
+        self.assertTrue(record.is_applied)
+        # `map_result` sees the values once the operation has incremented them
+        self.assertEqual(record.result, {"odd": 4, "even": 3})
+        self.assertGreater(MigrationTask.objects.filter(partial_result__isnull=False).count(), 1)
+
+    def test_error_in_map_result_marks_migration_as_errored(self):
+        Item.objects.bulk_create([Item(value=value) for value in range(6)])
+        migration = CountingIncrementMigration("testing", "0009_counting")
+        migration.backend_params = {"shard_count": 1, "chunk_size": 2}
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            migration.launch("default")
+            error = ValueError("Bad result")
+            with mock.patch.object(migration, "map_result", side_effect=error) as map_result:
+                self.run_worker()
+        record = MigrationRecord.objects.get(key=migration.key)
+        self.assertTrue(record.has_error)
+        self.assertIn("ValueError: Bad result", record.last_error)
+        self.assertFalse(record.is_applied)
+        # The task stops at the first error, after the first object, rather than carrying on through its range
+        map_result.assert_called_once()
+        self.assertEqual(sorted(Item.objects.values_list("value", flat=True)), [1, 1, 2, 3, 4, 5])
+        self.assertFalse(MigrationTask.objects.exclude(status=MigrationTask.Status.DONE).exists())
+
+    def test_cannot_pause_finished_migration(self):
+        self.migration.launch("default")
+        self.run_worker()
+        self.assertRaises(MigrationNotRunning, self.migration.pause, "default")
+
+    def test_does_not_claim_leased_task(self):
+        backend = DatabaseBackend()
+        backend.run_mapper(self.migration, "default")
+        self.assertIsNotNone(backend.claim_task("default", "first"))
+        self.assertIsNone(backend.claim_task("default", "second"))
+
+    def test_runs_update_migration_in_chunks(self):
+        Item.objects.bulk_create([Item(value=index % 12) for index in range(20)])
+        migration = AddTenMigration("testing", "0002_add_ten")
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            migration.launch("default")
+            self.run_worker()
+        self.assertFalse(Item.objects.filter(value__lt=10).exists())
+        self.assertEqual(Item.objects.filter(value__gte=20).count(), 0)
+        self.assertEqual(sum(MigrationTask.objects.values_list("objects_processed", flat=True)), 18)
+        self.assertTrue(MigrationRecord.objects.get(key=migration.key).is_applied)
+
+    def run_delete_migration(self, migration_class):
+        migration = migration_class("testing", "0003_delete_small")
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            migration.launch("default")
+            self.run_worker()
+        return MigrationRecord.objects.get(key=migration.key)
+
+    def test_runs_delete_migration_with_raw_delete(self):
+        items = Item.objects.bulk_create([Item(value=index % 10) for index in range(20)])
+        ItemNote.objects.bulk_create([ItemNote(item=item) for item in items])
+        with mock.patch("django.db.models.query.QuerySet.delete") as delete:
+            record = self.run_delete_migration(DeleteSmallNotesMigration)
+        delete.assert_not_called()
+        self.assertFalse(ItemNote.objects.filter(item__value__lt=5).exists())
+        self.assertEqual(ItemNote.objects.count(), 10)
+        self.assertEqual(record.objects_processed, 10)
+        self.assertTrue(record.is_applied)
+
+    def test_runs_delete_migration_with_cascades(self):
+        items = Item.objects.bulk_create([Item(value=index) for index in range(10)])
+        ItemNote.objects.bulk_create([ItemNote(item=item) for item in items])
+        record = self.run_delete_migration(DeleteSmallMigration)
+        self.assertEqual(sorted(Item.objects.values_list("value", flat=True)), [5, 6, 7, 8, 9])
+        self.assertEqual(ItemNote.objects.count(), 5)
+        self.assertEqual(record.objects_processed, 5)
+        self.assertTrue(record.is_applied)
+
+    def test_runs_copy_migration(self):
+        Item.objects.bulk_create([Item(value=index) for index in range(10)])
+        migration = CopyItemsMigration("testing", "0004_copy_items")
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            migration.launch("default")
+            self.run_worker()
+        self.assertEqual(
+            sorted(ItemCopy.objects.values_list("source_id", "value")),
+            sorted((item.pk, item.value * 2) for item in Item.objects.all()),
+        )
+        self.assertTrue(MigrationRecord.objects.get(key=migration.key).is_applied)
+        # Re-running the chunks shouldn't create duplicates
+        attempt_uuid = MigrationRecord.objects.get(key=migration.key).attempt_uuid
+        list(migration.wrapped_chunks(attempt_uuid, "default"))
+        self.assertEqual(ItemCopy.objects.count(), 10)
+
+
+@mock.patch("djangae.utils.retry", call_without_retrying)
+class LeaseTestCase(TransactionTestCase):
+    """ Tests for the renewal of a DatabaseBackend task's lease while it's being processed. """
+
+    def test_lease_is_extended_during_long_operation(self):
+        migration = SimpleDatabaseMigration("testing", "0013_simple")
+        migration.wait_seconds = 2.5
+        backend = DatabaseBackend()
+        claims = []
+
+        def operation(db_alias):
+            SimpleDatabaseMigration.operation(migration, db_alias)
+            claims.append(backend.claim_task(db_alias, "second", lease_seconds=2))
+
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            migration.launch("default")
+            task = backend.claim_task("default", "first", lease_seconds=2)
+            with mock.patch.object(migration, "operation", side_effect=operation):
+                backend.process_task(task, lease_seconds=2)
+        # The lease hadn't expired when the operation finished, so no other worker could claim it
+        self.assertEqual(claims, [None])
+        task.refresh_from_db()
+        self.assertEqual(task.status, MigrationTask.Status.DONE)
+        self.assertEqual(task.claim_count, 1)
+        self.assertGreater(task.heartbeat_at, task.started_at)
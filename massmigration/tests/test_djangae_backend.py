@@ -0,0 +1,143 @@
+# Standard library
+from unittest import mock, skipIf
+
+# Third party
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+# Mass Migration
+from massmigration.loader import store
+from massmigration.migrations import MapperMigration, SimpleMigration
+from massmigration.models import MigrationRecord, MigrationTask
+from massmigration.tests.utils import call_without_retrying
+from testing.models import Item
+
+try:
+    from massmigration.backends.djangae import DjangaeBackend
+except (ImportError, RuntimeError):
+    # The backend needs a version of djangae with `djangae.tasks`, and that app to be installed
+    DjangaeBackend = None
+
+
+class DjangaeIncrementMigration(MapperMigration):
+    """ Test migration which increments the value of every Item. """
+
+    backend = "massmigration.backends.djangae.DjangaeBackend"
+    backend_params = {"shard_count": 2, "chunk_size": 2}
+
+    def get_queryset(self, db_alias):
+        return Item.objects.using(db_alias)
+
+    def operation(self, obj, db_alias):
+        obj.value += 1
+        obj.save()
+
+
+class DjangaeSimpleMigration(SimpleMigration):
+    backend = "massmigration.backends.djangae.DjangaeBackend"
+
+    def operation(self, db_alias):
+        Item.objects.using(db_alias).create(value=1)
+
+
+@skipIf(DjangaeBackend is None, "djangae.tasks is not available.")
+@override_settings(MASSMIGRATION_TASK_QUEUE="migrations")
+@mock.patch("djangae.utils.retry", call_without_retrying)
+class DjangaeBackendTestCase(TestCase):
+    """ Tests for the DjangaeBackend, with `defer` replaced by a list of the deferred tasks. """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.deferred = []
+        patcher = mock.patch("massmigration.backends.djangae.defer", side_effect=self.defer)
+        self.defer_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.migration = DjangaeIncrementMigration("testing", "0010_djangae_increment")
+        patcher = mock.patch.dict(store.by_key, {self.migration.key: self.migration})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def defer(self, function, *args, **kwargs):
+        self.deferred.append((function, args, kwargs))
+
+    def run_deferred(self, count=None):
+        """ Run the deferred tasks (and any tasks which they defer) in order, as the queue would. """
+        while self.deferred and count != 0:
+            function, args, kwargs = self.deferred.pop(0)
+            function(*args)
+            count = None if count is None else count - 1
+
+    def test_runs_mapper_to_completion(self):
+        Item.objects.bulk_create([Item() for _ in range(10)])
+        self.migration.launch("default")
+        task_count = MigrationTask.objects.count()
+        self.assertEqual(len(self.deferred), task_count)
+        self.assertTrue(all(kwargs["_transactional"] for _, _, kwargs in self.deferred))
+        self.assertTrue(all(kwargs["_queue"] == "migrations" for _, _, kwargs in self.deferred))
+        self.assertEqual(MigrationRecord.objects.get(key=self.migration.key).outstanding_tasks, task_count)
+        with mock.patch.object(
+            self.migration, "mark_as_finished", wraps=self.migration.mark_as_finished
+        ) as mark_as_finished:
+            self.run_deferred(count=1)
+            record = MigrationRecord.objects.get(key=self.migration.key)
+            self.assertEqual(record.outstanding_tasks, task_count - 1)
+            self.assertFalse(record.is_applied)
+            self.run_deferred()
+        mark_as_finished.assert_called_once()
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        record = MigrationRecord.objects.get(key=self.migration.key)
+        self.assertTrue(record.is_applied)
+        self.assertEqual(record.outstanding_tasks, 0)
+        self.assertFalse(MigrationTask.objects.exclude(status=MigrationTask.Status.DONE).exists())
+
+    def test_continues_task_in_new_deferred_task(self):
+        """ Once a task reaches its time limit, the rest of its range is continued in a new task. """
+        Item.objects.bulk_create([Item() for _ in range(10)])
+        self.migration.backend_params = {
+            "shard_count": 1, "target_chunk_seconds": 0.000001, "min_chunk_size": 2, "max_chunk_size": 2
+        }
+        self.migration.launch("default")
+        self.run_deferred()
+        # One deferred task per chunk, plus one which finds that there's nothing left
+        self.assertEqual(self.defer_mock.call_count, 6)
+        self.assertEqual(MigrationTask.objects.get().claim_count, 6)
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        self.assertTrue(MigrationRecord.objects.get(key=self.migration.key).is_applied)
+
+    def test_splits_long_running_task(self):
+        Item.objects.bulk_create([Item() for _ in range(10)])
+        self.migration.backend_params = {
+            "shard_count": 1, "chunk_size": 2, "split_after_seconds": 0.000001, "min_split_size": 2
+        }
+        self.migration.launch("default")
+        with mock.patch.object(
+            self.migration, "mark_as_finished", wraps=self.migration.mark_as_finished
+        ) as mark_as_finished:
+            self.run_deferred()
+        mark_as_finished.assert_called_once()
+        self.assertGreater(MigrationTask.objects.count(), 1)
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        self.assertEqual(MigrationRecord.objects.get(key=self.migration.key).outstanding_tasks, 0)
+
+    @override_settings(MASSMIGRATION_PAUSED_TASK_DELAY=30)
+    def test_paused_migration_defers_tasks_until_later(self):
+        Item.objects.bulk_create([Item() for _ in range(4)])
+        self.migration.launch("default")
+        self.migration.pause("default")
+        self.run_deferred(count=2)
+        self.assertEqual([kwargs["_countdown"] for _, _, kwargs in self.deferred], [30, 30])
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {0})
+        self.migration.resume("default")
+        self.run_deferred()
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        self.assertTrue(MigrationRecord.objects.get(key=self.migration.key).is_applied)
+
+    def test_defers_simple_migration_by_key(self):
+        migration = DjangaeSimpleMigration("testing", "0011_djangae_simple")
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            migration.launch("default")
+            self.assertEqual(self.deferred[0][1], (migration.key, "default"))
+            self.run_deferred()
+        self.assertTrue(MigrationRecord.objects.get(key=migration.key).is_applied)
+        self.assertEqual(Item.objects.count(), 1)
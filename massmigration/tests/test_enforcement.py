@@ -0,0 +1,125 @@
+# Standard library
+from unittest import mock
+
+# Third party
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+
+# Mass Migration
+from massmigration import enforcement
+from massmigration.exceptions import RequiredMigrationNotApplied
+from massmigration.loader import store
+from massmigration.migrations import SimpleMigration
+from massmigration.models import MigrationRecord
+from massmigration.tests.utils import call_without_retrying
+
+
+FIRST = SimpleMigration("testing", "0001_first")
+SECOND = SimpleMigration("testing", "0002_second")
+
+
+@enforcement.requires_migrations([("testing", "0001_first"), "testing:0002_second"], skip_in_tests=False)
+def needs_both():
+    return "done"
+
+
+@enforcement.requires_migration(("testing", "0002_second"), skip_in_tests=False)
+def needs_second():
+    return "done"
+
+
+@enforcement.view_requires_migrations([("testing", "0001_first")], skip_in_tests=False)
+def view_needing_first(request):
+    # Inside the same request, this check doesn't need to query the DB
+    try:
+        needs_second()
+    except RequiredMigrationNotApplied:
+        return HttpResponse("second not applied")
+    return HttpResponse("ok")
+
+
+class EnforcementTestCase(TestCase):
+    """ Tests for the `requires_migration(s)` decorators and the EnforcementMiddleware. """
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(store.by_key, {FIRST.key: FIRST, SECOND.key: SECOND})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(enforcement.APPLIED_MIGRATIONS_CACHE, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+        for name, value in [("_applied_version", None), ("_version_checked_at", None)]:
+            patcher = mock.patch.object(enforcement, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_requires_all_migrations_with_one_query(self):
+        MigrationRecord.objects.create(key=FIRST.key, is_applied=True)
+        with self.assertNumQueries(1):
+            self.assertRaises(RequiredMigrationNotApplied, needs_both)
+        MigrationRecord.objects.create(key=SECOND.key, is_applied=True)
+        with self.assertNumQueries(1):
+            self.assertEqual(needs_both(), "done")
+        # Applied migrations are cached for the life of the process
+        with self.assertNumQueries(0):
+            self.assertEqual(needs_both(), "done")
+
+    def test_request_scope_remembers_unapplied_migrations(self):
+        with enforcement.request_scope():
+            with self.assertNumQueries(1):
+                self.assertFalse(enforcement.migration_is_applied(FIRST.key, "default"))
+            # The other required migrations were checked in the same query
+            with self.assertNumQueries(0):
+                self.assertFalse(enforcement.migration_is_applied(FIRST.key, "default"))
+                self.assertRaises(RequiredMigrationNotApplied, needs_second)
+        # Outside of the request, unapplied migrations are checked again
+        with self.assertNumQueries(1):
+            self.assertFalse(enforcement.migration_is_applied(FIRST.key, "default"))
+
+    def test_middleware(self):
+        MigrationRecord.objects.create(key=FIRST.key, is_applied=True)
+        middleware = enforcement.EnforcementMiddleware(view_needing_first)
+        with self.assertNumQueries(1):
+            response = middleware(RequestFactory().get("/"))
+        self.assertEqual(response.content, b"second not applied")
+
+
+    def test_warm_applied_migrations(self):
+        MigrationRecord.objects.create(key=FIRST.key, is_applied=True)
+        MigrationRecord.objects.create(key=SECOND.key)
+        with self.assertNumQueries(1):
+            enforcement.warm_applied_migrations()
+        self.assertEqual(enforcement.APPLIED_MIGRATIONS_CACHE, {(FIRST.key, "default"): True})
+        # Other processes can load the snapshot from the cache
+        enforcement.APPLIED_MIGRATIONS_CACHE.clear()
+        with self.assertNumQueries(0):
+            enforcement.warm_applied_migrations()
+            self.assertTrue(enforcement.migration_is_applied(FIRST.key, "default"))
+
+    @mock.patch.object(enforcement, "VERSION_CHECK_INTERVAL", 0)
+    def test_deleting_record_invalidates_applied_migrations(self):
+        record = MigrationRecord.objects.create(key=FIRST.key, is_applied=True)
+        self.assertTrue(enforcement.migration_is_applied(FIRST.key, "default"))
+        with self.captureOnCommitCallbacks(execute=True):
+            record.delete()
+        self.assertFalse(enforcement.migration_is_applied(FIRST.key, "default"))
+
+    @override_settings(MASSMIGRATION_WARM_APPLIED_MIGRATIONS=True)
+    @mock.patch("djangae.utils.retry", call_without_retrying)
+    @mock.patch.object(enforcement, "VERSION_CHECK_INTERVAL", 0)
+    def test_finishing_migration_refreshes_warmed_applied_migrations(self):
+        enforcement.warm_applied_migrations()
+        self.assertFalse(enforcement.migration_is_applied(FIRST.key, "default"))
+        FIRST.mark_as_started("default")
+        version = cache.get(enforcement.APPLIED_VERSION_CACHE_KEY)
+        with self.captureOnCommitCallbacks(execute=True):
+            FIRST.mark_as_finished("default")
+            # Other processes only reload the applied migrations once the change is committed
+            self.assertEqual(cache.get(enforcement.APPLIED_VERSION_CACHE_KEY), version)
+        self.assertNotEqual(cache.get(enforcement.APPLIED_VERSION_CACHE_KEY), version)
+        # The snapshot is reloaded, so this doesn't need a query of its own
+        self.assertTrue(enforcement.migration_is_applied(FIRST.key, "default"))
+        self.assertEqual(cache.get(enforcement.APPLIED_SNAPSHOT_CACHE_KEY)[1], [(FIRST.key, "default")])
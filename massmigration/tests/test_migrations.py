@@ -0,0 +1,159 @@
+# Standard library
+from unittest import mock
+import uuid
+
+# Third party
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+# Mass Migration
+from massmigration import api, migrations
+from massmigration.loader import store
+from massmigration.migrations import MapperMigration
+from massmigration.models import MigrationAttempt, MigrationErrorSample, MigrationRecord
+from massmigration.tests.utils import call_without_retrying
+
+
+@mock.patch("djangae.utils.retry", call_without_retrying)
+class MarkAsErroredTestCase(TestCase):
+    """ Tests for `BaseMigration.mark_as_errored`. """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        migrations.ERRORED_ATTEMPTS.clear()
+        migrations.SAMPLED_ERRORS.clear()
+        self.migration = MapperMigration("massmigration", "0001_test")
+        self.attempt_uuid = self.migration.mark_as_started("default")
+
+    def test_first_error_wins(self):
+        self.migration.mark_as_errored("default", ValueError("first"), self.attempt_uuid)
+        self.migration.mark_as_errored("default", KeyError("second"), self.attempt_uuid)
+        record = MigrationRecord.objects.get(key=self.migration.key)
+        self.assertTrue(record.has_error)
+        self.assertEqual(record.last_error, "ValueError: first")
+
+    def test_does_not_update_record_once_seen_as_errored(self):
+        self.migration.mark_as_errored("default", ValueError("first"), self.attempt_uuid)
+        # Only the error sample should be written
+        with self.assertNumQueries(1):
+            self.migration.mark_as_errored("default", KeyError("second"), self.attempt_uuid)
+
+    def test_does_not_mark_other_attempt_as_errored(self):
+        self.migration.mark_as_errored("default", ValueError("stale"), uuid.uuid4())
+        self.assertFalse(MigrationRecord.objects.get(key=self.migration.key).has_error)
+
+    def test_samples_distinct_error_types(self):
+        for error in [ValueError("a"), ValueError("b"), KeyError("c")]:
+            self.migration.mark_as_errored("default", error, self.attempt_uuid)
+        samples = MigrationErrorSample.objects.filter(attempt_uuid=self.attempt_uuid)
+        self.assertEqual(sorted(samples.values_list("error_type", flat=True)), ["KeyError", "ValueError"])
+
+    @override_settings(MASSMIGRATION_MAX_ERROR_SAMPLES_PER_ATTEMPT=1)
+    def test_sample_limit_is_per_attempt(self):
+        self.migration.mark_as_errored("default", ValueError("a"), self.attempt_uuid)
+        self.migration.mark_as_errored("default", KeyError("b"), self.attempt_uuid)
+        other_attempt_uuid = uuid.uuid4()
+        self.migration.mark_as_errored("default", KeyError("c"), other_attempt_uuid)
+        self.assertEqual(MigrationErrorSample.objects.filter(attempt_uuid=self.attempt_uuid).count(), 1)
+        self.assertEqual(MigrationErrorSample.objects.filter(attempt_uuid=other_attempt_uuid).count(), 1)
+
+
+class FlakyMigration(MapperMigration):
+    """ Test migration whose operation raises a transient error the first `failures` times. """
+
+    retry_exceptions = (TimeoutError,)
+
+    def __init__(self, *args, failures=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failures = failures
+
+    def operation(self, obj, db_alias):
+        if self.failures:
+            self.failures -= 1
+            raise TimeoutError("Try again")
+
+
+@mock.patch("djangae.utils.retry", call_without_retrying)
+@mock.patch("massmigration.migrations.time.sleep")
+class OperationRetryTestCase(TestCase):
+    """ Tests for the retrying of transient errors in `MapperMigration.wrapped_operation`. """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        migrations.ERRORED_ATTEMPTS.clear()
+
+    def run_operation(self, migration):
+        attempt_uuid = migration.mark_as_started("default")
+        on_retry = mock.Mock()
+        result = migration.wrapped_operation(MigrationRecord(key="x:y"), attempt_uuid, "default", on_retry)
+        return result, MigrationRecord.objects.get(key=migration.key), on_retry.call_count
+
+    def test_retries_transient_errors(self, sleep):
+        succeeded, record, retries = self.run_operation(
+            FlakyMigration("massmigration", "0002_flaky", failures=2)
+        )
+        self.assertTrue(succeeded)
+        self.assertFalse(record.has_error)
+        self.assertEqual(retries, 2)
+        self.assertEqual(sleep.call_count, 2)
+        # The wait doubles, and a random amount of it is used
+        self.assertLessEqual(sleep.call_args_list[1][0][0], 0.2)
+
+    def test_marks_as_errored_after_max_attempts(self, sleep):
+        succeeded, record, retries = self.run_operation(
+            FlakyMigration("massmigration", "0003_flaky", failures=3)
+        )
+        self.assertFalse(succeeded)
+        self.assertTrue(record.has_error)
+        self.assertEqual(record.last_error, "TimeoutError: Try again")
+        self.assertEqual(retries, 2)
+
+    def test_does_not_retry_other_errors(self, sleep):
+        migration = FlakyMigration("massmigration", "0004_flaky", failures=1)
+        migration.retry_exceptions = (KeyError,)
+        succeeded, record, retries = self.run_operation(migration)
+        self.assertFalse(succeeded)
+        self.assertEqual(retries, 0)
+        sleep.assert_not_called()
+
+
+@mock.patch("djangae.utils.retry", call_without_retrying)
+class MigrationAttemptTestCase(TestCase):
+    """ Tests for the recording of MigrationAttempt history. """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        migrations.ERRORED_ATTEMPTS.clear()
+        self.migration = MapperMigration("massmigration", "0005_attempts")
+
+    def test_records_errored_attempt(self):
+        attempt_uuid = self.migration.mark_as_started("default")
+        attempt = MigrationAttempt.objects.get(attempt_uuid=attempt_uuid)
+        self.assertEqual(attempt.status, MigrationAttempt.Status.RUNNING)
+        self.migration.mark_as_errored("default", ValueError("first"), attempt_uuid)
+        self.migration.mark_as_errored("default", ValueError("second"), attempt_uuid)
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.status, MigrationAttempt.Status.ERRORED)
+        self.assertEqual(attempt.error, "ValueError: first")
+        self.assertIsNotNone(attempt.finished_at)
+
+    def test_attempts_survive_deletion_of_record(self):
+        first_uuid = self.migration.mark_as_started("default")
+        self.client.force_login(User.objects.create(username="admin", is_superuser=True))
+        with mock.patch.dict(store.by_key, {self.migration.key: self.migration}):
+            self.client.post(
+                reverse("massmigration_delete", kwargs={"key": self.migration.key, "db_alias": "default"})
+            )
+        self.assertFalse(MigrationRecord.objects.exists())
+        second_uuid = self.migration.mark_as_started("default")
+        self.migration.mark_as_finished("default")
+        attempts = api.get_migration_attempts(self.migration, "default")
+        self.assertEqual(
+            [(attempt.attempt_uuid, attempt.status) for attempt in attempts],
+            [(second_uuid, MigrationAttempt.Status.APPLIED), (first_uuid, MigrationAttempt.Status.DELETED)],
+        )
@@ -0,0 +1,119 @@
+# Standard library
+from unittest import mock
+import uuid
+
+# Third party
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.urls import reverse
+
+# Mass Migration
+from massmigration import planner
+from massmigration.api import plan_migration
+from massmigration.backends.database import DatabaseBackend
+from massmigration.loader import store
+from massmigration.migrations import MapperMigration, SimpleMigration
+from massmigration.models import MigrationAttempt, MigrationRecord
+from testing.models import Item
+
+
+class PlannedMigration(MapperMigration):
+    """ Test migration which does nothing to each Item. """
+
+    backend = "massmigration.backends.database.DatabaseBackend"
+    backend_params = {"shard_count": 2}
+
+    def get_queryset(self, db_alias):
+        return Item.objects.using(db_alias).filter(value=0)
+
+    def operation(self, obj, db_alias):
+        pass
+
+
+class PlanMigrationTestCase(TestCase):
+    """ Tests for `planner.plan_migration`. """
+
+    def setUp(self):
+        super().setUp()
+        Item.objects.bulk_create([Item() for _ in range(10)] + [Item(value=1)])
+        self.migration = PlannedMigration("testing", "0001_planned")
+
+    def test_plans_mapper_migration(self):
+        plan = plan_migration(self.migration, "default", estimate=False)
+        self.assertEqual(plan.row_count, 10)
+        self.assertFalse(plan.row_count_is_estimate)
+        self.assertEqual(plan.task_count, 2)
+        self.assertEqual(sum(size for _, _, size in plan.shards), 10)
+        self.assertIn("SCAN", plan.query_plan)
+        self.assertTrue(plan.full_scan)
+        self.assertEqual(plan.warnings, [])
+        # There's no previous rate to estimate the duration from
+        self.assertIsNone(plan.estimated_seconds)
+
+    def test_projects_duration_from_previous_rate(self):
+        MigrationRecord.objects.create(key=self.migration.key, seconds_per_object=2)
+        plan = plan_migration(self.migration, "default", estimate=False)
+        self.assertEqual(plan.estimated_seconds, max(size for _, _, size in plan.shards) * 2)
+
+    def test_projects_duration_from_previous_attempt(self):
+        MigrationAttempt.objects.create(
+            key=self.migration.key,
+            attempt_uuid=uuid.uuid4(),
+            db_alias="default",
+            status=MigrationAttempt.Status.APPLIED,
+            objects_per_second=5,
+        )
+        plan = plan_migration(self.migration, "default", estimate=False)
+        self.assertEqual(plan.estimated_seconds, 2)
+
+    def test_warns_about_full_scan_of_large_table(self):
+        with mock.patch.object(planner, "LARGE_TABLE_ROW_COUNT", 5):
+            plan = plan_migration(self.migration, "default", estimate=False)
+            self.assertEqual(len(plan.warnings), 1)
+
+    def test_estimate_mode_reports_unknown_size_without_table_statistics(self):
+        # SQLite has no table statistics, and the queryset mustn't be counted or scanned instead
+        with mock.patch("django.db.models.QuerySet.count") as count:
+            with mock.patch.object(DatabaseBackend, "get_key_ranges") as get_key_ranges:
+                plan = plan_migration(self.migration, "default")
+        count.assert_not_called()
+        get_key_ranges.assert_not_called()
+        self.assertIsNone(plan.row_count)
+        self.assertFalse(plan.row_count_is_estimate)
+        self.assertIsNone(plan.task_count)
+        self.assertIsNone(plan.estimated_seconds)
+
+    def test_simple_migration_has_single_task(self):
+        plan = plan_migration(SimpleMigration("testing", "0002_simple"), "default")
+        self.assertEqual(plan.task_count, 1)
+        self.assertIsNone(plan.row_count)
+
+    def get_run_page(self, query=""):
+        self.client.force_login(User.objects.create(username="admin", is_superuser=True))
+        url = reverse("massmigration_run", kwargs={"key": self.migration.key, "db_alias": "default"})
+        with mock.patch.dict(store.by_key, {self.migration.key: self.migration}):
+            return self.client.get(url + query)
+
+    def test_run_page_shows_plan(self):
+        response = self.get_run_page()
+        self.assertIsNone(response.context["plan"].row_count)
+        self.assertContains(response, "no table statistics")
+        self.assertContains(response, "Projected duration")
+
+    def test_run_page_estimates_table_size_by_default(self):
+        with mock.patch.object(planner, "_get_table_row_estimate", return_value=500):
+            with mock.patch("django.db.models.QuerySet.count") as count:
+                response = self.get_run_page()
+        count.assert_not_called()
+        self.assertTrue(response.context["plan"].row_count_is_estimate)
+        self.assertEqual(response.context["plan"].row_count, 500)
+        self.assertContains(response, "Rows in table")
+        self.assertContains(response, "not just of the migration's queryset")
+
+    def test_run_page_counts_objects_on_request(self):
+        with mock.patch.object(planner, "_get_table_row_estimate", return_value=500):
+            response = self.get_run_page("?count=1")
+        plan = response.context["plan"]
+        self.assertFalse(plan.row_count_is_estimate)
+        self.assertEqual(plan.row_count, 10)
+        self.assertEqual(sum(size for _, _, size in plan.shards), 10)
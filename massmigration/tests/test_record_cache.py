@@ -0,0 +1,66 @@
+# Standard library
+from unittest import mock
+
+# Third party
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+# Mass Migration
+from massmigration import record_cache
+from massmigration.models import MigrationRecord
+
+
+class RecordCacheTestCase(TestCase):
+    """ Tests for the 'record_cache.py' module. """
+
+    key = "massmigration:0001_test"
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_caches_record(self):
+        MigrationRecord.objects.create(key=self.key)
+        cache.clear()
+        with self.assertNumQueries(1):
+            record = record_cache.get_record(self.key, "default")
+            self.assertEqual(record_cache.get_record(self.key, "default"), record)
+        self.assertEqual(record.key, self.key)
+
+    def test_caches_absent_record(self):
+        """ A missing record should be cached as a tombstone rather than treated as a cache miss. """
+        with self.assertNumQueries(1):
+            self.assertIsNone(record_cache.get_record(self.key, "default"))
+            self.assertIsNone(record_cache.get_record(self.key, "default"))
+
+    def test_delete_stores_tombstone(self):
+        record = MigrationRecord.objects.create(key=self.key)
+        record.delete()
+        with self.assertNumQueries(0):
+            self.assertIsNone(record_cache.get_record(self.key, "default"))
+
+    @override_settings(MASSMIGRATION_RECORD_CACHE_TIMEOUT=60)
+    def test_stale_entry_served_while_refreshing(self):
+        """ If another caller is refreshing an expired entry, the stale value should be returned
+            without querying the DB.
+        """
+        record = MigrationRecord.objects.create(key=self.key)
+        cache_key = record_cache.get_cache_key(self.key, "default")
+        cache.set(cache_key, (record, 0), 120)
+        lock = record_cache._get_refresh_lock(cache_key)
+        lock.acquire()
+        try:
+            with self.assertNumQueries(0):
+                self.assertEqual(record_cache.get_record(self.key, "default"), record)
+        finally:
+            lock.release()
+        # Once nobody else is refreshing it, the expired entry gets refreshed
+        with self.assertNumQueries(1):
+            record_cache.get_record(self.key, "default")
+
+    def test_ignores_legacy_cache_values(self):
+        record = MigrationRecord.objects.create(key=self.key)
+        cache.set(record_cache.get_cache_key(self.key, "default"), record)
+        with mock.patch.object(record_cache, "_set_entry") as set_entry:
+            self.assertEqual(record_cache.get_record(self.key, "default"), record)
+        set_entry.assert_called_once()
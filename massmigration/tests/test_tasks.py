@@ -0,0 +1,294 @@
+# Standard library
+from unittest import mock
+
+# Third party
+from django.core.cache import cache
+from django.db import DatabaseError, connections
+from django.test import TestCase
+
+# Mass Migration
+from massmigration.loader import store
+from massmigration.migrations import MapperMigration
+from massmigration.models import MigrationRecord, MigrationTask
+from massmigration.tasks import DEFAULT_CHUNK_SIZE, ChunkSizer, _switch_to_primary, create_tasks, run_task
+from massmigration.tests.utils import call_without_retrying
+from massmigration.utils.processed import BLOCK_SIZE, WRITE_BATCH_SIZE, ProcessedSet
+from massmigration.utils.replication import get_replication_lag
+from testing.models import Item
+
+
+class AdaptiveMigration(MapperMigration):
+    backend_params = {"target_chunk_seconds": 60, "min_chunk_size": 5, "max_chunk_size": 1000}
+
+
+class ChunkSizerTestCase(TestCase):
+    """ Tests for `tasks.ChunkSizer`. """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.migration = AdaptiveMigration("testing", "0001_adaptive")
+        attempt_uuid = self.migration.mark_as_started("default")
+        self.task = create_tasks(self.migration, "default", attempt_uuid, [(None, None)])[0]
+
+    def test_uses_fixed_chunk_size_by_default(self):
+        migration = MapperMigration("testing", "0002_fixed")
+        sizer = ChunkSizer(migration, MigrationTask(key=migration.key))
+        self.assertEqual(sizer.next_size(), DEFAULT_CHUNK_SIZE)
+        sizer.record(10, 100)
+        self.assertEqual(sizer.next_size(), DEFAULT_CHUNK_SIZE)
+
+    def test_sizes_chunks_to_target_duration(self):
+        sizer = ChunkSizer(self.migration, self.task)
+        # With nothing measured yet, it starts small
+        self.assertEqual(sizer.next_size(), 5)
+        sizer.record(5, 1)
+        self.assertEqual(sizer.next_size(), 300)
+        # Slower objects mean smaller chunks, but no smaller than the minimum
+        sizer.record(300, 300 * 120)
+        self.assertEqual(sizer.next_size(), 5)
+        # Faster objects mean bigger chunks, but no bigger than the maximum
+        sizer.seconds_per_object = 0.001
+        self.assertEqual(sizer.next_size(), 1000)
+
+    def test_later_tasks_start_from_learned_rate(self):
+        sizer = ChunkSizer(self.migration, self.task)
+        sizer.record(10, 1)
+        sizer.store_learned_rate("default")
+        self.assertEqual(MigrationRecord.objects.get(key=self.migration.key).seconds_per_object, 0.1)
+        new_task = MigrationTask.objects.create(
+            key=self.migration.key, attempt_uuid=self.task.attempt_uuid, backend_method="run_mapper"
+        )
+        self.assertEqual(ChunkSizer(self.migration, new_task).next_size(), 600)
+
+
+class ProcessedSetTestCase(TestCase):
+    """ Tests for `utils.processed.ProcessedSet`. """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_integer_pks(self):
+        items = [Item(pk=pk) for pk in (1, 2, BLOCK_SIZE + 3, 5 * BLOCK_SIZE)]
+        processed = ProcessedSet("testing:0001", "attempt", Item)
+        self.assertEqual(processed.filter_unprocessed(items), items)
+        processed.add(2)
+        processed.add(5 * BLOCK_SIZE)
+        processed.flush()
+        # A new instance, e.g. in a retried task, sees what was stored
+        processed = ProcessedSet("testing:0001", "attempt", Item)
+        self.assertEqual(processed.filter_unprocessed(items), [items[0], items[2]])
+        self.assertEqual(ProcessedSet("testing:0001", "other", Item).filter_unprocessed(items), items)
+
+    def test_writes_added_pks_in_batches(self):
+        processed = ProcessedSet("testing:0001", "attempt", Item)
+        with mock.patch("massmigration.utils.processed.cache.set_many") as set_many:
+            for pk in range(1, WRITE_BATCH_SIZE * 2 + 2):
+                processed.add(pk)
+            self.assertEqual(set_many.call_count, 2)
+            processed.flush()
+            self.assertEqual(set_many.call_count, 3)
+            processed.flush()
+            self.assertEqual(set_many.call_count, 3)
+
+    def test_other_pks(self):
+        records = [MigrationRecord(key=key) for key in ("a:1", "a:2", "b:1")]
+        processed = ProcessedSet("testing:0001", "attempt", MigrationRecord)
+        processed.add("a:2")
+        processed.flush()
+        self.assertEqual(processed.filter_unprocessed(records), [records[0], records[2]])
+
+
+class SkipProcessedMigration(MapperMigration):
+    skip_processed_objects = True
+
+    def get_queryset(self, db_alias):
+        return Item.objects.using(db_alias)
+
+    def operation(self, obj, db_alias):
+        obj.value += 1
+        obj.save()
+
+
+class SkipProcessedObjectsTestCase(TestCase):
+    """ Tests for `MapperMigration.skip_processed_objects`. """
+
+    def test_retried_task_skips_processed_objects(self):
+        cache.clear()
+        items = Item.objects.bulk_create([Item() for _ in range(5)])
+        migration = SkipProcessedMigration("testing", "0003_skip_processed")
+        attempt_uuid = migration.mark_as_started("default")
+        task = create_tasks(migration, "default", attempt_uuid, [(None, None)])[0]
+        # Simulate a task which processed some objects but died before saving its cursor
+        processed = ProcessedSet(migration.key, attempt_uuid, Item)
+        for item in items[:2]:
+            migration.wrapped_operation(item, attempt_uuid, "default")
+            processed.add(item.pk)
+        processed.flush()
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            self.assertTrue(run_task(task, lambda task: True))
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+
+
+class BatchedMigration(MapperMigration):
+    objects_per_transaction = 3
+
+    def get_queryset(self, db_alias):
+        return Item.objects.using(db_alias)
+
+    def operation(self, obj, db_alias):
+        obj.value = 1
+        obj.save()
+        if obj.pk == self.failing_pk:
+            raise ValueError("Failed")
+
+
+class TransactionBatchingTestCase(TestCase):
+    """ Tests for `MapperMigration.objects_per_transaction`. """
+
+    def test_failed_object_is_rolled_back_alone(self):
+        cache.clear()
+        items = Item.objects.bulk_create([Item() for _ in range(5)])
+        migration = BatchedMigration("testing", "0004_batched")
+        migration.failing_pk = items[-1].pk
+        attempt_uuid = migration.mark_as_started("default")
+        task = create_tasks(migration, "default", attempt_uuid, [(None, None)])[0]
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            with mock.patch("djangae.utils.retry", call_without_retrying):
+                run_task(task, lambda task: True)
+        # The failed object's changes are rolled back, but not those of the rest of its batch
+        self.assertEqual(list(Item.objects.order_by("pk").values_list("value", flat=True)), [1, 1, 1, 1, 0])
+        self.assertTrue(MigrationRecord.objects.get(key=migration.key).has_error)
+
+    def test_transient_error_retries_batch_outside_transaction(self):
+        cache.clear()
+        items = Item.objects.bulk_create([Item() for _ in range(5)])
+        migration = BatchedMigration("testing", "0004_batched")
+        migration.failing_pk = items[1].pk
+        migration.retry_exceptions = (ValueError,)
+        attempt_uuid = migration.mark_as_started("default")
+        task = create_tasks(migration, "default", attempt_uuid, [(None, None)])[0]
+        connection = connections["default"]
+        # Test cases run in a transaction, so only the batch's transaction is counted
+        outer_atomic_depth = len(connection.atomic_blocks)
+
+        def sleep(seconds):
+            self.assertEqual(len(connection.atomic_blocks), outer_atomic_depth)
+            # The failing object succeeds when it's retried
+            migration.failing_pk = None
+
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            with mock.patch("massmigration.migrations.time.sleep", side_effect=sleep) as mock_sleep:
+                self.assertTrue(run_task(task, lambda task: True))
+        mock_sleep.assert_called_once()
+        self.assertEqual(task.operation_retries, 1)
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        self.assertFalse(MigrationRecord.objects.get(key=migration.key).has_error)
+
+
+class ReplicaMigration(MapperMigration):
+    read_db_alias = "replica"
+
+    def get_queryset(self, db_alias):
+        return Item.objects.using(db_alias)
+
+
+class ReadReplicaTestCase(TestCase):
+    """ Tests for `MapperMigration.read_db_alias`. """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.migration = ReplicaMigration("testing", "0005_replica")
+        self.items = [Item(pk=1, value=1), Item(pk=2, value=1)]
+
+    def test_objects_are_switched_to_primary(self):
+        objects = _switch_to_primary(self.migration, self.items, "default")
+        self.assertEqual([obj._state.db for obj in objects], ["default", "default"])
+
+    def test_objects_are_refetched_from_primary(self):
+        Item.objects.create(pk=1, value=2)
+        self.migration.refetch_from_primary = True
+        # The second object has been deleted from the primary since it was read from the replica
+        objects = _switch_to_primary(self.migration, self.items, "default")
+        self.assertEqual([(obj.pk, obj.value) for obj in objects], [(1, 2)])
+
+
+class DeadlineMigration(MapperMigration):
+    backend_params = {"chunk_size": 10}
+
+    def get_queryset(self, db_alias):
+        return Item.objects.using(db_alias)
+
+    def operation(self, obj, db_alias):
+        obj.value += 1
+        obj.save()
+        self.processed.append(obj.pk)
+
+
+class DeadlineTestCase(TestCase):
+    """ Tests for the `deadline` of `tasks.run_task`. """
+
+    def test_stops_at_object_boundary_and_continues_from_cursor(self):
+        cache.clear()
+        items = Item.objects.bulk_create([Item() for _ in range(5)])
+        migration = DeadlineMigration("testing", "0006_deadline")
+        migration.processed = []
+        attempt_uuid = migration.mark_as_started("default")
+        task = create_tasks(migration, "default", attempt_uuid, [(None, None)])[0]
+        progress = []
+
+        def on_progress(task):
+            progress.append((task.cursor, task.objects_processed))
+            return False
+
+        with mock.patch.dict(store.by_key, {migration.key: migration}):
+            # Time is measured in processed objects, so the deadline is reached after 3 of them
+            with mock.patch("massmigration.tasks.time.monotonic", lambda: len(migration.processed)):
+                self.assertFalse(run_task(task, on_progress, deadline=3))
+            self.assertEqual(progress, [(items[2].pk, 3)])
+            self.assertTrue(run_task(task, lambda task: True))
+        self.assertEqual(migration.processed, [item.pk for item in items])
+        self.assertEqual(set(Item.objects.values_list("value", flat=True)), {1})
+        self.assertEqual(task.objects_processed, 5)
+
+
+class ReplicationLagTestCase(TestCase):
+
+    def get_lag(self, vendor, execute):
+        connection = mock.MagicMock(vendor=vendor)
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.execute.side_effect = lambda sql: execute(cursor, sql)
+        with mock.patch("massmigration.utils.replication.connections", {"replica": connection}):
+            return get_replication_lag("replica"), cursor
+
+    def test_postgresql_replica_which_has_replayed_all_wal_has_no_lag(self):
+        def execute(cursor, sql):
+            cursor.fetchone.return_value = (0,)
+        lag, cursor = self.get_lag("postgresql", execute)
+        self.assertEqual(lag, 0)
+        self.assertIn(
+            "pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0", cursor.execute.call_args[0][0]
+        )
+
+    def test_falls_back_to_slave_status_on_old_mysql(self):
+        def execute(cursor, sql):
+            if sql == "SHOW REPLICA STATUS":
+                raise DatabaseError("You have an error in your SQL syntax")
+            cursor.description = [("Slave_IO_State",), ("Seconds_Behind_Master",)]
+            cursor.fetchone.return_value = ("Waiting for master to send event", 12)
+        lag, cursor = self.get_lag("mysql", execute)
+        self.assertEqual(lag, 12)
+        self.assertEqual(
+            [call[0][0] for call in cursor.execute.call_args_list],
+            ["SHOW REPLICA STATUS", "SHOW SLAVE STATUS"],
+        )
+
+    def test_reads_replica_status_on_mysql(self):
+        def execute(cursor, sql):
+            cursor.description = [("Replica_IO_State",), ("Seconds_Behind_Source",)]
+            cursor.fetchone.return_value = ("Waiting for source to send event", 3)
+        lag, cursor = self.get_lag("mysql", execute)
+        self.assertEqual(lag, 3)
+        cursor.execute.assert_called_once_with("SHOW REPLICA STATUS")
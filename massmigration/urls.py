@@ -7,5 +7,7 @@ urlpatterns = [
     path("manage/", views.manage_migrations, name="massmigration_manage"),
     path("run/<str:key>/<str:db_alias>/", views.run_migration, name="massmigration_run"),
     path("detail/<str:key>/<str:db_alias>/", views.migration_detail, name="massmigration_detail"),
+    path("pause/<str:key>/<str:db_alias>/", views.pause_migration, name="massmigration_pause"),
+    path("resume/<str:key>/<str:db_alias>/", views.resume_migration, name="massmigration_resume"),
     path("delete/<str:key>/<str:db_alias>/", views.delete_migration, name="massmigration_delete"),
 ]
@@ -0,0 +1,80 @@
+""" Utilities for splitting querysets into ranges of PKs and iterating over them, for backends which
+    do their own sharding rather than relying on a task queue library to do it.
+"""
+
+# Third party
+from django.db import models
+
+
+def get_key_ranges(queryset, shard_count):
+    """ Split the queryset into (up to) `shard_count` contiguous ranges of PK values. Returns a list
+        of (lower, upper) pairs, where `lower` is inclusive, `upper` is exclusive and None means
+        unbounded. There is always at least one range, even for an empty queryset.
+    """
+    pks = queryset.order_by("pk").values_list("pk", flat=True)
+    if isinstance(queryset.model._meta.pk, models.IntegerField):
+        # Integer PKs can be split arithmetically, which avoids scanning the table
+        smallest = pks.first()
+        biggest = pks.last()
+        if smallest is None:
+            return [(None, None)]
+        size = max((biggest - smallest) // shard_count, 1)
+        boundaries = list(range(smallest + size, biggest + 1, size))[:shard_count - 1]
+    else:
+        # Other PK types are split by offset, which costs a (partial) scan for each boundary
+        count = pks.count()
+        boundaries = []
+        for index in range(1, shard_count):
+            offset = count * index // shard_count
+            if offset:
+                boundaries.append(pks[offset])
+    boundaries = sorted(set(boundaries))
+    bounds = [None, *boundaries, None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def filter_key_range(queryset, lower, upper):
+    """ Filter the queryset to the given range, as returned by `get_key_ranges`. """
+    if lower is not None:
+        queryset = queryset.filter(pk__gte=lower)
+    if upper is not None:
+        queryset = queryset.filter(pk__lt=upper)
+    return queryset
+
+
+def get_split_point(queryset, lower, upper, after=None, min_size=2):
+    """ Find a PK which splits the remaining objects of the given range (those after the `after` PK,
+        if given) roughly in half, for handing the upper half of a range over to another task.
+        Returns None if there are fewer than `min_size` objects remaining.
+    """
+    queryset = filter_key_range(queryset, lower, upper)
+    if after is not None:
+        queryset = queryset.filter(pk__gt=after)
+    pks = queryset.order_by("pk").values_list("pk", flat=True)
+    remaining = pks.count()
+    if remaining < max(min_size, 2):
+        return None
+    if isinstance(queryset.model._meta.pk, models.IntegerField):
+        smallest = pks.first()
+        biggest = pks.last()
+        # The midpoint must leave at least one object below it
+        return max((smallest + biggest + 1) // 2, smallest + 1)
+    return pks[remaining // 2]
+
+
+def iterate_in_chunks(queryset, chunk_size, after=None):
+    """ Yield lists of (up to) `chunk_size` objects from the queryset in PK order, starting after the
+        given PK (if any). Each chunk is fetched with a separate query which filters on the PK rather
+        than using an offset, so that fetching each chunk is equally cheap.
+        `chunk_size` can be a function, which is called to get the size of each chunk.
+    """
+    queryset = queryset.order_by("pk")
+    while True:
+        size = chunk_size() if callable(chunk_size) else chunk_size
+        chunk_queryset = queryset if after is None else queryset.filter(pk__gt=after)
+        chunk = list(chunk_queryset[:size])
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            return
+        after = chunk[-1].pk
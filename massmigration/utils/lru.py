@@ -0,0 +1,23 @@
+# Standard library
+from collections import OrderedDict
+
+
+class LRUDict(OrderedDict):
+    """ A dict which holds at most `max_size` items. Once it's full, setting a new item drops the
+        least recently set (or looked up) one, so that per-process state can't grow without bound.
+    """
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
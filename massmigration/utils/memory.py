@@ -0,0 +1,26 @@
+# Standard library
+import resource
+import sys
+
+# Third party
+from django.conf import settings
+
+
+def get_memory_usage():
+    """ Return the resident set size (RSS) of the current process, in bytes. On platforms without
+        /proc (e.g. macOS), this falls back to the peak RSS of the process so far.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS but in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def memory_limit_exceeded():
+    """ Whether the current process is using more than `settings.MASSMIGRATION_MEMORY_LIMIT_MB`. """
+    limit_mb = getattr(settings, "MASSMIGRATION_MEMORY_LIMIT_MB", None)
+    return bool(limit_mb) and get_memory_usage() > limit_mb * 1024 * 1024
@@ -0,0 +1,85 @@
+""" A compact record, kept in the cache, of which objects a mapper migration attempt has already
+    processed, so that retried or re-run tasks can skip them.
+    See `MapperMigration.skip_processed_objects`.
+"""
+
+# Standard library
+import hashlib
+
+# Third party
+from django.core.cache import cache
+from django.db import models
+
+# The number of integer PKs covered by each bitmap, i.e. 1KB per cache entry
+BLOCK_SIZE = 8192
+# This only needs to outlive the migration attempt
+CACHE_TIMEOUT = 60 * 60 * 24 * 7
+# Added PKs are written to the cache (with one `set_many`) once this many have been added
+WRITE_BATCH_SIZE = 100
+
+
+class ProcessedSet:
+    """ The set of PKs processed by one attempt of a migration. Integer PKs are stored as bitmaps
+        covering blocks of `BLOCK_SIZE` PKs. Other PKs are stored as one (small) cache entry each.
+        Tasks whose ranges share a block may occasionally overwrite each other's updates to it, in
+        which case those objects are simply processed again if their task is retried.
+        Added PKs are written to the cache in batches of `WRITE_BATCH_SIZE`, and by `flush()`.
+    """
+
+    def __init__(self, key, attempt_uuid, model):
+        self.prefix = f"massmigration:processed:{key}:{attempt_uuid}"
+        self.use_bitmaps = isinstance(model._meta.pk, models.IntegerField)
+        self._bitmaps = {}
+        # The cache keys which have changed since the last write, and the number of PKs added
+        self._unwritten_keys = set()
+        self._unwritten_count = 0
+
+    def filter_unprocessed(self, objects):
+        """ Return the given objects minus those which have already been processed, fetching the
+            state of all of them from the cache in one go.
+        """
+        if self.use_bitmaps:
+            keys = {self._block_key(obj.pk) for obj in objects}
+            self._bitmaps.update(cache.get_many(keys))
+            return [obj for obj in objects if not self._is_set(obj.pk)]
+        keys = {obj.pk: self._pk_key(obj.pk) for obj in objects}
+        processed = cache.get_many(keys.values())
+        return [obj for obj in objects if keys[obj.pk] not in processed]
+
+    def add(self, pk):
+        """ Record that the object with the given PK has been processed. """
+        if self.use_bitmaps:
+            block_key = self._block_key(pk)
+            bitmap = bytearray(self._bitmaps.get(block_key) or bytes(BLOCK_SIZE // 8))
+            offset = pk % BLOCK_SIZE
+            bitmap[offset // 8] |= 1 << (offset % 8)
+            self._bitmaps[block_key] = bytes(bitmap)
+            self._unwritten_keys.add(block_key)
+        else:
+            self._unwritten_keys.add(self._pk_key(pk))
+        self._unwritten_count += 1
+        if self._unwritten_count >= WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """ Write the PKs which have been added since the last write to the cache, in one go. """
+        if not self._unwritten_keys:
+            return
+        if self.use_bitmaps:
+            values = {block_key: self._bitmaps[block_key] for block_key in self._unwritten_keys}
+        else:
+            values = dict.fromkeys(self._unwritten_keys, True)
+        cache.set_many(values, CACHE_TIMEOUT)
+        self._unwritten_keys = set()
+        self._unwritten_count = 0
+
+    def _is_set(self, pk):
+        bitmap = self._bitmaps.get(self._block_key(pk))
+        offset = pk % BLOCK_SIZE
+        return bool(bitmap) and bool(bitmap[offset // 8] & (1 << (offset % 8)))
+
+    def _block_key(self, pk):
+        return f"{self.prefix}:{pk // BLOCK_SIZE}"
+
+    def _pk_key(self, pk):
+        return f"{self.prefix}:{hashlib.md5(str(pk).encode()).hexdigest()}"
@@ -0,0 +1,47 @@
+# Standard library
+import logging
+
+# Third party
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+
+def get_replication_lag(db_alias):
+    """ Return the number of seconds by which the given (replica) DB is behind its primary, or None
+        if that can't be determined, e.g. because it's not a replica or its DB vendor isn't supported.
+    """
+    connection = connections[db_alias]
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                # The time since the last replayed transaction only measures the lag while there's
+                # WAL still to replay; a replica which is up to date with an idle primary isn't behind
+                cursor.execute(
+                    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN NULL "
+                    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+                )
+                row = cursor.fetchone()
+                return None if not row or row[0] is None else float(row[0])
+            if connection.vendor == "mysql":
+                return _get_mysql_replication_lag(cursor)
+    except DatabaseError:
+        logger.exception("Failed to get the replication lag of DB %s.", db_alias)
+    return None
+
+
+def _get_mysql_replication_lag(cursor):
+    try:
+        cursor.execute("SHOW REPLICA STATUS")
+        lag_column = "Seconds_Behind_Source"
+    except DatabaseError:
+        # MySQL before 8.0.22 only has the old names
+        cursor.execute("SHOW SLAVE STATUS")
+        lag_column = "Seconds_Behind_Master"
+    row = cursor.fetchone()
+    if not row:
+        return None
+    columns = [column[0] for column in cursor.description]
+    lag = dict(zip(columns, row)).get(lag_column)
+    return None if lag is None else float(lag)
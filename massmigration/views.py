@@ -1,16 +1,24 @@
 # Third party
 from collections import OrderedDict
+import logging
+
 from django.contrib import messages
 from django.http import Http404
+from django.views.decorators.http import require_POST
 from django.shortcuts import redirect, render
 
 # Mass Migration
-from massmigration.exceptions import DependentMigrationNotApplied
+from massmigration.exceptions import DependentMigrationNotApplied, MigrationNotRunning
 from massmigration.loader import store
 from massmigration.migrations import get_all_db_aliases
-from massmigration.models import MigrationRecord
+from massmigration.models import MigrationAttempt, MigrationErrorSample, MigrationRecord, MigrationTask
+from massmigration.planner import plan_migration
 from massmigration.utils.permissions import superuser_required
 
+logger = logging.getLogger(__name__)
+
+ERROR_SAMPLES_DISPLAY_LIMIT = 50
+
 
 @superuser_required()
 def manage_migrations(request):
@@ -47,9 +55,8 @@ def run_migration(request, key, db_alias):
     if not migration:
         raise Http404(f"Migration with key '{key}' not found.")
 
-    record = migration.get_migration_record(db_alias)
-
-    if record:
+    # Incremental migrations can be re-run once they've finished
+    if not migration.can_be_started(db_alias):
         messages.error(request, f"Migration '{key}' for db <{db_alias}> has already been started.")
         return redirect("massmigration_manage")
     try:
@@ -64,9 +71,19 @@ def run_migration(request, key, db_alias):
         return redirect("massmigration_manage")
 
     # else...
+    # Counting the queryset can take a long time on a large table, so that's only done on request
+    estimate = not request.GET.get("count")
+    try:
+        plan = plan_migration(migration, db_alias, estimate=estimate)
+    except Exception:
+        # The plan is only informational, so failing to make it mustn't stop the migration being run
+        logger.exception("Error planning migration %s on DB %s.", key, db_alias)
+        plan = None
     context = {
         "migration": migration,
         "db_alias": db_alias,
+        "plan": plan,
+        "estimate": estimate,
     }
     return render(request, "massmigration/run_migration.html", context)
 
@@ -90,15 +107,58 @@ def migration_detail(request, key, db_alias):
             "key": dep_key,
             "record": dependency_records_by_key.get(dep_key),
         })
+    error_samples = []
+    operation_retries = 0
+    if record:
+        error_samples = MigrationErrorSample.objects.using(db_alias).filter(
+            key=key, attempt_uuid=record.attempt_uuid
+        )[:ERROR_SAMPLES_DISPLAY_LIMIT]
+        # Retries are counted on each task, rather than on the record, to avoid contention on it
+        operation_retries = sum(MigrationTask.objects.using(db_alias).filter(
+            attempt_uuid=record.attempt_uuid
+        ).values_list("operation_retries", flat=True))
     context = {
         "migration": migration,
         "record": record,
+        "error_samples": error_samples,
+        "operation_retries": operation_retries,
         "dependencies": dependencies,
+        "can_be_started": migration.can_be_started(db_alias),
         "db_alias": db_alias,
     }
     return render(request, "massmigration/migration_detail.html", context)
 
 
+@superuser_required()
+@require_POST
+def pause_migration(request, key, db_alias):
+    """ Pause a running migration. """
+    return _set_paused(request, key, db_alias, pause=True)
+
+
+@superuser_required()
+@require_POST
+def resume_migration(request, key, db_alias):
+    """ Resume a paused migration. """
+    return _set_paused(request, key, db_alias, pause=False)
+
+
+def _set_paused(request, key, db_alias, pause):
+    migration = store.by_key.get(key)
+    if not migration:
+        raise Http404(f"Migration with key {key} not found.")
+    try:
+        if pause:
+            migration.pause(db_alias)
+        else:
+            migration.resume(db_alias)
+    except MigrationNotRunning as error:
+        messages.error(request, str(error))
+    else:
+        messages.success(request, f"Migration '{key}' {'paused' if pause else 'resumed'}.")
+    return redirect("massmigration_detail", key=key, db_alias=db_alias)
+
+
 @superuser_required()
 def delete_migration(request, key, db_alias):
     """ Delete a migration which has already started or has errored. """
@@ -117,6 +177,8 @@ def delete_migration(request, key, db_alias):
         return redirect("massmigration_manage")
 
     if request.method == "POST":
+        # The attempt's history is kept, for comparing it with other attempts
+        migration.finish_attempt(db_alias, record.attempt_uuid, MigrationAttempt.Status.DELETED)
         record.delete()
         messages.success(request, f"Deleted record for migration '{key}")
         return redirect("massmigration_manage")
@@ -0,0 +1,24 @@
+""" Models which are only used by the 'massmigration' tests. """
+
+# Third party
+from django.db import models
+
+
+class Item(models.Model):
+    """ A model for test migrations to operate on. """
+
+    value = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(null=True)
+
+
+class ItemNote(models.Model):
+    """ A model which cascades when an Item is deleted. """
+
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+
+
+class ItemCopy(models.Model):
+    """ A model for test migrations to copy Items into. """
+
+    source_id = models.IntegerField(unique=True)
+    value = models.IntegerField(default=0)